@@ -0,0 +1,345 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import glob
+import os
+import re
+import threading
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 镜像到列式存储的 api_logs 列及DuckDB类型（不含 error_message 等大文本列）
+ANALYTICS_COLUMNS = (
+    ('id', 'BIGINT'), ('api_key_id', 'INTEGER'), ('timestamp', 'TIMESTAMP'),
+    ('client_ip', 'VARCHAR'), ('provider', 'VARCHAR'), ('model', 'VARCHAR'),
+    ('request_path', 'VARCHAR'), ('request_method', 'VARCHAR'), ('response_code', 'INTEGER'),
+    ('response_time', 'DOUBLE'), ('time_to_first_token', 'DOUBLE'), ('success', 'BOOLEAN'),
+    ('tokens', 'BIGINT'), ('cost', 'DOUBLE'), ('cache_hit', 'BOOLEAN'),
+)
+# 可用于过滤和分组的列
+DIMENSIONS = (
+    'provider', 'model', 'client_ip', 'api_key_id', 'request_path',
+    'request_method', 'response_code', 'success', 'cache_hit'
+)
+TIME_BUCKETS = ('hour', 'day', 'week', 'month')
+
+# 延迟指标只统计实际调用了上游的成功请求
+_UPSTREAM_SUCCESS = 'success AND NOT cache_hit'
+METRICS = {
+    'calls': 'COUNT(*)',
+    'errors': 'COUNT(*) FILTER (WHERE NOT success)',
+    'error_rate': 'AVG(CASE WHEN success THEN 0.0 ELSE 1.0 END)',
+    'avg_latency': f'AVG(response_time) FILTER (WHERE {_UPSTREAM_SUCCESS})',
+    'p50_latency': f'quantile_cont(response_time, 0.5) FILTER (WHERE {_UPSTREAM_SUCCESS})',
+    'p95_latency': f'quantile_cont(response_time, 0.95) FILTER (WHERE {_UPSTREAM_SUCCESS})',
+    'p99_latency': f'quantile_cont(response_time, 0.99) FILTER (WHERE {_UPSTREAM_SUCCESS})',
+    'avg_ttft': 'AVG(time_to_first_token)',
+    'tokens': 'SUM(tokens)',
+    'cost': 'SUM(cost)',
+    'cache_hits': 'COUNT(*) FILTER (WHERE cache_hit)',
+}
+
+SEGMENT_PATTERN = re.compile(r'^api_logs_(\d+)_(\d+)\.parquet$')
+
+def _require_duckdb():
+    try:
+        import duckdb
+        import numpy
+    except ImportError:
+        raise ImportError("分析功能需要安装 duckdb 和 numpy: pip install duckdb numpy")
+    return duckdb, numpy
+
+def _as_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+
+def _column_arrays(numpy, name, type_, values):
+    """按列类型转换为NumPy数组，返回 {列名: 数组}
+
+    数值和布尔为 float64（NaN 即NULL），时间为 datetime64（NaT 即NULL），文本为定长
+    Unicode 数组加一列 <列名>__null 标记NULL。都是定长类型的数组，DuckDB按列整体
+    读取，不逐个转换Python对象。
+    """
+    if type_ == 'TIMESTAMP':
+        return {name: numpy.array(values, dtype='datetime64[us]')}
+    if type_ == 'VARCHAR':
+        nulls = numpy.array([value is None for value in values], dtype=bool)
+        return {name: numpy.array(['' if value is None else value for value in values], dtype=str),
+                f'{name}__null': nulls}
+    return {name: numpy.array([numpy.nan if value is None else value for value in values], dtype=numpy.float64)}
+
+def _quote_path(path):
+    return "'" + path.replace("'", "''") + "'"
+
+class UsageAnalytics:
+    """api_logs 的列式镜像和即席分析查询
+
+    - sync() 按 api_logs.id 高水位增量读取主库（主键范围扫描），每批写成一个不可变的
+      Parquet 段文件 api_logs_<首id>_<末id>.parquet，高水位即已有段的最大末id
+    - 最近 settle_seconds 内的日志暂不同步，避免并发事务晚提交的较小id被跳过
+    - query() 用内存中的DuckDB直接扫描段文件做过滤和分组聚合，不访问主库
+    - compact() 把相邻的小段合并为大段；id范围被其他段覆盖的段在查询时忽略，
+      合并过程中的查询不会重复计数
+    """
+
+    def __init__(self, db_manager, data_dir='logs/analytics', batch_size=100000,
+                 settle_seconds=5, max_segment_rows=2000000):
+        self.db_manager = db_manager
+        self.data_dir = data_dir
+        self.batch_size = batch_size
+        self.settle_seconds = settle_seconds
+        self.max_segment_rows = max_segment_rows
+        self._stop = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        """注册到 app.extensions，管理后台的分析页面使用本实例"""
+        app.extensions['usage_analytics'] = self
+        return self
+
+    def start(self, interval=60):
+        """在后台线程中每 interval 秒同步一次（多进程部署时只有拿到同步锁的进程会写入）"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,),
+                                            name='analytics-sync', daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"同步分析数据失败: {e}")
+
+    def segments(self):
+        """返回有效的段文件 [(首id, 末id, 路径)]，跳过id范围被其他段覆盖的段"""
+        found = []
+        for path in glob.glob(os.path.join(self.data_dir, 'api_logs_*.parquet')):
+            match = SEGMENT_PATTERN.match(os.path.basename(path))
+            if match:
+                found.append((int(match.group(1)), int(match.group(2)), path))
+        found.sort(key=lambda s: (s[0], -s[1]))
+        segments = []
+        covered = 0
+        for first, last, path in found:
+            if last > covered:
+                segments.append((first, last, path))
+                covered = last
+        return segments
+
+    def high_water_mark(self):
+        segments = self.segments()
+        return max(last for _, last, _ in segments) if segments else 0
+
+    @contextmanager
+    def _sync_lock(self):
+        """跨进程的同步锁，拿不到时返回False（其他进程正在同步）"""
+        os.makedirs(self.data_dir, exist_ok=True)
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(self.data_dir, '.sync.lock'), 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def sync(self, max_rows=None):
+        """把高水位之后的日志追加到镜像，返回同步的行数"""
+        with self._sync_lock() as acquired:
+            if not acquired:
+                return 0
+            duckdb, numpy = _require_duckdb()
+            high_water = self.high_water_mark()
+            cutoff = datetime.utcnow() - timedelta(seconds=self.settle_seconds)
+            columns = ', '.join(name for name, _ in ANALYTICS_COLUMNS)
+            synced = 0
+            while max_rows is None or synced < max_rows:
+                limit = self.batch_size if max_rows is None else min(self.batch_size, max_rows - synced)
+                with self.db_manager.get_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute(f"""
+                        SELECT {columns} FROM api_logs
+                        WHERE id > ?
+                        ORDER BY id
+                        LIMIT ?
+                    """, (high_water, limit))
+                    rows = [tuple(row) for row in cursor.fetchall()]
+                fetched = len(rows)
+                # 遇到尚未稳定的日志即停止，之后的行留到下次同步
+                for i, row in enumerate(rows):
+                    if row[2] is not None and _as_datetime(row[2]) >= cutoff:
+                        rows = rows[:i]
+                        break
+                if rows:
+                    self._write_segment(duckdb, numpy, rows)
+                    high_water = rows[-1][0]
+                    synced += len(rows)
+                if len(rows) < fetched or fetched < limit:
+                    break
+            if synced:
+                logger.info(f"分析数据已同步 {synced} 条，高水位 id={high_water}")
+            return synced
+
+    def _write_segment(self, duckdb, numpy, rows):
+        batch = {}
+        for (name, type_), values in zip(ANALYTICS_COLUMNS, zip(*rows)):
+            batch.update(_column_arrays(numpy, name, type_, values))
+        path = os.path.join(self.data_dir, f"api_logs_{rows[0][0]:012d}_{rows[-1][0]:012d}.parquet")
+        self._copy_to_parquet(duckdb, path, 'batch', batch)
+
+    def _copy_to_parquet(self, duckdb, path, source, data=None):
+        """把查询结果写为Parquet段（先写临时文件再重命名，查询不会读到写了一半的文件）"""
+        def column(name, type_):
+            value = f'CAST("{name}" AS {type_})'
+            if data is not None and f'{name}__null' in data:
+                value = f'CASE WHEN "{name}__null" THEN NULL ELSE {value} END'
+            if name == 'cache_hit':
+                value = f'COALESCE({value}, FALSE)'
+            return f'{value} AS "{name}"'
+
+        select = ', '.join(column(name, type_) for name, type_ in ANALYTICS_COLUMNS)
+        tmp_path = path + '.tmp'
+        conn = duckdb.connect()
+        try:
+            if data is not None:
+                conn.register(source, data)
+            conn.execute(f"COPY (SELECT {select} FROM {source} ORDER BY id) TO {_quote_path(tmp_path)} "
+                         f"(FORMAT parquet, COMPRESSION zstd)")
+        finally:
+            conn.close()
+        os.replace(tmp_path, path)
+
+    def compact(self):
+        """合并相邻的小段（每段不超过 max_segment_rows 行），返回合并后新建的段数"""
+        with self._sync_lock() as acquired:
+            if not acquired:
+                return 0
+            duckdb, _ = _require_duckdb()
+            groups = []
+            current = []
+            for segment in self.segments():
+                first = current[0][0] if current else segment[0]
+                if current and segment[1] - first + 1 > self.max_segment_rows:
+                    groups.append(current)
+                    current = []
+                current.append(segment)
+            groups.append(current)
+            merged = 0
+            for group in groups:
+                if len(group) < 2:
+                    continue
+                path = os.path.join(self.data_dir, f"api_logs_{group[0][0]:012d}_{group[-1][1]:012d}.parquet")
+                files = ', '.join(_quote_path(p) for _, _, p in group)
+                self._copy_to_parquet(duckdb, path, f"read_parquet([{files}])")
+                # 新段覆盖了原有段的id范围，此后的查询不再读取原有段
+                for _, _, old_path in group:
+                    os.remove(old_path)
+                merged += 1
+            return merged
+
+    def query(self, group_by=('provider',), metrics=('calls', 'error_rate', 'p50_latency'),
+              filters=None, start=None, end=None, bucket=None, order_by=None, limit=1000):
+        """在镜像上过滤、分组聚合，返回 [dict]
+
+        group_by 为 DIMENSIONS 中的列，bucket 为 TIME_BUCKETS 之一时按时间分桶（结果列为
+        bucket）；filters 为 {列: 值或值列表}；order_by 为结果列名，前缀 "-" 表示倒序，
+        默认按时间桶升序或第一个指标倒序。
+        """
+        group_by = list(group_by or ())
+        metrics = list(metrics or ())
+        for name in group_by:
+            if name not in DIMENSIONS:
+                raise ValueError(f"不支持的分组列: {name}")
+        for name in metrics:
+            if name not in METRICS:
+                raise ValueError(f"不支持的指标: {name}")
+        if not metrics:
+            raise ValueError("至少需要一个指标")
+        if bucket is not None and bucket not in TIME_BUCKETS:
+            raise ValueError(f"不支持的时间粒度: {bucket}")
+
+        files = [path for _, _, path in self.segments()]
+        if not files:
+            return []
+        duckdb, _ = _require_duckdb()
+
+        conditions = []
+        params = [files]
+        types = dict(ANALYTICS_COLUMNS)
+        for name, value in (filters or {}).items():
+            if name not in DIMENSIONS:
+                raise ValueError(f"不支持的过滤列: {name}")
+            # 参数统一转换为列类型，查询字符串中的 "1"、"true" 等可以直接使用
+            placeholder = f'CAST(? AS {types[name]})'
+            if isinstance(value, (list, tuple, set)):
+                values = list(value)
+                conditions.append(f'"{name}" IN ({", ".join([placeholder] * len(values))})')
+                params.extend(values)
+            else:
+                conditions.append(f'"{name}" = {placeholder}')
+                params.append(value)
+        if start is not None:
+            conditions.append('"timestamp" >= ?')
+            params.append(start)
+        if end is not None:
+            conditions.append('"timestamp" < ?')
+            params.append(end)
+
+        keys = ([f"date_trunc('{bucket}', \"timestamp\") AS bucket"] if bucket else []) + \
+            [f'"{name}"' for name in group_by]
+        columns = (['bucket'] if bucket else []) + group_by + metrics
+        if order_by is None:
+            order_by = 'bucket' if bucket else f'-{metrics[0]}'
+        descending = order_by.startswith('-')
+        order_column = order_by.lstrip('-')
+        if order_column not in columns:
+            raise ValueError(f"不支持的排序列: {order_by}")
+
+        select = ', '.join(keys + [f'{METRICS[name]} AS {name}' for name in metrics])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        group = f"GROUP BY {', '.join(str(i + 1) for i in range(len(keys)))}" if keys else ''
+        sql = f"""
+            SELECT {select}
+            FROM read_parquet(?)
+            {where}
+            {group}
+            ORDER BY "{order_column}" {'DESC' if descending else 'ASC'} NULLS LAST
+            LIMIT ?
+        """
+        params.append(int(limit))
+        conn = duckdb.connect()
+        try:
+            try:
+                rows = conn.execute(sql, params).fetchall()
+            except duckdb.IOException:
+                # 查询期间段文件被 compact() 合并删除，重新列出段文件后重试
+                params[0] = [path for _, _, path in self.segments()]
+                rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def status(self):
+        segments = self.segments()
+        return {
+            'segments': len(segments),
+            'high_water_mark': segments[-1][1] if segments else 0,
+            'bytes': sum(os.path.getsize(path) for _, _, path in segments),
+        }
@@ -1,20 +1,276 @@
+from collections import OrderedDict, namedtuple
 from datetime import datetime, timedelta
+import hashlib
+import hmac
+import json
+import math
+import os
 import secrets
+import threading
+import time
 from functools import wraps
-from flask import request, jsonify, g, current_app
+from flask import request, jsonify, g, current_app, make_response
 import logging
 
+from counters import MemoryCounterBackend
+from log_writer import BatchWriter
+from metrics import stage, timed
+from pagination import decode_cursor, encode_cursor
+from pricing import PriceTable
+from sketch import LatencySketch
+
 logger = logging.getLogger(__name__)
 
+# 今日调用次数，用于初始化每日限制计数
+DAILY_USAGE_SQL = """
+    SELECT COUNT(*) FROM api_logs 
+    WHERE api_key_id = ? AND timestamp >= ? AND timestamp < ?
+"""
+
+# 今日/本月 token 和费用，用于初始化预算计数
+USAGE_SEED_SQL = """
+    SELECT
+        COALESCE(SUM(CASE WHEN date >= ? THEN total_tokens END), 0),
+        COALESCE(SUM(CASE WHEN date >= ? THEN total_cost END), 0),
+        COALESCE(SUM(total_tokens), 0),
+        COALESCE(SUM(total_cost), 0)
+    FROM api_stats
+    WHERE api_key_id = ? AND date >= ?
+"""
+
+class KeyCache:
+    """带TTL的LRU密钥缓存（包括未知密钥的否定缓存）
+
+    以密钥前缀为键，缓存的记录只包含密钥哈希，不含明文密钥。
+    设置 on_invalidate(kind, values) 后，本地失效操作会通过它通知其他节点
+    （见 cluster.KeyInvalidationSync），kind 为 'prefixes'、'ids' 或 'clear'。
+    """
+
+    def __init__(self, max_size=10000, ttl=60, negative_ttl=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # key_prefix -> (record, expires_at)
+        self._ids = {}  # api_key_id -> {key_prefix}，用于按ID失效（轮换宽限期内新旧前缀可能同时缓存）
+        self._lock = threading.Lock()
+        self.on_invalidate = None
+
+    def get(self, key_prefix):
+        """返回 (命中, 记录)，记录为None表示否定缓存"""
+        with self._lock:
+            entry = self._entries.get(key_prefix)
+            if entry is None:
+                return False, None
+            record, expires_at = entry
+            if time.monotonic() >= expires_at:
+                self._remove(key_prefix)
+                return False, None
+            self._entries.move_to_end(key_prefix)
+            return True, record
+
+    def set(self, key_prefix, record):
+        """缓存密钥记录，record为None时写入否定缓存"""
+        ttl = self.ttl if record is not None else self.negative_ttl
+        with self._lock:
+            self._remove(key_prefix)
+            self._entries[key_prefix] = (record, time.monotonic() + ttl)
+            if record is not None:
+                self._ids.setdefault(record['id'], set()).add(key_prefix)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key_prefix):
+        """按密钥前缀失效"""
+        self.invalidate_many([key_prefix])
+
+    def invalidate_many(self, key_prefixes, propagate=True):
+        """按密钥前缀批量失效"""
+        key_prefixes = list(key_prefixes)
+        with self._lock:
+            for key_prefix in key_prefixes:
+                self._remove(key_prefix)
+        if propagate:
+            self._notify('prefixes', key_prefixes)
+
+    def invalidate_id(self, key_id):
+        """按密钥ID失效"""
+        self.invalidate_ids([key_id])
+
+    def invalidate_ids(self, key_ids, propagate=True):
+        """按密钥ID批量失效（只加一次锁）"""
+        key_ids = list(key_ids)
+        with self._lock:
+            for key_id in key_ids:
+                for key_prefix in list(self._ids.get(key_id, ())):
+                    self._remove(key_prefix)
+        if propagate:
+            self._notify('ids', key_ids)
+
+    def clear(self, propagate=True):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._ids.clear()
+        if propagate:
+            self._notify('clear', [])
+
+    def hot_prefixes(self):
+        """返回缓存中已知密钥的前缀，最近使用的在前（用于缓存快照）"""
+        with self._lock:
+            return [prefix for prefix, (record, _) in reversed(self._entries.items()) if record is not None]
+
+    def _notify(self, kind, values):
+        if self.on_invalidate is None:
+            return
+        try:
+            self.on_invalidate(kind, values)
+        except Exception as e:
+            logger.error(f"广播密钥缓存失效失败: {e}")
+
+    def _remove(self, key_prefix):
+        entry = self._entries.pop(key_prefix, None)
+        if entry is not None and entry[0] is not None:
+            prefixes = self._ids.get(entry[0]['id'])
+            if prefixes is not None:
+                prefixes.discard(key_prefix)
+                if not prefixes:
+                    del self._ids[entry[0]['id']]
+
+RateLimitResult = namedtuple(
+    'RateLimitResult', ['allowed', 'limit', 'remaining', 'reset_after', 'retry_after']
+)
+
+class RateLimiter:
+    """基于GCRA的短周期速率限制器
+
+    每个 (密钥, 周期) 只保存一个理论到达时间（TAT），不访问数据库。
+    limit 次/period 秒，允许最多 limit 次的突发。
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._tat = {}  # (api_key_id, period) -> tat
+        self._lock = threading.Lock()
+
+    def check(self, api_key_id, limits):
+        """按 [(limit, period), ...] 检查并占用一次请求额度"""
+        now = time.monotonic()
+        with self._lock:
+            updates = []
+            result = None
+            for limit, period in limits:
+                interval = period / limit
+                tat = max(self._tat.get((api_key_id, period), now), now)
+                new_tat = tat + interval
+                allow_at = new_tat - period
+                if now < allow_at:
+                    # 任一周期超限则整体拒绝，不占用其他周期的额度
+                    return RateLimitResult(False, limit, 0, tat - now, allow_at - now)
+                remaining = int((period - (new_tat - now)) / interval + 1e-9)
+                updates.append(((api_key_id, period), new_tat))
+                # 响应头报告剩余额度最少的限制
+                if result is None or remaining < result.remaining:
+                    result = RateLimitResult(True, limit, remaining, new_tat - now, 0)
+            if len(self._tat) + len(updates) > self.max_entries:
+                self._prune(now)
+            self._tat.update(updates)
+            return result
+
+    def refund(self, api_key_id, limits):
+        """退还一次 check() 占用的额度（请求通过速率检查后又被其他检查拒绝时调用）"""
+        now = time.monotonic()
+        with self._lock:
+            for limit, period in limits:
+                entry = (api_key_id, period)
+                tat = self._tat.get(entry)
+                if tat is None:
+                    continue
+                tat -= period / limit
+                if tat <= now:
+                    del self._tat[entry]
+                else:
+                    self._tat[entry] = tat
+
+    def reset(self, api_key_id):
+        """清除密钥的速率状态"""
+        self.reset_many([api_key_id])
+
+    def reset_many(self, api_key_ids):
+        """一次清除多个密钥的速率状态"""
+        api_key_ids = set(api_key_ids)
+        with self._lock:
+            for entry in [k for k in self._tat if k[0] in api_key_ids]:
+                del self._tat[entry]
+
+    def _prune(self, now):
+        # TAT已过去的条目与不存在等价，可直接删除
+        for entry in [k for k, tat in self._tat.items() if tat <= now]:
+            del self._tat[entry]
+
+LEGACY_PREFIX_LENGTH = 16
+
+def generate_api_key():
+    """生成 "前缀.密文" 格式的API密钥，返回 (完整密钥, 前缀, 密文)"""
+    prefix = secrets.token_hex(6)
+    secret = secrets.token_urlsafe(24)
+    return f"{prefix}.{secret}", prefix, secret
+
+def split_api_key(api_key):
+    """拆分为 (前缀, 密文)；旧格式的32位密钥取前16位作为前缀"""
+    if '.' in api_key:
+        prefix, _, secret = api_key.partition('.')
+        return prefix, secret
+    return api_key[:LEGACY_PREFIX_LENGTH], api_key[LEGACY_PREFIX_LENGTH:]
+
+# 搜索条件按字面匹配，配合 LIKE ? ESCAPE '\' 使用
+SEARCH_SQL = "({alias}name LIKE ? ESCAPE '\\' OR {alias}key_prefix LIKE ? ESCAPE '\\')"
+
+def like_escape(value):
+    """转义 LIKE 模式中的通配符 % 和 _"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
 class ApiKeyManager:
-    def __init__(self, db_manager):
+    def __init__(self, db_manager, cache_size=10000, cache_ttl=60, negative_cache_ttl=10,
+                 counter_backend=None, price_table=None, hash_secret=None):
         self.db_manager = db_manager
+        hash_secret = hash_secret or os.getenv('API_KEY_HASH_SECRET') or os.getenv('SECRET_KEY') or ''
+        if not hash_secret:
+            logger.warning("未配置API_KEY_HASH_SECRET，密钥哈希未使用服务端密钥")
+        self._hash_secret = hash_secret.encode() if isinstance(hash_secret, str) else hash_secret
+        self.key_cache = KeyCache(cache_size, cache_ttl, negative_cache_ttl)
+        self.rate_limiter = RateLimiter()
+        self.counters = counter_backend or MemoryCounterBackend()
+        self.price_table = price_table or PriceTable()
+        self._seeded_counters = set()
+        self._seeded_day = None
+        self.log_writer = None
+
+    def enable_log_writer(self, batch_size=100, flush_interval=1.0,
+                          max_queue_size=10000, overflow='drop'):
+        """启用后台批量日志写入"""
+        self.log_writer = BatchWriter(
+            self.write_log_records,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            max_queue_size=max_queue_size,
+            overflow=overflow,
+            name='api-log-writer'
+        ).start()
+        return self.log_writer
 
-    def create_key(self, name, created_by, validity_days=365, daily_limit=1000):
-        """创建新的API密钥"""
+    def close(self):
+        """关闭后台写入器，写完队列中剩余的日志"""
+        if self.log_writer:
+            self.log_writer.close()
+
+    def create_key(self, name, created_by, validity_days=365, daily_limit=1000,
+                   requests_per_second=None, requests_per_minute=None,
+                   daily_token_limit=None, monthly_token_limit=None,
+                   daily_cost_limit=None, monthly_cost_limit=None, response_cache_enabled=False):
+        """创建新的API密钥（明文密钥只在返回值中出现一次）"""
         try:
-            # 生成随机密钥
-            api_key = secrets.token_hex(16)
+            # 生成随机密钥，数据库只保存前缀和HMAC哈希
+            api_key, prefix, secret = generate_api_key()
             
             # 计算过期时间
             expires_at = datetime.now() + timedelta(days=validity_days) if validity_days > 0 else None
@@ -24,21 +280,34 @@ class ApiKeyManager:
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT INTO api_keys (
-                        key, name, created_by, created_at, 
-                        expires_at, status, daily_limit
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
+                        key_prefix, key_hash, name, created_by, created_at, 
+                        expires_at, status, daily_limit,
+                        requests_per_second, requests_per_minute,
+                        daily_token_limit, monthly_token_limit,
+                        daily_cost_limit, monthly_cost_limit, response_cache_enabled
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    RETURNING id
                 """, (
-                    api_key,
+                    prefix,
+                    self.hash_secret(secret),
                     name,
                     created_by,
                     datetime.now(),
                     expires_at,
                     'active',
-                    daily_limit
+                    daily_limit,
+                    requests_per_second,
+                    requests_per_minute,
+                    daily_token_limit,
+                    monthly_token_limit,
+                    daily_cost_limit,
+                    monthly_cost_limit,
+                    bool(response_cache_enabled)
                 ))
+                key_id = cursor.fetchone()[0]
                 conn.commit()
-                key_id = cursor.lastrowid
                 
+            self.key_cache.invalidate(prefix)
             logger.info(f"创建新API密钥: name={name}, id={key_id}")
             return {'id': key_id, 'key': api_key}
             
@@ -46,55 +315,486 @@ class ApiKeyManager:
             logger.error(f"创建API密钥失败: {e}")
             raise
 
-    def validate_key(self, api_key):
-        """验证API密钥并返回密钥对象"""
+    def create_keys(self, count, created_by, name=None, validity_days=365, daily_limit=1000,
+                    requests_per_second=None, requests_per_minute=None,
+                    daily_token_limit=None, monthly_token_limit=None,
+                    daily_cost_limit=None, monthly_cost_limit=None, response_cache_enabled=False,
+                    chunk_size=500):
+        """在一个事务中批量创建API密钥，返回 [{'id', 'name', 'key', 'expires_at'}]
+
+        每 chunk_size 个密钥一条多行INSERT，RETURNING 取回ID，全部成功后才提交。
+        """
+        now = datetime.now()
+        expires_at = now + timedelta(days=validity_days) if validity_days > 0 else None
+        keys = []
+        for i in range(count):
+            api_key, prefix, secret = generate_api_key()
+            keys.append({
+                'name': f"{name}-{i + 1}" if name else None,
+                'key': api_key,
+                'prefix': prefix,
+                'hash': self.hash_secret(secret),
+                'expires_at': expires_at
+            })
+            
         try:
+            ids = {}
             with self.db_manager.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT * FROM api_keys 
-                    WHERE key = ? AND status = 'active'
-                """, (api_key,))
-                key_obj = cursor.fetchone()
+                for start in range(0, count, chunk_size):
+                    chunk = keys[start:start + chunk_size]
+                    params = []
+                    for key in chunk:
+                        params.extend((
+                            key['prefix'], key['hash'], key['name'], created_by, now,
+                            expires_at, 'active', daily_limit,
+                            requests_per_second, requests_per_minute,
+                            daily_token_limit, monthly_token_limit,
+                            daily_cost_limit, monthly_cost_limit, bool(response_cache_enabled)
+                        ))
+                    placeholders = ', '.join(['(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'] * len(chunk))
+                    cursor.execute(f"""
+                        INSERT INTO api_keys (
+                            key_prefix, key_hash, name, created_by, created_at,
+                            expires_at, status, daily_limit,
+                            requests_per_second, requests_per_minute,
+                            daily_token_limit, monthly_token_limit,
+                            daily_cost_limit, monthly_cost_limit, response_cache_enabled
+                        ) VALUES {placeholders}
+                        RETURNING id, key_prefix
+                    """, params)
+                    ids.update((row[1], row[0]) for row in cursor.fetchall())
+                conn.commit()
                 
-                if not key_obj:
-                    return None
-                    
-                # 检查是否过期
-                if key_obj['expires_at'] and datetime.now() > key_obj['expires_at']:
-                    return None
-                    
-                return key_obj
+        except Exception as e:
+            logger.error(f"批量创建API密钥失败: {e}")
+            raise
+            
+        self.key_cache.invalidate_many(ids)
+        logger.info(f"批量创建API密钥: count={count}, created_by={created_by}")
+        return [{
+            'id': ids[key['prefix']],
+            'name': key['name'],
+            'key': key['key'],
+            'expires_at': key['expires_at']
+        } for key in keys]
+
+    def revoke_keys(self, key_ids=None, search=None, created_by=None, created_before=None,
+                    chunk_size=500):
+        """在一个事务中按条件批量禁用API密钥，返回被禁用的密钥ID
+
+        条件之间为AND关系，至少需要一个条件。
+        """
+        conditions, params = ["status = 'active'"], []
+        if search:
+            search = like_escape(search)
+            conditions.append(SEARCH_SQL.format(alias=''))
+            params.extend([f"%{search}%", f"{search}%"])
+        if created_by:
+            conditions.append("created_by = ?")
+            params.append(created_by)
+        if created_before:
+            conditions.append("created_at < ?")
+            params.append(created_before)
+        if key_ids is None and len(conditions) == 1:
+            raise ValueError("批量禁用至少需要一个过滤条件")
+            
+        id_chunks = [None]
+        if key_ids is not None:
+            key_ids = list(key_ids)
+            id_chunks = [key_ids[i:i + chunk_size] for i in range(0, len(key_ids), chunk_size)]
+            
+        try:
+            revoked = []
+            with self.db_manager.get_connection() as conn:
+                cursor = conn.cursor()
+                for chunk in id_chunks:
+                    where, chunk_params = list(conditions), list(params)
+                    if chunk is not None:
+                        where.append(f"id IN ({', '.join('?' * len(chunk))})")
+                        chunk_params.extend(chunk)
+                    cursor.execute(f"""
+                        UPDATE api_keys SET status = 'disabled', updated_at = ?
+                        WHERE {' AND '.join(where)}
+                        RETURNING id
+                    """, [datetime.now()] + chunk_params)
+                    revoked.extend(row[0] for row in cursor.fetchall())
+                conn.commit()
                 
         except Exception as e:
-            logger.error(f"验证API密钥时出错: {e}")
-            return None
+            logger.error(f"批量禁用API密钥失败: {e}")
+            raise
+            
+        self.invalidate_keys(revoked)
+        logger.info(f"批量禁用API密钥: count={len(revoked)}")
+        return revoked
 
-    def check_rate_limit(self, api_key_id):
-        """检查API密钥的使用频率限制"""
+    def rotate_keys(self, key_ids, grace_period=timedelta(hours=24), chunk_size=500):
+        """在一个事务中批量轮换API密钥，返回 [{'id', 'key', 'previous_key_expires_at'}]
+
+        新密钥立即生效，旧密钥在 grace_period 内仍然有效。密钥ID不变，
+        用量、预算和统计继续累计。
+        """
+        now = datetime.now()
+        grace_until = now + grace_period
+        key_ids = list(key_ids)
+        rotated = []
         try:
             with self.db_manager.get_connection() as conn:
                 cursor = conn.cursor()
+                for start in range(0, len(key_ids), chunk_size):
+                    chunk = key_ids[start:start + chunk_size]
+                    cursor.execute(f"""
+                        SELECT id, key, key_prefix, key_hash FROM api_keys
+                        WHERE id IN ({', '.join('?' * len(chunk))})
+                    """, chunk)
+                    params = []
+                    for row in cursor.fetchall():
+                        previous_prefix, previous_hash = row['key_prefix'], row['key_hash']
+                        if not previous_hash and row['key']:
+                            # 尚未迁移的明文旧密钥，按迁移后的格式保留
+                            previous_prefix, secret = split_api_key(row['key'])
+                            previous_hash = self.hash_secret(secret)
+                        api_key, prefix, secret = generate_api_key()
+                        params.append((
+                            previous_prefix, previous_hash, grace_until,
+                            prefix, self.hash_secret(secret), now, row['id']
+                        ))
+                        rotated.append({
+                            'id': row['id'],
+                            'key': api_key,
+                            'previous_key_expires_at': grace_until
+                        })
+                    cursor.executemany("""
+                        UPDATE api_keys SET
+                            previous_key_prefix = ?, previous_key_hash = ?,
+                            previous_key_expires_at = ?,
+                            key_prefix = ?, key_hash = ?, key = NULL, updated_at = ?
+                        WHERE id = ?
+                    """, params)
+                conn.commit()
                 
-                # 获取今日使用次数
-                cursor.execute("""
-                    SELECT COUNT(*) FROM api_logs 
-                    WHERE api_key_id = ? AND DATE(timestamp) = DATE('now')
-                """, (api_key_id,))
-                today_usage = cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"批量轮换API密钥失败: {e}")
+            raise
+            
+        # 速率和用量状态按ID保存，轮换后继续有效，只需清除缓存的旧记录
+        self.key_cache.invalidate_ids([key['id'] for key in rotated])
+        logger.info(f"批量轮换API密钥: count={len(rotated)}")
+        return rotated
+
+    def dump_cache_snapshot(self, path):
+        """把缓存中的密钥前缀写入快照文件，返回写入的数量
+
+        快照只包含前缀，不含密钥哈希；新进程启动时用 warm_cache() 预热。
+        """
+        prefixes = self.key_cache.hot_prefixes()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'created_at': datetime.now().isoformat(), 'prefixes': prefixes}, f)
+            os.replace(tmp_path, path)
+            return len(prefixes)
+        except Exception as e:
+            logger.error(f"写入密钥缓存快照失败: {e}")
+            return 0
+
+    def warm_cache(self, path, chunk_size=500):
+        """按快照中的前缀批量读取密钥记录并写入缓存，返回预热的数量
+
+        记录从数据库重新读取，快照之后被禁用或删除的密钥不会因预热而继续有效。
+        """
+        try:
+            with open(path, encoding='utf-8') as f:
+                prefixes = json.load(f).get('prefixes', [])[:self.key_cache.max_size]
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logger.error(f"读取密钥缓存快照失败: {e}")
+            return 0
+            
+        # 最近使用的前缀最后写入，在LRU中保持最新
+        prefixes.reverse()
+        loaded = 0
+        try:
+            with self.db_manager.get_connection() as conn:
+                cursor = conn.cursor()
+                for start in range(0, len(prefixes), chunk_size):
+                    chunk = prefixes[start:start + chunk_size]
+                    placeholders = ', '.join(['?'] * len(chunk))
+                    cursor.execute(f"SELECT * FROM api_keys WHERE key_prefix IN ({placeholders})", chunk)
+                    rows = {row['key_prefix']: row for row in cursor.fetchall()}
+                    rotated = [prefix for prefix in chunk if prefix not in rows]
+                    if rotated:
+                        placeholders = ', '.join(['?'] * len(rotated))
+                        cursor.execute(f"SELECT * FROM api_keys WHERE previous_key_prefix IN ({placeholders})",
+                                       rotated)
+                        rows.update((row['previous_key_prefix'], row) for row in cursor.fetchall())
+                    for prefix in chunk:
+                        if prefix in rows:
+                            self.key_cache.set(prefix, rows[prefix])
+                            loaded += 1
+        except Exception as e:
+            logger.error(f"预热密钥缓存失败: {e}")
+            
+        logger.info(f"从快照预热密钥缓存: {loaded}/{len(prefixes)}")
+        return loaded
+
+    def hash_secret(self, secret):
+        """计算密钥密文的HMAC-SHA256"""
+        return hmac.new(self._hash_secret, secret.encode(), hashlib.sha256).hexdigest()
+
+    def validate_key(self, api_key):
+        """验证API密钥并返回密钥对象"""
+        try:
+            prefix, secret = split_api_key(api_key)
+            hit, key_obj = self.key_cache.get(prefix)
+            if not hit:
+                # 缓存不分状态的记录，禁用后可按ID立即失效
+                with self.db_manager.get_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT * FROM api_keys 
+                        WHERE key_prefix = ?
+                    """, (prefix,))
+                    key_obj = cursor.fetchone()
+                    if not key_obj:
+                        # 已轮换的旧密钥
+                        cursor.execute("""
+                            SELECT * FROM api_keys
+                            WHERE previous_key_prefix = ?
+                        """, (prefix,))
+                        key_obj = cursor.fetchone()
+                    if not key_obj and '.' not in api_key:
+                        # 兼容尚未执行 migrate-key-hashes 的旧密钥
+                        key_obj = self._migrate_legacy_key(cursor, api_key)
+                        conn.commit()
+                self.key_cache.set(prefix, key_obj)
                 
-                # 获取密钥的每日限制
+            return self._verify_key_record(key_obj, prefix, secret)
+                
+        except Exception as e:
+            logger.error(f"验证API密钥时出错: {e}")
+            return None
+
+    def _verify_key_record(self, key_obj, prefix, secret):
+        """校验密钥哈希、状态和有效期，通过时返回记录"""
+        if not key_obj:
+            return None
+            
+        key_hash = key_obj['key_hash']
+        if key_obj['key_prefix'] != prefix:
+            # 轮换后的旧密钥只在宽限期内有效
+            grace_until = key_obj['previous_key_expires_at']
+            if not grace_until or datetime.now() > grace_until:
+                return None
+            key_hash = key_obj['previous_key_hash']
+            
+        if not hmac.compare_digest(key_hash or '', self.hash_secret(secret)):
+            return None
+            
+        if key_obj['status'] != 'active':
+            return None
+            
+        # 检查是否过期
+        if key_obj['expires_at'] and datetime.now() > key_obj['expires_at']:
+            return None
+            
+        return key_obj
+
+    def _migrate_legacy_key(self, cursor, api_key):
+        """把明文存储的旧密钥转换为前缀+哈希，返回更新后的记录"""
+        cursor.execute("SELECT id FROM api_keys WHERE key = ?", (api_key,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        prefix, secret = split_api_key(api_key)
+        cursor.execute("""
+            UPDATE api_keys SET key_prefix = ?, key_hash = ?, key = NULL
+            WHERE id = ?
+        """, (prefix, self.hash_secret(secret), row['id']))
+        cursor.execute("SELECT * FROM api_keys WHERE id = ?", (row['id'],))
+        return cursor.fetchone()
+
+    def migrate_plaintext_keys(self, batch_size=1000):
+        """把所有明文存储的旧密钥转换为前缀+哈希，返回迁移数量"""
+        migrated = 0
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            while True:
                 cursor.execute("""
-                    SELECT daily_limit FROM api_keys WHERE id = ?
-                """, (api_key_id,))
-                daily_limit = cursor.fetchone()[0]
+                    SELECT id, key FROM api_keys
+                    WHERE key_hash IS NULL AND key IS NOT NULL
+                    LIMIT ?
+                """, (batch_size,))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                params = []
+                for row in rows:
+                    prefix, secret = split_api_key(row['key'])
+                    params.append((prefix, self.hash_secret(secret), row['id']))
+                cursor.executemany("""
+                    UPDATE api_keys SET key_prefix = ?, key_hash = ?, key = NULL
+                    WHERE id = ?
+                """, params)
+                conn.commit()
+                migrated += len(rows)
                 
-                return today_usage < daily_limit
+        self.key_cache.clear()
+        logger.info(f"迁移明文API密钥完成: count={migrated}")
+        return migrated
+
+    def check_rate_limit(self, api_key_id, daily_limit=None):
+        """检查API密钥的使用频率限制"""
+        try:
+            if daily_limit is None:
+                with self.db_manager.get_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        SELECT daily_limit FROM api_keys WHERE id = ?
+                    """, (api_key_id,))
+                    daily_limit = cursor.fetchone()[0]
+                    
+            periods = self._current_periods()
+            day_start, day_ttl = periods['day']
+            counter_key = f"daily:{api_key_id}:{day_start.date().isoformat()}"
+            
+            if not self._is_seeded(counter_key, day_start):
+                self._seed_daily_usage(counter_key, api_key_id, day_start, day_ttl)
+                
+            # 先占用额度再比较，并发请求不会同时通过检查
+            today_usage = self.counters.incr(counter_key, 1, day_ttl)
+            if today_usage > daily_limit:
+                self.counters.incr(counter_key, -1, day_ttl)
+                return False
+            return True
                 
         except Exception as e:
             logger.error(f"检查使用频率限制时出错: {e}")
             return False
 
+    def check_budget(self, key_obj):
+        """检查token和费用预算（日/月），未设置预算时直接通过"""
+        limits = {
+            ('tokens', 'day'): key_obj['daily_token_limit'],
+            ('tokens', 'month'): key_obj['monthly_token_limit'],
+            ('cost', 'day'): key_obj['daily_cost_limit'],
+            ('cost', 'month'): key_obj['monthly_cost_limit'],
+        }
+        if not any(limits.values()):
+            return True
+        try:
+            usage = self.get_usage_totals(key_obj['id'])
+            return all(not limit or usage[metric][period] < limit
+                       for (metric, period), limit in limits.items())
+        except Exception as e:
+            logger.error(f"检查用量预算时出错: {e}")
+            return False
+
+    def get_usage_totals(self, api_key_id):
+        """返回内存中的今日/本月 token 和费用累计"""
+        periods = self._current_periods()
+        self._ensure_usage_seeded(api_key_id, periods)
+        return {
+            metric: {
+                period: self.counters.get(self._usage_counter_key(metric, api_key_id, period, start))
+                for period, (start, _) in periods.items()
+            }
+            for metric in ('tokens', 'cost')
+        }
+
+    def _record_usage(self, api_key_id, tokens, cost):
+        """调用记录时增量更新内存中的用量累计"""
+        periods = self._current_periods()
+        self._ensure_usage_seeded(api_key_id, periods)
+        self._increment_usage(api_key_id, tokens, cost, periods)
+
+    def _increment_usage(self, api_key_id, tokens, cost, periods):
+        for period, (start, ttl) in periods.items():
+            if tokens:
+                self.counters.incr(self._usage_counter_key('tokens', api_key_id, period, start), tokens, ttl)
+            if cost:
+                self.counters.incr(self._usage_counter_key('cost', api_key_id, period, start), float(cost), ttl)
+
+    @staticmethod
+    def _usage_counter_key(metric, api_key_id, period, start):
+        label = start.strftime('%Y-%m-%d' if period == 'day' else '%Y-%m')
+        return f"{metric}:{api_key_id}:{label}"
+
+    @staticmethod
+    def _current_periods():
+        """返回当前UTC日/月的起始时间和计数器TTL（到期后计数自动归零）"""
+        now = datetime.utcnow()
+        day_start = datetime(now.year, now.month, now.day)
+        month_start = datetime(now.year, now.month, 1)
+        next_month = datetime(now.year + now.month // 12, now.month % 12 + 1, 1)
+        return {
+            'day': (day_start, (day_start + timedelta(days=1) - now).total_seconds() + 60),
+            'month': (month_start, (next_month - now).total_seconds() + 60),
+        }
+
+    def _is_seeded(self, counter_key, day_start):
+        # 已初始化的计数器集合每天清空一次
+        if self._seeded_day != day_start:
+            self._seeded_counters.clear()
+            self._seeded_day = day_start
+        return counter_key in self._seeded_counters
+
+    def _ensure_usage_seeded(self, api_key_id, periods):
+        """用api_stats中已有的用量初始化token/费用累计（每个进程每天每个密钥只查询一次）"""
+        day_start, day_ttl = periods['day']
+        month_start, month_ttl = periods['month']
+        seed_key = f"usage:{api_key_id}"
+        if self._is_seeded(seed_key, day_start):
+            return
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(USAGE_SEED_SQL, (day_start.date(), day_start.date(), api_key_id, month_start.date()))
+            totals = cursor.fetchone()
+        self._apply_usage_seed(api_key_id, periods, totals)
+
+    def _apply_usage_seed(self, api_key_id, periods, totals):
+        day_start, day_ttl = periods['day']
+        month_start, month_ttl = periods['month']
+        day_tokens, day_cost, month_tokens, month_cost = totals
+        self.counters.setdefault(self._usage_counter_key('tokens', api_key_id, 'day', day_start), day_tokens, day_ttl)
+        self.counters.setdefault(self._usage_counter_key('cost', api_key_id, 'day', day_start), float(day_cost), day_ttl)
+        self.counters.setdefault(self._usage_counter_key('tokens', api_key_id, 'month', month_start), month_tokens, month_ttl)
+        self.counters.setdefault(self._usage_counter_key('cost', api_key_id, 'month', month_start), float(month_cost), month_ttl)
+        self._seeded_counters.add(f"usage:{api_key_id}")
+
+    @staticmethod
+    def _request_rate_limits(key_obj):
+        limits = []
+        if key_obj['requests_per_second']:
+            limits.append((key_obj['requests_per_second'], 1))
+        if key_obj['requests_per_minute']:
+            limits.append((key_obj['requests_per_minute'], 60))
+        return limits
+
+    def check_request_rate(self, key_obj):
+        """检查每秒/每分钟请求限制，未设置限制时返回None"""
+        limits = self._request_rate_limits(key_obj)
+        if not limits:
+            return None
+        return self.rate_limiter.check(key_obj['id'], limits)
+
+    def refund_request_rate(self, key_obj):
+        """退还 check_request_rate() 占用的额度"""
+        limits = self._request_rate_limits(key_obj)
+        if limits:
+            self.rate_limiter.refund(key_obj['id'], limits)
+
+    def _seed_daily_usage(self, counter_key, api_key_id, day_start, ttl):
+        """用今日已有日志初始化计数（每个进程每天每个密钥只查询一次）"""
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(DAILY_USAGE_SQL, (api_key_id, day_start, day_start + timedelta(days=1)))
+            today_usage = cursor.fetchone()[0]
+        self.counters.setdefault(counter_key, today_usage, ttl)
+        self._seeded_counters.add(counter_key)
+
     def update_key_status(self, key_id, new_status):
         """更新API密钥状态"""
         try:
@@ -107,6 +807,7 @@ class ApiKeyManager:
                 """, (new_status, datetime.now(), key_id))
                 conn.commit()
                 
+            self.invalidate_key(key_id)
             logger.info(f"更新API密钥状态: id={key_id}, new_status={new_status}")
             return True
             
@@ -122,6 +823,7 @@ class ApiKeyManager:
                 cursor.execute("DELETE FROM api_keys WHERE id = ?", (key_id,))
                 conn.commit()
                 
+            self.invalidate_key(key_id)
             logger.info(f"删除API密钥: id={key_id}")
             return True
             
@@ -129,67 +831,281 @@ class ApiKeyManager:
             logger.error(f"删除API密钥失败: {e}")
             return False
 
-    def get_key_list(self):
-        """获取API密钥列表"""
+    def invalidate_key(self, key_id):
+        """使缓存中的API密钥记录立即失效"""
+        self.invalidate_keys([key_id])
+
+    def invalidate_keys(self, key_ids):
+        """批量使缓存记录和速率状态失效"""
+        self.key_cache.invalidate_ids(key_ids)
+        self.rate_limiter.reset_many(key_ids)
+
+    def get_key_list(self, search=None, status=None, after=None, limit=50):
+        """按创建时间倒序分页获取API密钥列表
+
+        返回 (记录列表, 下一页游标)，没有更多数据时游标为None
+        """
         try:
+            conditions, params = [], []
+            if search:
+                search = like_escape(search)
+                conditions.append(SEARCH_SQL.format(alias='ak.'))
+                params.extend([f"%{search}%", f"{search}%"])
+            if status:
+                conditions.append("ak.status = ?")
+                params.append(status)
+            if after:
+                (created_at, key_id), _ = decode_cursor(after, (datetime, int))
+                created_at = self._sql_datetime(created_at)
+                conditions.append("(ak.created_at < ? OR (ak.created_at = ? AND ak.id < ?))")
+                params.extend([created_at, created_at, key_id])
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            
             with self.db_manager.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
+                cursor.execute(f"""
                     SELECT ak.*, u.username as created_by_name
                     FROM api_keys ak
                     LEFT JOIN users u ON ak.created_by = u.id
-                    ORDER BY ak.created_at DESC
-                """)
-                return cursor.fetchall()
+                    {where}
+                    ORDER BY ak.created_at DESC, ak.id DESC
+                    LIMIT ?
+                """, params + [limit + 1])
+                rows = cursor.fetchall()
                 
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_cursor([rows[-1]['created_at'], rows[-1]['id']])
+            return rows, next_cursor
+                
+        except ValueError:
+            raise
         except Exception as e:
             logger.error(f"获取API密钥列表失败: {e}")
-            return []
+            return [], None
 
+    def _sql_datetime(self, value):
+        # SQLite中时间以SQLAlchemy的文本格式保存，等值比较需要格式一致
+        if value is not None and getattr(self.db_manager, 'dialect', 'sqlite') == 'sqlite':
+            return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+        return value
+
+    @timed('log_api_call')
     def log_api_call(self, client_ip, provider, model, api_key_id, success, 
-                     error_message=None, response_time=0):
-        """记录API调用日志"""
+                     error_message=None, response_time=0,
+                     prompt_tokens=0, completion_tokens=0,
+                     time_to_first_token=None, response_code=None,
+                     request_path=None, request_method=None, cache_hit=False):
+        """记录API调用日志
+
+        request_path/request_method 默认取当前请求；在请求上下文之外（如流式响应
+        结束时）记录需要显式传入。cache_hit 为True表示由响应缓存返回，不计token
+        和费用，统计中单独计入 cache_hits。
+        """
+        try:
+            record = self._build_log_record(
+                client_ip, provider, model, api_key_id, success, error_message,
+                response_time, prompt_tokens, completion_tokens,
+                request_path or request.path, request_method or request.method,
+                time_to_first_token, response_code, cache_hit
+            )
+            tokens, cost = record['tokens'], record['cost']
+            if tokens or cost:
+                self._record_usage(api_key_id, tokens, cost)
+            if self.log_writer:
+                self.log_writer.submit(record)
+            else:
+                self.write_log_records([record])
+                
+        except Exception as e:
+            logger.error(f"记录API调用日志时出错: {e}")
+
+    def _build_log_record(self, client_ip, provider, model, api_key_id, success, error_message,
+                          response_time, prompt_tokens, completion_tokens, request_path, request_method,
+                          time_to_first_token=None, response_code=None, cache_hit=False):
+        if response_code is None:
+            response_code = 200 if success else 500
+        if cache_hit:
+            prompt_tokens = completion_tokens = 0
+        return {
+            'timestamp': datetime.utcnow(),
+            'client_ip': client_ip,
+            'provider': provider,
+            'model': model,
+            'api_key_id': api_key_id,
+            'success': success,
+            'error_message': error_message,
+            'response_time': response_time,
+            'time_to_first_token': time_to_first_token,
+            'request_path': request_path,
+            'request_method': request_method,
+            'response_code': response_code,
+            'tokens': prompt_tokens + completion_tokens,
+            'cost': self.price_table.cost(provider, model, prompt_tokens, completion_tokens) if not cache_hit else 0.0,
+            'cache_hit': cache_hit
+        }
+
+    @timed('write_log_records')
+    def write_log_records(self, records):
+        """批量写入API调用日志并合并更新统计信息（一次提交）"""
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO api_logs (
+                    timestamp, client_ip, provider, model, api_key_id, 
+                    success, error_message, response_time, time_to_first_token,
+                    request_path, request_method, response_code,
+                    tokens, cost, cache_hit
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(
+                r['timestamp'], r['client_ip'], r['provider'], r['model'], r['api_key_id'],
+                r['success'], r['error_message'], r['response_time'], r.get('time_to_first_token'),
+                r['request_path'], r['request_method'], r['response_code'],
+                r['tokens'], r['cost'], r.get('cache_hit', False)
+            ) for r in records])
+            
+            # 更新API统计信息
+            stats = _aggregate_calls(records, lambda r: (r['api_key_id'], r['provider'], r['timestamp'].date()))
+            cursor.executemany("""
+                INSERT INTO api_stats (
+                    api_key_id, provider, date, total_calls, 
+                    success_calls, average_latency, total_tokens, total_cost, cache_hits
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(api_key_id, provider, date) DO UPDATE SET
+                    total_calls = api_stats.total_calls + excluded.total_calls,
+                    success_calls = api_stats.success_calls + excluded.success_calls,
+                    total_tokens = api_stats.total_tokens + excluded.total_tokens,
+                    total_cost = api_stats.total_cost + excluded.total_cost,
+                    cache_hits = COALESCE(api_stats.cache_hits, 0) + excluded.cache_hits,
+                    average_latency = CASE
+                        WHEN api_stats.success_calls + excluded.success_calls > 0
+                        THEN (api_stats.average_latency * api_stats.success_calls + ?) / (api_stats.success_calls + excluded.success_calls)
+                        ELSE api_stats.average_latency
+                    END
+            """, [(
+                api_key_id, provider, date, total, success_calls,
+                latency / success_calls if success_calls else 0.0, tokens, cost, cache_hits, latency
+            ) for (api_key_id, provider, date), (total, success_calls, latency, tokens, cost, cache_hits)
+                in stats.items()])
+            
+            self._upsert_rollups(cursor, records)
+            conn.commit()
+
+    def _upsert_rollups(self, cursor, records):
+        """按小时（每个密钥）和按天（全局）增量更新汇总表"""
+        hourly = _aggregate_calls(records, lambda r: (
+            r['api_key_id'], r['provider'], r['timestamp'].replace(minute=0, second=0, microsecond=0)
+        ))
+        cursor.executemany("""
+            INSERT INTO api_stats_hourly (
+                api_key_id, provider, hour, total_calls, success_calls,
+                latency_sum, total_tokens, total_cost, cache_hits
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(api_key_id, provider, hour) DO UPDATE SET
+                total_calls = api_stats_hourly.total_calls + excluded.total_calls,
+                success_calls = api_stats_hourly.success_calls + excluded.success_calls,
+                latency_sum = api_stats_hourly.latency_sum + excluded.latency_sum,
+                total_tokens = api_stats_hourly.total_tokens + excluded.total_tokens,
+                total_cost = api_stats_hourly.total_cost + excluded.total_cost,
+                cache_hits = COALESCE(api_stats_hourly.cache_hits, 0) + excluded.cache_hits
+        """, [group + values for group, values in hourly.items()])
+        self._merge_latency_sketches(cursor, 'api_stats_hourly', ('api_key_id', 'provider', 'hour'),
+                                     _build_sketches(records, lambda r: (
+                                         r['api_key_id'], r['provider'],
+                                         r['timestamp'].replace(minute=0, second=0, microsecond=0)
+                                     )))
+        
+        daily = _aggregate_calls(records, lambda r: (r['timestamp'].date(), r['provider']))
+        cursor.executemany("""
+            INSERT INTO api_stats_daily (
+                date, provider, total_calls, success_calls,
+                latency_sum, total_tokens, total_cost, cache_hits
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(date, provider) DO UPDATE SET
+                total_calls = api_stats_daily.total_calls + excluded.total_calls,
+                success_calls = api_stats_daily.success_calls + excluded.success_calls,
+                latency_sum = api_stats_daily.latency_sum + excluded.latency_sum,
+                total_tokens = api_stats_daily.total_tokens + excluded.total_tokens,
+                total_cost = api_stats_daily.total_cost + excluded.total_cost,
+                cache_hits = COALESCE(api_stats_daily.cache_hits, 0) + excluded.cache_hits
+        """, [group + values for group, values in daily.items()])
+        self._merge_latency_sketches(cursor, 'api_stats_daily', ('date', 'provider'),
+                                     _build_sketches(records, lambda r: (r['timestamp'].date(), r['provider'])))
+
+    @staticmethod
+    def _merge_latency_sketches(cursor, table, columns, sketches):
+        """把本批次的延迟直方图合并进汇总表（每个分组一次读写）"""
+        where = ' AND '.join(f"{column} = ?" for column in columns)
+        for group, sketch in sketches.items():
+            cursor.execute(f"SELECT latency_sketch FROM {table} WHERE {where}", group)
+            row = cursor.fetchone()
+            if row and row[0]:
+                sketch.merge(LatencySketch.from_bytes(row[0]))
+            cursor.execute(f"UPDATE {table} SET latency_sketch = ? WHERE {where}",
+                           (sketch.to_bytes(),) + group)
+
+    def rebuild_rollups(self, since=None, batch_size=5000):
+        """根据api_logs重建汇总表（since为None时全量重建），返回处理的日志条数"""
+        since_hour = datetime(since.year, since.month, since.day) if since else datetime.min
+        processed = 0
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM api_stats_hourly WHERE hour >= ?", (since_hour,))
+            cursor.execute("DELETE FROM api_stats_daily WHERE date >= ?", (since_hour.date(),))
+            
+            # 按id分批读取，内存占用与日志总量无关
+            last_id = 0
+            while True:
+                cursor.execute("""
+                    SELECT id, timestamp, api_key_id, provider, success,
+                           response_time, tokens, cost, cache_hit
+                    FROM api_logs
+                    WHERE id > ? AND timestamp >= ?
+                    ORDER BY id
+                    LIMIT ?
+                """, (last_id, since_hour, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]['id']
+                processed += len(rows)
+                self._upsert_rollups(conn.cursor(), [{
+                    'timestamp': row['timestamp'],
+                    'api_key_id': row['api_key_id'],
+                    'provider': row['provider'],
+                    'success': row['success'],
+                    'response_time': row['response_time'] or 0.0,
+                    'tokens': row['tokens'] or 0,
+                    'cost': row['cost'] or 0.0,
+                    'cache_hit': bool(row['cache_hit'])
+                } for row in rows])
+            conn.commit()
+            
+        logger.info(f"重建统计汇总表完成: since={since}, logs={processed}")
+        return processed
+
+    def get_latency_percentiles(self, api_key_id=None, provider=None, days=7):
+        """合并汇总表中的延迟直方图，返回p50/p95/p99（秒）"""
         try:
             with self.db_manager.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO api_logs (
-                        client_ip, provider, model, api_key_id, 
-                        success, error_message, response_time,
-                        request_path, request_method, response_code
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    client_ip, provider, model, api_key_id,
-                    success, error_message, response_time,
-                    request.path, request.method,
-                    200 if success else 500
-                ))
-                conn.commit()
-                
-                # 更新API统计信息
-                if success:
-                    cursor.execute("""
-                        INSERT INTO api_stats (
-                            api_key_id, provider, date, total_calls, 
-                            success_calls, average_latency
-                        ) VALUES (?, ?, DATE('now'), 1, 1, ?)
-                        ON CONFLICT(api_key_id, provider, date) DO UPDATE SET
-                            total_calls = total_calls + 1,
-                            success_calls = success_calls + 1,
-                            average_latency = (average_latency * success_calls + ?) / (success_calls + 1)
-                    """, (api_key_id, provider, response_time, response_time))
+                since = datetime.utcnow().date() - timedelta(days=days)
+                if api_key_id:
+                    query = "SELECT latency_sketch FROM api_stats_hourly WHERE hour >= ? AND api_key_id = ?"
+                    params = [datetime(since.year, since.month, since.day), api_key_id]
                 else:
-                    cursor.execute("""
-                        INSERT INTO api_stats (
-                            api_key_id, provider, date, total_calls
-                        ) VALUES (?, ?, DATE('now'), 1)
-                        ON CONFLICT(api_key_id, provider, date) DO UPDATE SET
-                            total_calls = total_calls + 1
-                    """, (api_key_id, provider))
-                conn.commit()
+                    query = "SELECT latency_sketch FROM api_stats_daily WHERE date >= ?"
+                    params = [since]
+                if provider and provider != 'all':
+                    query += " AND provider = ?"
+                    params.append(provider)
+                cursor.execute(query, params)
+                return LatencySketch.merge_all(row[0] for row in cursor.fetchall()).percentiles()
                 
         except Exception as e:
-            logger.error(f"记录API调用日志时出错: {e}")
+            logger.error(f"获取延迟分位数时出错: {e}")
+            return LatencySketch().percentiles()
 
     def get_api_stats(self, api_key_id=None, provider=None, days=7):
         """获取API使用统计信息"""
@@ -197,26 +1113,41 @@ class ApiKeyManager:
             with self.db_manager.get_connection() as conn:
                 cursor = conn.cursor()
                 
-                query = """
-                    SELECT 
-                        date,
-                        provider,
-                        SUM(total_calls) as total_calls,
-                        SUM(success_calls) as success_calls,
-                        AVG(average_latency) as avg_latency
-                    FROM api_stats
-                    WHERE date >= DATE('now', ?)
-                """
-                params = [f'-{days} days']
-                
+                since = datetime.utcnow().date() - timedelta(days=days)
                 if api_key_id:
-                    query += " AND api_key_id = ?"
-                    params.append(api_key_id)
-                if provider and provider != 'all':
-                    query += " AND provider = ?"
-                    params.append(provider)
-                    
-                query += " GROUP BY date, provider ORDER BY date DESC, provider"
+                    # 每个密钥每天每个提供商只有一行，按调用数加权平均延迟
+                    query = """
+                        SELECT 
+                            date,
+                            provider,
+                            SUM(total_calls) as total_calls,
+                            SUM(success_calls) as success_calls,
+                            COALESCE(SUM(average_latency * success_calls) / NULLIF(SUM(success_calls), 0), 0) as avg_latency
+                        FROM api_stats
+                        WHERE date >= ? AND api_key_id = ?
+                    """
+                    params = [since, api_key_id]
+                    if provider and provider != 'all':
+                        query += " AND provider = ?"
+                        params.append(provider)
+                    query += " GROUP BY date, provider ORDER BY date DESC, provider"
+                else:
+                    # 全局统计直接读取按天汇总表
+                    query = """
+                        SELECT 
+                            date,
+                            provider,
+                            total_calls,
+                            success_calls,
+                            COALESCE(latency_sum / NULLIF(success_calls, 0), 0) as avg_latency
+                        FROM api_stats_daily
+                        WHERE date >= ?
+                    """
+                    params = [since]
+                    if provider and provider != 'all':
+                        query += " AND provider = ?"
+                        params.append(provider)
+                    query += " ORDER BY date DESC, provider"
                 
                 cursor.execute(query, params)
                 return cursor.fetchall()
@@ -225,6 +1156,35 @@ class ApiKeyManager:
             logger.error(f"获取API统计信息时出错: {e}")
             return []
 
+def _build_sketches(records, group_key):
+    """按分组构建成功调用的延迟直方图（不含缓存命中）"""
+    sketches = {}
+    for r in records:
+        if r['success'] and not r.get('cache_hit'):
+            group = group_key(r)
+            if group not in sketches:
+                sketches[group] = LatencySketch()
+            sketches[group].add(r['response_time'])
+    return sketches
+
+def _aggregate_calls(records, group_key):
+    """按分组在内存中累计 (总调用, 成功调用, 成功调用延迟和, token数, 费用, 缓存命中)
+
+    缓存命中没有调用上游，只计入缓存命中数。
+    """
+    groups = {}
+    for r in records:
+        group = group_key(r)
+        total, success_calls, latency, tokens, cost, cache_hits = groups.get(group, (0, 0, 0.0, 0, 0.0, 0))
+        if r.get('cache_hit'):
+            groups[group] = (total, success_calls, latency, tokens, cost, cache_hits + 1)
+            continue
+        if r['success']:
+            success_calls += 1
+            latency += r['response_time']
+        groups[group] = (total + 1, success_calls, latency, tokens + r['tokens'], cost + r['cost'], cache_hits)
+    return groups
+
 def get_api_key_from_request():
     """从请求中获取API密钥"""
     # 尝试从请求头获取
@@ -240,27 +1200,66 @@ def get_api_key_from_request():
         api_key = request.json.get('api_key')
     return api_key
 
+def rate_limit_headers(result):
+    """生成速率限制相关的响应头"""
+    headers = {
+        'X-RateLimit-Limit': str(result.limit),
+        'X-RateLimit-Remaining': str(result.remaining),
+        'X-RateLimit-Reset': str(math.ceil(result.reset_after))
+    }
+    if not result.allowed:
+        headers['Retry-After'] = str(max(1, math.ceil(result.retry_after)))
+    return headers
+
 def require_api_key(f):
-    """验证API密钥的装饰器"""
+    """验证API密钥的装饰器（各阶段耗时记入 metrics）"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        with stage('total'):
+            return _call_with_api_key(f, args, kwargs)
+    return decorated_function
+
+def _call_with_api_key(f, args, kwargs):
+    with stage('get_api_key_from_request'):
         api_key = get_api_key_from_request()
         
-        if not api_key:
-            return jsonify({'error': 'API密钥缺失'}), 401
-            
-        api_key_manager = current_app.api_key_manager
+    if not api_key:
+        return jsonify({'error': 'API密钥缺失'}), 401
+        
+    api_key_manager = current_app.api_key_manager
+    with stage('validate_key'):
         key_obj = api_key_manager.validate_key(api_key)
-            
-        if not key_obj:
-            return jsonify({'error': '无效的API密钥'}), 401
-            
-        # 检查使用限制
-        if not api_key_manager.check_rate_limit(key_obj['id']):
-            return jsonify({'error': 'API密钥已达到使用限制或已过期'}), 429
-            
-        # 将API密钥对象添加到g对象中，以便在路由处理函数中使用
-        g.api_key = key_obj
         
-        return f(*args, **kwargs)
-    return decorated_function
\ No newline at end of file
+    if not key_obj:
+        return jsonify({'error': '无效的API密钥'}), 401
+        
+    # 检查token/费用预算（只读，先于占用额度的检查，被拒绝的请求不占用速率额度）
+    with stage('check_budget'):
+        within_budget = api_key_manager.check_budget(key_obj)
+    if not within_budget:
+        return jsonify({'error': 'API密钥已超出token或费用预算'}), 429
+        
+    # 检查短周期请求频率
+    with stage('check_request_rate'):
+        rate = api_key_manager.check_request_rate(key_obj)
+    if rate and not rate.allowed:
+        return jsonify({'error': '请求过于频繁，请稍后重试'}), 429, rate_limit_headers(rate)
+        
+    # 检查使用限制，拒绝时退还上面占用的短周期额度
+    with stage('check_rate_limit'):
+        allowed = api_key_manager.check_rate_limit(key_obj['id'], key_obj['daily_limit'])
+    if not allowed:
+        if rate:
+            api_key_manager.refund_request_rate(key_obj)
+        return jsonify({'error': 'API密钥已达到使用限制或已过期'}), 429
+        
+    # 将API密钥对象添加到g对象中，以便在路由处理函数中使用
+    g.api_key = key_obj
+    
+    with stage('handler'):
+        response = f(*args, **kwargs)
+    if not rate:
+        return response
+    response = make_response(response)
+    response.headers.update(rate_limit_headers(rate))
+    return response
\ No newline at end of file
@@ -0,0 +1,358 @@
+from datetime import timedelta
+from functools import wraps
+import asyncio
+import re
+import sqlite3
+import logging
+
+from api_keys import (DAILY_USAGE_SQL, USAGE_SEED_SQL, rate_limit_headers,
+                      split_api_key)
+from counters import MemoryCounterBackend
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+class AsyncDatabase:
+    """异步数据库连接池（SQLite使用aiosqlite，PostgreSQL使用asyncpg）
+
+    SQL沿用同步层的 ? 占位符，PostgreSQL下转换为 $1, $2 ...；
+    返回的行支持 row['列名'] 和按位置访问，与同步层一致。
+    """
+
+    def __init__(self, database_url, pool_size=10):
+        self.database_url = database_url
+        self.pool_size = pool_size
+        scheme = database_url.split(':', 1)[0].split('+', 1)[0]
+        self.dialect = 'postgresql' if scheme in ('postgresql', 'postgres') else 'sqlite'
+        self._pool = None
+        self._sqlite_pool = None
+        self._sqlite_created = 0
+        self._sql_cache = {}
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self._lock:
+            if self.dialect == 'postgresql' and self._pool is None:
+                try:
+                    import asyncpg
+                except ImportError:
+                    raise ImportError("异步PostgreSQL访问需要安装 asyncpg: pip install asyncpg")
+                url = re.sub(r'^postgres(ql)?(\+\w+)?://', 'postgresql://', self.database_url)
+                self._pool = await asyncpg.create_pool(url, min_size=1, max_size=self.pool_size)
+            elif self.dialect == 'sqlite' and self._sqlite_pool is None:
+                self._sqlite_pool = asyncio.LifoQueue(maxsize=self.pool_size)
+        return self
+
+    async def close(self):
+        """关闭连接池"""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        if self._sqlite_pool is not None:
+            while not self._sqlite_pool.empty():
+                conn = self._sqlite_pool.get_nowait()
+                await conn.close()
+            self._sqlite_pool = None
+            self._sqlite_created = 0
+
+    async def fetchone(self, sql, params=()):
+        """执行查询并返回第一行，没有结果时返回None"""
+        if self._pool is None and self._sqlite_pool is None:
+            await self.connect()
+        if self.dialect == 'postgresql':
+            return await self._pool.fetchrow(self._pg_sql(sql), *params)
+        conn = await self._acquire_sqlite()
+        try:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+        finally:
+            self._sqlite_pool.put_nowait(conn)
+
+    async def fetchval(self, sql, params=()):
+        """执行查询并返回第一行第一列"""
+        row = await self.fetchone(sql, params)
+        return row[0] if row is not None else None
+
+    def _pg_sql(self, sql):
+        converted = self._sql_cache.get(sql)
+        if converted is None:
+            counter = iter(range(1, sql.count('?') + 1))
+            converted = self._sql_cache[sql] = re.sub(r'\?', lambda m: f"${next(counter)}", sql)
+        return converted
+
+    async def _acquire_sqlite(self):
+        try:
+            return self._sqlite_pool.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        if self._sqlite_created >= self.pool_size:
+            return await self._sqlite_pool.get()
+        self._sqlite_created += 1
+        try:
+            import aiosqlite
+        except ImportError:
+            self._sqlite_created -= 1
+            raise ImportError("异步SQLite访问需要安装 aiosqlite: pip install aiosqlite")
+        try:
+            conn = await aiosqlite.connect(
+                self.database_url.split('sqlite:///', 1)[-1],
+                detect_types=sqlite3.PARSE_DECLTYPES
+            )
+            conn.row_factory = sqlite3.Row
+            await conn.execute('PRAGMA journal_mode=WAL')
+            return conn
+        except Exception:
+            self._sqlite_created -= 1
+            raise
+
+class AsyncApiKeyManager:
+    """ApiKeyManager 的异步请求路径（验证、限额检查、调用记录）
+
+    与同步管理器共用密钥缓存、限流器、用量计数器、价格表和后台日志写入器，
+    管理后台的禁用/轮换等操作对两条路径同时生效。只有缓存未命中和计数器
+    初始化时才访问数据库，这些查询通过异步驱动执行，不占用工作线程。
+    """
+
+    def __init__(self, manager, database):
+        self.manager = manager
+        self.database = database
+        # Redis等网络计数器后端是同步客户端，放到线程中调用
+        self._offload_counters = not isinstance(manager.counters, MemoryCounterBackend)
+
+    def init_app(self, app):
+        """注册到Quart应用（app.async_api_key_manager），停止服务时关闭连接池
+
+        Starlette应用设置 app.state.api_key_manager，并在lifespan结束时调用 close()。
+        """
+        app.async_api_key_manager = self
+        app.after_serving(self.close)
+
+    async def close(self):
+        """关闭异步连接池（aiosqlite的连接线程不会随进程退出自动结束）"""
+        await self.database.close()
+
+    async def _counters(self, fn, *args):
+        if self._offload_counters:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def validate_key(self, api_key):
+        """验证API密钥并返回密钥对象"""
+        manager = self.manager
+        try:
+            prefix, secret = split_api_key(api_key)
+            hit, key_obj = manager.key_cache.get(prefix)
+            if not hit:
+                if '.' not in api_key:
+                    # 旧格式密钥需要在事务中迁移，交给同步实现
+                    return await asyncio.to_thread(manager.validate_key, api_key)
+                key_obj = await self.database.fetchone(
+                    "SELECT * FROM api_keys WHERE key_prefix = ?", (prefix,)
+                )
+                if not key_obj:
+                    # 已轮换的旧密钥
+                    key_obj = await self.database.fetchone(
+                        "SELECT * FROM api_keys WHERE previous_key_prefix = ?", (prefix,)
+                    )
+                manager.key_cache.set(prefix, key_obj)
+
+            return manager._verify_key_record(key_obj, prefix, secret)
+
+        except Exception as e:
+            logger.error(f"异步验证API密钥时出错: {e}")
+            return None
+
+    def check_request_rate(self, key_obj):
+        """检查每秒/每分钟请求限制（纯内存操作）"""
+        return self.manager.check_request_rate(key_obj)
+
+    async def check_rate_limit(self, api_key_id, daily_limit=None):
+        """检查API密钥的使用频率限制"""
+        manager = self.manager
+        try:
+            if daily_limit is None:
+                daily_limit = await self.database.fetchval(
+                    "SELECT daily_limit FROM api_keys WHERE id = ?", (api_key_id,)
+                )
+
+            periods = manager._current_periods()
+            day_start, day_ttl = periods['day']
+            counter_key = f"daily:{api_key_id}:{day_start.date().isoformat()}"
+
+            if not manager._is_seeded(counter_key, day_start):
+                today_usage = await self.database.fetchval(
+                    DAILY_USAGE_SQL, (api_key_id, day_start, day_start + timedelta(days=1))
+                )
+                await self._counters(manager.counters.setdefault, counter_key, today_usage, day_ttl)
+                manager._seeded_counters.add(counter_key)
+
+            # 先占用额度再比较，并发请求不会同时通过检查
+            today_usage = await self._counters(manager.counters.incr, counter_key, 1, day_ttl)
+            if today_usage > daily_limit:
+                await self._counters(manager.counters.incr, counter_key, -1, day_ttl)
+                return False
+            return True
+
+        except Exception as e:
+            logger.error(f"异步检查使用频率限制时出错: {e}")
+            return False
+
+    async def check_budget(self, key_obj):
+        """检查token和费用预算（日/月），未设置预算时直接通过"""
+        manager = self.manager
+        limits = {
+            ('tokens', 'day'): key_obj['daily_token_limit'],
+            ('tokens', 'month'): key_obj['monthly_token_limit'],
+            ('cost', 'day'): key_obj['daily_cost_limit'],
+            ('cost', 'month'): key_obj['monthly_cost_limit'],
+        }
+        if not any(limits.values()):
+            return True
+        try:
+            periods = await self._ensure_usage_seeded(key_obj['id'])
+            for (metric, period), limit in limits.items():
+                if not limit:
+                    continue
+                start = periods[period][0]
+                key = manager._usage_counter_key(metric, key_obj['id'], period, start)
+                if await self._counters(manager.counters.get, key) >= limit:
+                    return False
+            return True
+        except Exception as e:
+            logger.error(f"异步检查用量预算时出错: {e}")
+            return False
+
+    async def _ensure_usage_seeded(self, api_key_id):
+        manager = self.manager
+        periods = manager._current_periods()
+        day_start = periods['day'][0]
+        month_start = periods['month'][0]
+        if not manager._is_seeded(f"usage:{api_key_id}", day_start):
+            totals = await self.database.fetchone(
+                USAGE_SEED_SQL, (day_start.date(), day_start.date(), api_key_id, month_start.date())
+            )
+            await self._counters(manager._apply_usage_seed, api_key_id, periods, tuple(totals))
+        return periods
+
+    async def log_api_call(self, client_ip, provider, model, api_key_id, success,
+                           request_path, request_method, error_message=None, response_time=0,
+                           prompt_tokens=0, completion_tokens=0,
+                           time_to_first_token=None, response_code=None, cache_hit=False):
+        """记录API调用日志
+
+        日志写入（含统计汇总和延迟分布合并）由同步管理器的后台批量写入器完成；
+        未启用批量写入时在线程中同步写入，不阻塞事件循环。
+        """
+        manager = self.manager
+        try:
+            record = manager._build_log_record(
+                client_ip, provider, model, api_key_id, success, error_message,
+                response_time, prompt_tokens, completion_tokens, request_path, request_method,
+                time_to_first_token, response_code, cache_hit
+            )
+            tokens, cost = record['tokens'], record['cost']
+            if tokens or cost:
+                periods = await self._ensure_usage_seeded(api_key_id)
+                await self._counters(manager._increment_usage, api_key_id, tokens, cost, periods)
+            if manager.log_writer:
+                manager.log_writer.submit(record)
+            else:
+                await asyncio.to_thread(manager.write_log_records, [record])
+
+        except Exception as e:
+            logger.error(f"异步记录API调用日志时出错: {e}")
+
+    async def authorize(self, api_key):
+        """执行完整的密钥检查
+
+        通过时返回 (密钥对象, 速率限制结果)，拒绝时返回 (None, (状态码, 错误信息, 响应头))。
+        """
+        if not api_key:
+            return None, (401, 'API密钥缺失', {})
+
+        with stage('validate_key'):
+            key_obj = await self.validate_key(api_key)
+        if not key_obj:
+            return None, (401, '无效的API密钥', {})
+
+        # 检查token/费用预算（只读，先于占用额度的检查，被拒绝的请求不占用速率额度）
+        with stage('check_budget'):
+            within_budget = await self.check_budget(key_obj)
+        if not within_budget:
+            return None, (429, 'API密钥已超出token或费用预算', {})
+
+        # 检查短周期请求频率
+        with stage('check_request_rate'):
+            rate = self.check_request_rate(key_obj)
+        if rate and not rate.allowed:
+            return None, (429, '请求过于频繁，请稍后重试', rate_limit_headers(rate))
+
+        # 检查使用限制，拒绝时退还上面占用的短周期额度
+        with stage('check_rate_limit'):
+            allowed = await self.check_rate_limit(key_obj['id'], key_obj['daily_limit'])
+        if not allowed:
+            if rate:
+                self.manager.refund_request_rate(key_obj)
+            return None, (429, 'API密钥已达到使用限制或已过期', {})
+
+        return key_obj, rate
+
+def _api_key_from_mapping(headers, args, form=None, json_body=None):
+    api_key = headers.get('X-API-KEY') or args.get('api_key')
+    if not api_key and form:
+        api_key = form.get('api_key')
+    if not api_key and isinstance(json_body, dict):
+        api_key = json_body.get('api_key')
+    return api_key
+
+def quart_require_api_key(f):
+    """Quart版验证API密钥的装饰器，使用 app.async_api_key_manager，密钥对象存入 g.api_key"""
+    from quart import current_app, g, jsonify, make_response, request
+
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        with stage('total'):
+            form = await request.form
+            json_body = await request.get_json(silent=True) if request.is_json else None
+            api_key = _api_key_from_mapping(request.headers, request.args, form, json_body)
+            key_obj, result = await current_app.async_api_key_manager.authorize(api_key)
+            if key_obj is None:
+                status, error, headers = result
+                return jsonify({'error': error}), status, headers
+
+            g.api_key = key_obj
+            with stage('handler'):
+                response = await f(*args, **kwargs)
+            if not result:
+                return response
+            response = await make_response(response)
+            response.headers.update(rate_limit_headers(result))
+            return response
+    return decorated_function
+
+def starlette_require_api_key(f):
+    """Starlette版验证API密钥的装饰器，使用 app.state.api_key_manager，密钥对象存入 request.state.api_key"""
+    from starlette.responses import JSONResponse
+
+    @wraps(f)
+    async def decorated_function(request, *args, **kwargs):
+        with stage('total'):
+            json_body = None
+            if request.headers.get('content-type', '').startswith('application/json'):
+                try:
+                    json_body = await request.json()
+                except ValueError:
+                    json_body = None
+            api_key = _api_key_from_mapping(request.headers, request.query_params, json_body=json_body)
+            key_obj, result = await request.app.state.api_key_manager.authorize(api_key)
+            if key_obj is None:
+                status, error, headers = result
+                return JSONResponse({'error': error}, status_code=status, headers=headers)
+
+            request.state.api_key = key_obj
+            with stage('handler'):
+                response = await f(request, *args, **kwargs)
+            if result:
+                response.headers.update(rate_limit_headers(result))
+            return response
+    return decorated_function
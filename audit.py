@@ -0,0 +1,157 @@
+from datetime import datetime
+import json
+import os
+import threading
+import time
+import logging
+
+from log_writer import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+INSERT_SQL = "INSERT INTO system_logs (timestamp, level, message, source) VALUES (?, ?, ?, ?)"
+
+class AuditSink:
+    """系统审计日志（system_logs）的非阻塞写入器
+
+    - 请求线程只把记录放入队列，后台线程使用独立的数据库连接批量写入，
+      审计写入慢或失败不影响管理操作本身的事务
+    - 数据库不可用或队列已满时，记录追加到本地 spool 文件（JSONL），
+      数据库恢复后（下一批记录写入成功后）在后台线程中回放
+    """
+
+    def __init__(self, db_manager, spool_path=None, batch_size=100, flush_interval=1.0,
+                 max_queue_size=10000, retry_interval=30.0):
+        self.db_manager = db_manager
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.writer = BatchWriter(
+            self._flush,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            max_queue_size=max_queue_size,
+            overflow='drop',
+            name='audit-sink'
+        )
+        self._spool_lock = threading.Lock()
+        self._retry_at = 0.0
+
+    def init_app(self, app):
+        """注册到 app.extensions，SystemLog.log() 会改为通过本写入器异步写入"""
+        app.extensions['audit_sink'] = self.start()
+
+    def start(self):
+        self.writer.start()
+        return self
+
+    def close(self):
+        """写完队列中剩余的记录"""
+        self.writer.close()
+
+    def log(self, message, level='INFO', source=None):
+        """提交一条审计日志，立即返回"""
+        record = {
+            'timestamp': datetime.utcnow(),
+            'level': level,
+            'message': message,
+            'source': source
+        }
+        if not self.writer.submit(record):
+            self._spool([record])
+
+    def _flush(self, records):
+        if time.monotonic() < self._retry_at:
+            self._spool(records)
+            return
+        try:
+            self._insert(records)
+        except Exception as e:
+            logger.error(f"写入审计日志失败，{self.retry_interval}秒内改写本地文件: {e}")
+            self._retry_at = time.monotonic() + self.retry_interval
+            self._spool(records)
+            return
+        if self._has_spool():
+            try:
+                self.replay_spool()
+            except Exception as e:
+                logger.error(f"回放审计日志spool文件失败，{self.retry_interval}秒后重试: {e}")
+                self._retry_at = time.monotonic() + self.retry_interval
+
+    def _has_spool(self):
+        return bool(self.spool_path) and (
+            os.path.exists(self.spool_path) or os.path.exists(self.spool_path + '.replay')
+        )
+
+    def _insert(self, records):
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(INSERT_SQL, [(r['timestamp'], r['level'], r['message'], r['source']) for r in records])
+            conn.commit()
+
+    def _spool(self, records):
+        if not self.spool_path:
+            logger.error(f"未配置审计日志spool文件，丢弃 {len(records)} 条审计日志")
+            return
+        lines = ''.join(
+            json.dumps(dict(r, timestamp=r['timestamp'].isoformat()), ensure_ascii=False) + '\n'
+            for r in records
+        )
+        try:
+            with self._spool_lock:
+                os.makedirs(os.path.dirname(os.path.abspath(self.spool_path)), exist_ok=True)
+                with open(self.spool_path, 'a', encoding='utf-8') as f:
+                    f.write(lines)
+        except OSError as e:
+            logger.error(f"写入审计日志spool文件失败，丢弃 {len(records)} 条审计日志: {e}")
+
+    def replay_spool(self):
+        """把spool文件中的记录写入数据库，返回回放的记录数
+
+        先把spool文件改名再回放，回放期间新的记录写入新文件；回放在一个事务中
+        完成，失败时保留改名后的文件，下次重试。无法解析的行移到 .corrupt 文件，
+        不影响其余记录的回放。
+        """
+        if not self.spool_path:
+            return 0
+        replay_path = self.spool_path + '.replay'
+        with self._spool_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spool_path):
+                    return 0
+                os.replace(self.spool_path, replay_path)
+
+        replayed = 0
+        corrupt = []
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            with open(replay_path, encoding='utf-8') as f:
+                batch = []
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        r = json.loads(line)
+                        batch.append((datetime.fromisoformat(r['timestamp']), r['level'], r['message'], r['source']))
+                    except (ValueError, TypeError, KeyError) as e:
+                        logger.error(f"审计日志spool文件中有无法解析的记录: {e}")
+                        corrupt.append(line if line.endswith('\n') else line + '\n')
+                        continue
+                    if len(batch) >= self.batch_size:
+                        cursor.executemany(INSERT_SQL, batch)
+                        replayed += len(batch)
+                        batch = []
+                if batch:
+                    cursor.executemany(INSERT_SQL, batch)
+                    replayed += len(batch)
+            conn.commit()
+        if corrupt:
+            try:
+                with open(self.spool_path + '.corrupt', 'a', encoding='utf-8') as f:
+                    f.writelines(corrupt)
+                logger.error(f"已把 {len(corrupt)} 条无法解析的审计日志移到 {self.spool_path}.corrupt")
+            except OSError as e:
+                logger.error(f"写入审计日志隔离文件失败，丢弃 {len(corrupt)} 条无法解析的记录: {e}")
+        os.remove(replay_path)
+        logger.info(f"已回放审计日志spool文件: {replayed} 条")
+        return replayed
@@ -0,0 +1,145 @@
+import json
+import threading
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = 'akm:key-invalidation'
+
+class LocalInvalidationBus:
+    """进程内的失效消息总线，用于测试和单机多实例
+
+    多个 KeyInvalidationSync 共用同一个实例即相当于多个节点共用一个Redis频道。
+    """
+
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def publish(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback(message)
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def close(self):
+        with self._lock:
+            self._subscribers.clear()
+
+class RedisInvalidationBus:
+    """基于Redis pub/sub的失效消息总线
+
+    订阅在后台线程中进行，连接断开后按 reconnect_interval 重连。断开期间的消息
+    会丢失，因此重连成功后向订阅者投递一条 clear 消息，清空本地缓存。
+    """
+
+    def __init__(self, client, channel=DEFAULT_CHANNEL, reconnect_interval=1.0):
+        self.client = client
+        self.channel = channel
+        self.reconnect_interval = reconnect_interval
+        self._subscribers = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._pubsub = None
+
+    @classmethod
+    def from_url(cls, url, channel=DEFAULT_CHANNEL):
+        import redis
+        return cls(redis.Redis.from_url(url), channel=channel)
+
+    def publish(self, message):
+        self.client.publish(self.channel, json.dumps(message))
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='key-invalidation-listener', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        pubsub = self._pubsub
+        if pubsub is not None:
+            try:
+                pubsub.close()
+            except Exception:
+                pass
+
+    def _deliver(self, message):
+        for callback in list(self._subscribers):
+            try:
+                callback(message)
+            except Exception as e:
+                logger.error(f"处理密钥失效消息失败: {e}")
+
+    def _run(self):
+        connected_before = False
+        while not self._stop.is_set():
+            try:
+                self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                self._pubsub.subscribe(self.channel)
+                if connected_before:
+                    logger.warning("密钥失效订阅已重连，清空本地密钥缓存")
+                    self._deliver({'clear': []})
+                connected_before = True
+                while not self._stop.is_set():
+                    item = self._pubsub.get_message(timeout=1.0)
+                    if item and item['type'] == 'message':
+                        self._deliver(json.loads(item['data']))
+            except Exception as e:
+                if self._stop.is_set():
+                    break
+                logger.error(f"密钥失效订阅中断，{self.reconnect_interval}秒后重连: {e}")
+                self._stop.wait(self.reconnect_interval)
+            finally:
+                try:
+                    self._pubsub.close()
+                except Exception:
+                    pass
+
+class KeyInvalidationSync:
+    """在节点间同步API密钥缓存失效
+
+    本节点的 KeyCache 失效（禁用、删除、轮换、新建密钥时清除否定缓存等）通过
+    消息总线广播，其他节点收到后失效同一批缓存并重置对应密钥的请求速率状态，
+    管理操作在所有节点上立即生效，不必等待缓存TTL过期。
+    """
+
+    def __init__(self, api_key_manager, bus, node_id=None):
+        self.api_key_manager = api_key_manager
+        self.bus = bus
+        self.node_id = node_id or uuid.uuid4().hex
+
+    def start(self):
+        self.api_key_manager.key_cache.on_invalidate = self._publish
+        self.bus.subscribe(self._receive)
+        return self
+
+    def close(self):
+        self.api_key_manager.key_cache.on_invalidate = None
+        self.bus.close()
+
+    def _publish(self, kind, values):
+        self.bus.publish({'node': self.node_id, kind: list(values)})
+
+    def _receive(self, message):
+        if message.get('node') == self.node_id:
+            return
+        manager = self.api_key_manager
+        if 'prefixes' in message:
+            manager.key_cache.invalidate_many(message['prefixes'], propagate=False)
+        if 'ids' in message:
+            manager.key_cache.invalidate_ids(message['ids'], propagate=False)
+            manager.rate_limiter.reset_many(message['ids'])
+        if 'clear' in message:
+            manager.key_cache.clear(propagate=False)
+
+def init_cluster(api_key_manager, redis_url, channel=DEFAULT_CHANNEL):
+    """使用Redis pub/sub同步密钥缓存失效，返回 KeyInvalidationSync"""
+    return KeyInvalidationSync(api_key_manager, RedisInvalidationBus.from_url(redis_url, channel)).start()
@@ -0,0 +1,264 @@
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class MemoryCounterBackend:
+    """进程内计数器后端（适用于单worker部署）"""
+
+    def __init__(self):
+        self._values = {}  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and now >= entry[1]:
+            del self._values[key]
+            return None
+        return entry
+
+    def get(self, key):
+        """获取计数值，不存在时返回0"""
+        with self._lock:
+            entry = self._live(key, time.monotonic())
+            return entry[0] if entry else 0
+
+    def incr(self, key, amount=1, ttl=None):
+        """原子地增加计数并返回新值"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None:
+                entry = (0, now + ttl if ttl else None)
+            value = entry[0] + amount
+            self._values[key] = (value, entry[1])
+            return value
+
+    def setdefault(self, key, value, ttl=None):
+        """键不存在时写入初始值，返回当前值"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None:
+                entry = (value, now + ttl if ttl else None)
+                self._values[key] = entry
+            return entry[0]
+
+    def delete(self, key):
+        """删除计数"""
+        with self._lock:
+            self._values.pop(key, None)
+
+class RedisCounterBackend:
+    """基于Redis协议的计数器后端（多worker/多节点共享）
+
+    client 可以是 redis.Redis 实例，测试时可传入 fakeredis.FakeRedis()。
+    """
+
+    def __init__(self, client, prefix='akm:'):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, prefix='akm:'):
+        import redis
+        return cls(redis.Redis.from_url(url), prefix=prefix)
+
+    @staticmethod
+    def _parse(value):
+        if value is None:
+            return 0
+        if isinstance(value, bytes):
+            value = value.decode()
+        value = float(value)
+        return int(value) if value.is_integer() else value
+
+    def get(self, key):
+        """获取计数值，不存在时返回0"""
+        return self._parse(self.client.get(self.prefix + key))
+
+    def incr(self, key, amount=1, ttl=None):
+        """原子地增加计数并返回新值"""
+        name = self.prefix + key
+        pipe = self.client.pipeline()
+        if isinstance(amount, float):
+            pipe.incrbyfloat(name, amount)
+        else:
+            pipe.incrby(name, amount)
+        if ttl:
+            pipe.expire(name, int(ttl))
+        return self._parse(pipe.execute()[0])
+
+    def setdefault(self, key, value, ttl=None):
+        """键不存在时写入初始值，返回当前值"""
+        name = self.prefix + key
+        self.client.set(name, value, nx=True, ex=int(ttl) if ttl else None)
+        return self.get(key)
+
+    def delete(self, key):
+        """删除计数"""
+        self.client.delete(self.prefix + key)
+
+# 各类计数器允许的未同步增量，按计数器键的前缀（"daily:1:2024-01-01" 中的 daily）区分
+DEFAULT_MAX_PENDING = {
+    'daily': 10,       # 每日调用次数
+    'tokens': 20000,   # token用量
+    'cost': 0.5,       # 费用（美元）
+}
+
+class ReconciledCounterBackend:
+    """本地累计、定期与共享后端对账的计数器后端（多节点部署）
+
+    incr() 只修改本地值并返回 "上次同步的全局值 + 本节点未同步增量"，不访问
+    共享后端；后台线程每 sync_interval 秒把各计数器的本地增量合并到共享后端
+    （通常为 RedisCounterBackend）并取回全局值。某个计数器的未同步增量达到
+    max_pending 中对应的阈值时，在当前请求中立即同步。
+
+    超限上界：全局计数达到限额后，每个节点在下一次同步前最多再放行
+    max_pending 个单位，同步后即看到超限的全局值，因此任一计数器最多超出
+    节点数 × max_pending。max_pending 设为 0 时每次都同步（与直接使用共享后端一致）。
+    共享后端不可用时增量保留在本地，恢复后补写。
+    """
+
+    def __init__(self, remote, sync_interval=1.0, max_pending=None):
+        self.remote = remote
+        self.sync_interval = sync_interval
+        self.max_pending = dict(DEFAULT_MAX_PENDING if max_pending is None else max_pending)
+        self._entries = {}  # key -> [全局值, 未同步增量, expires_at, ttl, 上次同步时间]
+        self._dirty = set()  # 上次对账后访问过的计数器
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()  # 同一时间只有一个同步请求在进行
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """启动后台对账线程"""
+        if self._thread and self._thread.is_alive():
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='counter-reconciler', daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """停止对账线程并同步剩余增量"""
+        self._stop.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(self.sync_interval + 5)
+        self.sync()
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and now >= entry[2] and not entry[1]:
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key):
+        """获取计数值（本地视图），首次访问或超过两个对账周期未同步时从共享后端读取"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is not None and now - entry[4] < self.sync_interval * 2:
+                self._dirty.add(key)
+                return entry[0] + entry[1]
+            if entry is None:
+                self._entries[key] = [0, 0, None, None, now]
+        return self._sync_key(key)
+
+    def incr(self, key, amount=1, ttl=None):
+        """增加本地计数并返回本地视图，未同步增量达到阈值时立即同步"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            new = entry is None
+            if new:
+                entry = self._entries[key] = [0, 0, None, None, now]
+            if ttl and entry[2] is None:
+                entry[2], entry[3] = now + ttl, ttl
+            entry[1] += amount
+            self._dirty.add(key)
+            if not new and abs(entry[1]) < self._threshold(key):
+                return entry[0] + entry[1]
+        # 新计数器需要先取得全局值
+        return self._sync_key(key)
+
+    def setdefault(self, key, value, ttl=None):
+        """键不存在时在共享后端写入初始值，返回当前值"""
+        current = self.remote.setdefault(key, value, ttl)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None:
+                entry = self._entries[key] = [current, 0, now + ttl if ttl else None, ttl, now]
+            else:
+                entry[0], entry[4] = current, now
+            return entry[0] + entry[1]
+
+    def delete(self, key):
+        """删除计数"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._dirty.discard(key)
+        self.remote.delete(key)
+
+    def _threshold(self, key):
+        return self.max_pending.get(key.split(':', 1)[0], 0)
+
+    def _sync_key(self, key):
+        """把一个计数器的未同步增量写入共享后端并取回全局值，返回同步后的视图
+
+        增量在共享后端确认后才从本地扣除，同步期间本地视图仍包含这部分增量；
+        同步过程中达到阈值的请求等待本次同步完成后再同步，不会在过期的全局值上继续放行。
+        """
+        with self._sync_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    return 0
+                delta, ttl = entry[1], entry[3]
+            try:
+                value = self.remote.incr(key, delta, ttl) if delta else self.remote.get(key)
+            except Exception as e:
+                logger.error(f"同步计数器 {key} 失败，增量保留在本地: {e}")
+                value = None
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    return value or 0
+                if value is None:
+                    self._dirty.add(key)
+                else:
+                    entry[0], entry[1], entry[4] = value, entry[1] - delta, time.monotonic()
+                return entry[0] + entry[1]
+
+    def sync(self):
+        """同步上次对账后访问过的计数器"""
+        with self._lock:
+            keys, self._dirty = self._dirty, set()
+        for key in keys:
+            self._sync_key(key)
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"计数器对账失败: {e}")
+
+def create_counter_backend(url=None, sync_interval=None, max_pending=None):
+    """根据URL创建计数器后端，未配置时使用进程内后端
+
+    同时指定 sync_interval 时，Redis后端外面包一层本地累计、定期对账的
+    ReconciledCounterBackend，请求路径上不再每次访问Redis。
+    """
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        logger.info("使用Redis计数器后端")
+        backend = RedisCounterBackend.from_url(url)
+        if sync_interval:
+            return ReconciledCounterBackend(backend, sync_interval, max_pending).start()
+        return backend
+    return MemoryCounterBackend()
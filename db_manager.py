@@ -0,0 +1,232 @@
+from contextlib import contextmanager
+from datetime import datetime, date
+import queue
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _register_sqlite_types():
+    # SQLAlchemy 在SQLite中以 DATETIME/DATE 声明列，注册转换器后读取即为Python对象
+    sqlite3.register_converter('DATETIME', lambda b: datetime.fromisoformat(b.decode()))
+    sqlite3.register_converter('DATE', lambda b: date.fromisoformat(b.decode()))
+
+_register_sqlite_types()
+
+def configure_sqlite_connection(conn):
+    """为SQLite连接启用WAL模式（读写不互斥）并降低fsync频率"""
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+
+def install_sqlite_pragmas(engine):
+    """让Flask-SQLAlchemy的SQLite引擎使用相同的连接配置"""
+    if engine.dialect.name != 'sqlite':
+        return
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_conn, connection_record):
+        configure_sqlite_connection(dbapi_conn)
+
+class DatabaseManager:
+    """带连接池的SQLite连接管理器
+
+    - 连接池大小固定，取出连接时可先执行 SELECT 1 检测连接可用（pre_ping）
+    - 同一线程内嵌套调用 get_connection() 复用同一个连接
+    - 调用 init_app() 后，一个请求内的所有数据库操作共用一个连接，请求结束时归还
+    """
+
+    dialect = 'sqlite'
+
+    def __init__(self, database_url, pool_size=5, pre_ping=True,
+                 statement_cache_size=256, timeout=30):
+        self.database = database_url.split('sqlite:///', 1)[-1]
+        self.pool_size = pool_size
+        self.pre_ping = pre_ping
+        self.statement_cache_size = statement_cache_size
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def init_app(self, app):
+        """在请求范围内固定连接，请求结束时归还连接池"""
+        app.before_request(self.pin)
+        app.teardown_request(lambda exc: self.unpin())
+
+    def pin(self):
+        """当前线程后续的 get_connection() 在 unpin() 前不归还连接"""
+        self._local.pinned = True
+
+    def unpin(self):
+        """归还当前线程固定的连接"""
+        self._local.pinned = False
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and not getattr(self._local, 'depth', 0):
+            self._local.conn = None
+            self._release(conn)
+
+    @contextmanager
+    def get_connection(self):
+        """获取数据库连接（上下文管理器）"""
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = self._acquire()
+            local.depth = 0
+        local.depth += 1
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            local.depth -= 1
+            if not local.depth and not getattr(local, 'pinned', False):
+                local.conn = None
+                self._release(conn)
+
+    def close(self):
+        """关闭连接池中的空闲连接"""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def _acquire(self):
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.pool_size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    try:
+                        return self._connect()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                try:
+                    conn = self._pool.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"等待数据库连接超时（{self.timeout}秒）")
+            if not self.pre_ping or self._ping(conn):
+                return conn
+            self._discard(conn)
+
+    def _release(self, conn):
+        try:
+            # 归还前结束未提交的事务，避免长事务阻塞WAL检查点
+            conn.rollback()
+            self._pool.put_nowait(conn)
+        except Exception:
+            self._discard(conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _ping(conn):
+        try:
+            conn.execute('SELECT 1')
+            return True
+        except Exception as e:
+            logger.warning(f"数据库连接不可用，重新建立连接: {e}")
+            return False
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database,
+            timeout=self.timeout,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            cached_statements=self.statement_cache_size
+        )
+        conn.row_factory = sqlite3.Row
+        configure_sqlite_connection(conn)
+        return conn
+
+class EngineDatabaseManager(DatabaseManager):
+    """复用SQLAlchemy引擎连接池的连接管理器（用于PostgreSQL）
+
+    与 models.db 共用同一个连接池，连接池大小和 pre_ping 通过
+    SQLALCHEMY_ENGINE_OPTIONS 配置。SQL中的 ? 占位符会转换为驱动的格式。
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        self._local = threading.local()
+
+    def close(self):
+        self.engine.dispose()
+
+    def _acquire(self):
+        return _QmarkConnection(self.engine.raw_connection())
+
+    def _release(self, conn):
+        try:
+            conn.rollback()
+        finally:
+            # 归还到SQLAlchemy连接池
+            conn.close()
+
+class _QmarkConnection:
+    """把 ? 占位符转换为 %s，并返回可按列名访问的行"""
+
+    def __init__(self, raw_connection):
+        self._raw = raw_connection
+
+    def cursor(self):
+        from psycopg2.extras import DictCursor
+        return _QmarkCursor(self._raw.cursor(cursor_factory=DictCursor))
+
+    def execute(self, sql, params=()):
+        cursor = self.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def close(self):
+        self._raw.close()
+
+class _QmarkCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params=()):
+        return self._cursor.execute(sql.replace('%', '%%').replace('?', '%s'), params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._cursor.executemany(sql.replace('%', '%%').replace('?', '%s'), seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+def create_db_manager(database_url, engine=None, **pool_options):
+    """SQLite使用内置连接池，其他数据库复用Flask-SQLAlchemy引擎的连接池"""
+    if database_url.startswith('sqlite'):
+        return DatabaseManager(database_url, **pool_options)
+    if engine is None:
+        raise ValueError("非SQLite数据库需要传入SQLAlchemy引擎")
+    return EngineDatabaseManager(engine)
@@ -0,0 +1,69 @@
+from datetime import date, datetime, timedelta
+import csv
+import io
+import json
+import zlib
+import logging
+
+from pagination import encode_cursor
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+def _jsonable(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def stream_rows(rows, columns, fmt='csv', compress=False, chunk_size=65536):
+    """把行迭代器编码为CSV/JSONL分块输出，内存占用与总行数无关
+
+    每行附带 cursor 字段（排序键 id 的游标令牌），导出中断后可以从
+    最后收到的一行继续。compress 为True时输出gzip流。
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {fmt}")
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    if fmt == 'csv':
+        writer.writerow(list(columns) + ['cursor'])
+
+    def flush():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    for row in rows:
+        cursor = encode_cursor([row.id])
+        if fmt == 'csv':
+            writer.writerow([_jsonable(getattr(row, c)) for c in columns] + [cursor])
+        else:
+            record = {c: _jsonable(getattr(row, c)) for c in columns}
+            record['cursor'] = cursor
+            buffer.write(json.dumps(record, ensure_ascii=False))
+            buffer.write('\n')
+        if buffer.tell() >= chunk_size:
+            chunk = flush()
+            if chunk:
+                yield chunk
+
+    chunk = flush()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+def parse_time(value, end=False):
+    """解析导出参数中的时间（ISO日期或日期时间），日期作为结束时间时取次日零点"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
@@ -0,0 +1,71 @@
+"""API节点的轻量入口
+
+只依赖 Flask 和原生数据库连接（api_keys、db_manager），不导入ORM模型和管理后台，
+只需要 require_api_key 的工作进程启动更快。管理后台（models、routes）只在
+ADMIN_ENABLED 开启的节点上注册时才导入。
+
+    from gate import init_gate, require_api_key
+
+    app = Flask(__name__)
+    init_gate(app)
+"""
+import atexit
+import os
+import logging
+
+from api_keys import ApiKeyManager, get_api_key_from_request, require_api_key  # noqa: F401
+from db_manager import create_db_manager
+
+logger = logging.getLogger(__name__)
+
+def _env_flag(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+def init_gate(app, database_url=None, admin=None, snapshot_path=None, pool_size=10, **manager_options):
+    """创建 app.api_key_manager，按需注册管理后台，并从快照预热密钥缓存
+
+    - admin: 是否注册管理后台，默认取 ADMIN_ENABLED（默认开启）；API节点设为关闭
+    - snapshot_path: 密钥缓存快照文件，默认取 KEY_CACHE_SNAPSHOT；启动时预热，
+      进程退出时写回
+    """
+    database_url = (database_url or app.config.get('SQLALCHEMY_DATABASE_URI')
+                    or os.getenv('DATABASE_URL', 'sqlite:///api_keys.db'))
+    app.config.setdefault('SQLALCHEMY_DATABASE_URI', database_url)
+    if admin is None:
+        admin = _env_flag('ADMIN_ENABLED', app.config.get('ADMIN_ENABLED', True))
+
+    if admin:
+        # 管理节点与 models.db 共用一个引擎连接池
+        engine = register_admin(app)
+    elif database_url.startswith('sqlite'):
+        engine = None
+    else:
+        from sqlalchemy import create_engine
+        engine = create_engine(database_url, **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+    db_manager = create_db_manager(database_url, engine=engine, pool_size=pool_size)
+    db_manager.init_app(app)
+    manager = ApiKeyManager(db_manager, **manager_options)
+    app.api_key_manager = manager
+
+    snapshot_path = snapshot_path or app.config.get('KEY_CACHE_SNAPSHOT') or os.getenv('KEY_CACHE_SNAPSHOT')
+    if snapshot_path:
+        manager.warm_cache(snapshot_path)
+        atexit.register(manager.dump_cache_snapshot, snapshot_path)
+    return manager
+
+def register_admin(app):
+    """导入ORM模型和管理路由并注册管理后台，返回 models.db 的引擎"""
+    from models import db
+    from db_manager import install_sqlite_pragmas
+    import routes
+
+    if 'sqlalchemy' not in app.extensions:
+        db.init_app(app)
+    routes.init_app(app)
+    with app.app_context():
+        install_sqlite_pragmas(db.engine)
+        return db.engine
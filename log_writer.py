@@ -0,0 +1,105 @@
+import atexit
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class BatchWriter:
+    """后台批量写入器
+
+    请求线程通过 submit() 把记录放入有界队列，后台线程按批次大小或刷新间隔
+    调用 flush_func(records) 批量写入。队列满时按 overflow 策略处理：
+    'drop' 丢弃新记录，'block' 阻塞等待（最多 block_timeout 秒）。
+    """
+
+    def __init__(self, flush_func, batch_size=100, flush_interval=1.0,
+                 max_queue_size=10000, overflow='drop', block_timeout=5.0,
+                 name='batch-writer'):
+        if overflow not in ('drop', 'block'):
+            raise ValueError(f"不支持的溢出策略: {overflow}")
+        self.flush_func = flush_func
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.name = name
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """启动后台写入线程"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return self
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        return self
+
+    def submit(self, record):
+        """提交一条记录，被丢弃时返回False"""
+        try:
+            if self.overflow == 'block':
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(f"{self.name} 队列已满，已丢弃 {self.dropped} 条记录")
+            return False
+
+    def close(self, timeout=10.0):
+        """停止写入线程并写完队列中剩余的记录"""
+        self._stop.set()
+        thread = self._thread
+        if thread and thread.is_alive():
+            thread.join(timeout)
+        # 线程未启动或已退出时，在当前线程写完剩余记录
+        if not (thread and thread.is_alive()):
+            self._drain()
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+        self._drain()
+
+    def _collect(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        while True:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not batch:
+                return
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            self.flush_func(batch)
+        except Exception as e:
+            logger.error(f"{self.name} 批量写入失败（{len(batch)} 条）: {e}")
@@ -0,0 +1,223 @@
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+import bisect
+import heapq
+import hmac
+import itertools
+import os
+import sys
+import threading
+import time
+import logging
+
+from flask import Blueprint, Response, current_app, g, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+# 秒，覆盖从缓存命中（亚毫秒）到上游调用（数秒）的范围
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """固定分桶的耗时直方图，observe() 只做一次二分查找和计数"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """返回 (各桶计数, 总和)，最后一个桶为 +Inf"""
+        with self._lock:
+            return list(self._counts), self._sum
+
+class MetricsRegistry:
+    """按阶段汇总的耗时直方图，输出Prometheus文本格式"""
+
+    def __init__(self, name='api_key_stage_duration_seconds', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage_name, seconds):
+        histogram = self._histograms.get(stage_name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage_name, Histogram(self.buckets))
+        histogram.observe(seconds)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} API密钥请求处理各阶段耗时（秒）",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        for stage_name, histogram in histograms:
+            counts, total = histogram.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{stage="{stage_name}",le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{stage="{stage_name}"}} {total}')
+            lines.append(f'{self.name}_count{{stage="{stage_name}"}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+@contextmanager
+def stage(name):
+    """记录一个阶段的耗时；在请求中时同时记入 g.stage_timings 供 Server-Timing 使用"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        REGISTRY.observe(name, elapsed)
+        if has_request_context():
+            timings = g.get('stage_timings')
+            if timings is None:
+                timings = g.stage_timings = []
+            timings.append((name, elapsed))
+
+def timed(name):
+    """记录函数耗时的装饰器"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class SlowRequestProfiler:
+    """对进行中的请求定时采样调用栈，保留最慢N个请求的折叠栈文件
+
+    输出为 flamegraph.pl / speedscope 可直接读取的折叠格式（每行 "栈 次数"），
+    根帧为 "METHOD /path"。
+    """
+
+    def __init__(self, output_dir, top_n=10, interval=0.005):
+        self.output_dir = output_dir
+        self.top_n = top_n
+        self.interval = interval
+        self._active = {}  # thread_id -> (开始时间, Counter)
+        self._slowest = []  # 最小堆 (耗时, 序号, 文件路径)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        app.before_request(self.begin)
+        app.teardown_request(lambda exc: self.end(f"{request.method} {request.path}"))
+        self.start()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return self
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='slow-request-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def begin(self):
+        with self._lock:
+            self._active[threading.get_ident()] = (time.perf_counter(), Counter())
+
+    def end(self, label):
+        # 锁内只取出采样数据，写文件在锁外进行，不阻塞采样线程和其他请求
+        with self._lock:
+            entry = self._active.pop(threading.get_ident(), None)
+            if entry is None:
+                return
+            duration = time.perf_counter() - entry[0]
+            if len(self._slowest) >= self.top_n and duration <= self._slowest[0][0]:
+                return
+            seq = next(self._seq)
+            stacks = list(entry[1].items())
+        path = os.path.join(self.output_dir, f"{duration * 1000:.0f}ms-{seq}.folded")
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in stacks:
+                    f.write(f"{label};{stack} {count}\n")
+        except OSError as e:
+            logger.error(f"写入请求采样文件失败: {e}")
+            return
+        with self._lock:
+            heapq.heappush(self._slowest, (duration, seq, path))
+            evicted = heapq.heappop(self._slowest)[2] if len(self._slowest) > self.top_n else None
+        if evicted is not None:
+            try:
+                os.remove(evicted)
+            except OSError:
+                pass
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, (_, counts) in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        counts[self._fold(frame)] += 1
+
+    @staticmethod
+    def _fold(frame):
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(parts))
+
+bp = Blueprint('metrics', __name__)
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    """Prometheus抓取端点，配置 METRICS_TOKEN 后需要 Bearer 令牌"""
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        supplied = request.headers.get('Authorization', '')[len('Bearer '):]
+        if not hmac.compare_digest(supplied.encode(), token.encode()):
+            return Response('unauthorized\n', status=401, mimetype='text/plain')
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+def add_server_timing(response):
+    """调试模式下把各阶段耗时写入 Server-Timing 响应头（毫秒）"""
+    timings = g.get('stage_timings')
+    if timings:
+        response.headers['Server-Timing'] = ', '.join(
+            f"{name};dur={elapsed * 1000:.2f}" for name, elapsed in timings
+        )
+    return response
+
+def init_app(app):
+    """注册 /metrics 端点；调试模式或 SERVER_TIMING=True 时输出 Server-Timing；
+    配置 PROFILE_SLOWEST_N 时启用慢请求采样（输出到 PROFILE_DIR）"""
+    app.register_blueprint(bp)
+    if app.debug or app.config.get('SERVER_TIMING'):
+        app.after_request(add_server_timing)
+    top_n = app.config.get('PROFILE_SLOWEST_N')
+    if top_n:
+        profiler = SlowRequestProfiler(
+            app.config.get('PROFILE_DIR', 'logs/profiles'),
+            top_n=int(top_n),
+            interval=app.config.get('PROFILE_INTERVAL', 0.005)
+        )
+        profiler.init_app(app)
+        app.extensions['slow_request_profiler'] = profiler
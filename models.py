@@ -1,4 +1,5 @@
 from datetime import datetime
+from flask import current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -16,8 +17,8 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
     
-    # 关系
-    api_keys = db.relationship('ApiKey', backref='creator', lazy=True)
+    # 关系（lazy='raise'：需要时在查询中显式加载，避免模板中隐式触发N+1查询）
+    api_keys = db.relationship('ApiKey', backref=db.backref('creator', lazy='raise'), lazy='raise')
     
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -30,7 +31,12 @@ class ApiKey(db.Model):
     __tablename__ = 'api_keys'
     
     id = db.Column(db.Integer, primary_key=True)
-    key = db.Column(db.String(32), unique=True, nullable=False)
+    key = db.Column(db.String(32), unique=True)  # 旧版明文密钥，迁移后清空
+    key_prefix = db.Column(db.String(16), unique=True, index=True)  # 密钥中 "." 之前的公开部分
+    key_hash = db.Column(db.String(64))  # 密文部分的 HMAC-SHA256
+    previous_key_prefix = db.Column(db.String(16), unique=True, index=True)  # 轮换前的密钥前缀
+    previous_key_hash = db.Column(db.String(64))
+    previous_key_expires_at = db.Column(db.DateTime)  # 旧密钥宽限期截止时间
     name = db.Column(db.String(100))
     status = db.Column(db.String(20), default='active')  # active, disabled
     created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -39,11 +45,25 @@ class ApiKey(db.Model):
     expires_at = db.Column(db.DateTime)
     last_used_at = db.Column(db.DateTime)
     daily_limit = db.Column(db.Integer, default=1000)
+    requests_per_second = db.Column(db.Integer)  # 为空表示不限制
+    requests_per_minute = db.Column(db.Integer)  # 为空表示不限制
+    daily_token_limit = db.Column(db.Integer)  # 为空表示不限制
+    monthly_token_limit = db.Column(db.Integer)
+    daily_cost_limit = db.Column(db.Float)  # 美元
+    monthly_cost_limit = db.Column(db.Float)
+    response_cache_enabled = db.Column(db.Boolean, default=False)  # 缓存 temperature=0 的补全响应
     total_calls = db.Column(db.Integer, default=0)
     
-    # 关系
-    logs = db.relationship('ApiLog', backref='api_key', lazy=True)
-    stats = db.relationship('ApiStat', backref='api_key', lazy=True)
+    # 关系（日志和统计可能有大量行，禁止隐式加载；删除密钥时也不逐行加载）
+    logs = db.relationship('ApiLog', backref=db.backref('api_key', lazy='raise'),
+                           lazy='raise', passive_deletes=True)
+    stats = db.relationship('ApiStat', backref=db.backref('api_key', lazy='raise'),
+                            lazy='raise', passive_deletes=True)
+    
+    __table_args__ = (
+        # 密钥列表按 (创建时间, id) 游标分页
+        db.Index('ix_api_keys_created_at_id', 'created_at', 'id'),
+    )
     
     @property
     def is_expired(self):
@@ -59,7 +79,11 @@ class ApiKey(db.Model):
         db.session.commit()
 
 class ApiLog(db.Model):
-    """API调用日志模型"""
+    """API调用日志模型
+
+    只用于查询。日志统一通过 ApiKeyManager.log_api_call() / write_log_records() 写入：
+    分区后的SQLite中 api_logs 是由触发器路由写入的视图，ORM插入取不到新行的id。
+    """
     __tablename__ = 'api_logs'
     
     id = db.Column(db.Integer, primary_key=True)
@@ -72,16 +96,17 @@ class ApiLog(db.Model):
     request_method = db.Column(db.String(10))
     response_code = db.Column(db.Integer)
     response_time = db.Column(db.Float)  # 响应时间（秒）
+    time_to_first_token = db.Column(db.Float)  # 流式响应首个分块的耗时（秒）
     success = db.Column(db.Boolean, default=True)
     error_message = db.Column(db.Text)
+    tokens = db.Column(db.Integer, default=0)
+    cost = db.Column(db.Float, default=0.0)  # 美元
+    cache_hit = db.Column(db.Boolean, default=False)  # 由响应缓存返回，未调用上游
     
-    @classmethod
-    def create(cls, **kwargs):
-        """创建新的日志记录"""
-        log = cls(**kwargs)
-        db.session.add(log)
-        db.session.commit()
-        return log
+    __table_args__ = (
+        # 密钥详情页的最近调用和每日用量统计按 (密钥, 时间) 过滤排序
+        db.Index('ix_api_logs_key_time', 'api_key_id', 'timestamp'),
+    )
 
 class ApiStat(db.Model):
     """API使用统计模型"""
@@ -96,9 +121,11 @@ class ApiStat(db.Model):
     average_latency = db.Column(db.Float, default=0.0)
     total_tokens = db.Column(db.Integer, default=0)
     total_cost = db.Column(db.Float, default=0.0)
+    cache_hits = db.Column(db.Integer, default=0)  # 响应缓存命中，不计入 total_calls
     
     __table_args__ = (
         db.UniqueConstraint('api_key_id', 'date', 'provider', name='unique_daily_stats'),
+        db.Index('ix_api_stats_date_provider', 'date', 'provider'),
     )
     
     @classmethod
@@ -133,6 +160,55 @@ class ApiStat(db.Model):
         db.session.commit()
         return stat
 
+class ApiStatHourly(db.Model):
+    """按小时汇总的API使用统计（每个密钥/提供商）"""
+    __tablename__ = 'api_stats_hourly'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('api_keys.id'), nullable=False)
+    provider = db.Column(db.String(20), nullable=False)
+    hour = db.Column(db.DateTime, nullable=False)
+    total_calls = db.Column(db.Integer, default=0)
+    success_calls = db.Column(db.Integer, default=0)
+    latency_sum = db.Column(db.Float, default=0.0)  # 成功调用的响应时间之和
+    total_tokens = db.Column(db.Integer, default=0)
+    total_cost = db.Column(db.Float, default=0.0)
+    cache_hits = db.Column(db.Integer, default=0)
+    latency_sketch = db.Column(db.LargeBinary)  # 序列化的 LatencySketch
+    
+    __table_args__ = (
+        db.UniqueConstraint('api_key_id', 'provider', 'hour', name='unique_hourly_stats'),
+    )
+    
+    @property
+    def average_latency(self):
+        """按调用数加权的平均响应时间"""
+        return self.latency_sum / self.success_calls if self.success_calls else 0.0
+
+class ApiStatDaily(db.Model):
+    """按天汇总的API使用统计（所有密钥，按提供商）"""
+    __tablename__ = 'api_stats_daily'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False)
+    provider = db.Column(db.String(20), nullable=False)
+    total_calls = db.Column(db.Integer, default=0)
+    success_calls = db.Column(db.Integer, default=0)
+    latency_sum = db.Column(db.Float, default=0.0)  # 成功调用的响应时间之和
+    total_tokens = db.Column(db.Integer, default=0)
+    total_cost = db.Column(db.Float, default=0.0)
+    cache_hits = db.Column(db.Integer, default=0)
+    latency_sketch = db.Column(db.LargeBinary)  # 序列化的 LatencySketch
+    
+    __table_args__ = (
+        db.UniqueConstraint('date', 'provider', name='unique_daily_rollup'),
+    )
+    
+    @property
+    def average_latency(self):
+        """按调用数加权的平均响应时间"""
+        return self.latency_sum / self.success_calls if self.success_calls else 0.0
+
 class SystemLog(db.Model):
     """系统日志模型"""
     __tablename__ = 'system_logs'
@@ -143,9 +219,25 @@ class SystemLog(db.Model):
     message = db.Column(db.Text)
     source = db.Column(db.String(100))
     
+    __table_args__ = (
+        # 日志页按级别/来源过滤（均可选），按时间倒序分页
+        db.Index('ix_system_logs_timestamp', 'timestamp'),
+        db.Index('ix_system_logs_level_time', 'level', 'timestamp'),
+        db.Index('ix_system_logs_source_time', 'source', 'timestamp'),
+        db.Index('ix_system_logs_level_source_time', 'level', 'source', 'timestamp'),
+    )
+    
     @classmethod
     def log(cls, message, level='INFO', source=None):
-        """记录系统日志"""
+        """记录系统日志
+
+        应用注册了 AuditSink 时异步写入并返回None，不占用当前请求的数据库会话
+        """
+        sink = current_app.extensions.get('audit_sink') if has_app_context() else None
+        if sink is not None:
+            sink.log(message, level=level, source=source)
+            return None
+            
         log = cls(
             message=message,
             level=level,
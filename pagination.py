@@ -0,0 +1,104 @@
+from collections import namedtuple
+from datetime import datetime
+import base64
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+KeysetPage = namedtuple('KeysetPage', 'items next_cursor prev_cursor total total_exact')
+
+def encode_cursor(values, before=False, total=None):
+    """把排序键编码为URL安全的游标令牌，before 表示向前翻页
+
+    total 为第一页估算的 (行数, 是否精确)，随游标传到后续页面，翻页时不再重新计数。
+    """
+    data = {'v': [v.isoformat() if isinstance(v, datetime) else v for v in values], 'b': before}
+    if total is not None:
+        data['t'] = list(total)
+    raw = json.dumps(data, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(token, types):
+    """解析游标令牌，返回 (排序键, before)，令牌无效时抛出 ValueError"""
+    values, before, _ = _decode_cursor(token, types)
+    return values, before
+
+def _decode_cursor(token, types):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        data = json.loads(raw)
+        values = data['v']
+        if len(values) != len(types):
+            raise ValueError('排序键数量不匹配')
+        values = [datetime.fromisoformat(v) if t is datetime and v is not None else v
+                  for v, t in zip(values, types)]
+        total = data.get('t')
+        if total is not None:
+            count, exact = total
+            total = (int(count), bool(exact))
+        return values, bool(data.get('b')), total
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError(f"无效的分页游标: {e}")
+
+def keyset_paginate(query, columns, cursor=None, per_page=50, count_cap=10000):
+    """按 columns 倒序做游标分页（如 (timestamp, id)），避免OFFSET扫描和每页COUNT(*)
+
+    columns 最后一列必须唯一（通常为主键），翻页条件为行值比较，可直接利用
+    (过滤列..., 排序列) 复合索引。总数只在第一页估算，之后随游标传递；
+    不带总数的游标（如导出接口的游标）会重新估算。
+    """
+    from sqlalchemy import tuple_
+
+    values, before, total = (None, False, None)
+    if cursor:
+        values, before, total = _decode_cursor(cursor, [c.type.python_type for c in columns])
+    key = tuple_(*columns)
+    if values is None:
+        page = query.order_by(*[c.desc() for c in columns])
+    elif before:
+        page = query.filter(key > tuple(values)).order_by(*[c.asc() for c in columns])
+    else:
+        page = query.filter(key < tuple(values)).order_by(*[c.desc() for c in columns])
+
+    items = page.limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if before:
+        items.reverse()
+    has_next = True if before else more
+    has_prev = more if before else values is not None
+
+    def key_of(item):
+        return [getattr(item, c.key) for c in columns]
+
+    if total is None:
+        total = estimate_count(query, count_cap)
+    return KeysetPage(
+        items=items,
+        next_cursor=encode_cursor(key_of(items[-1]), total=total) if items and has_next else None,
+        prev_cursor=encode_cursor(key_of(items[0]), before=True, total=total) if items and has_prev else None,
+        total=total[0],
+        total_exact=total[1]
+    )
+
+def estimate_count(query, cap=10000):
+    """估算结果行数，返回 (行数, 是否精确)
+
+    PostgreSQL使用查询计划的行数估计；其他数据库最多计数 cap 行，超过时返回 (cap, False)。
+    """
+    from sqlalchemy import text
+
+    session = query.session
+    bind = session.get_bind()
+    if bind.dialect.name == 'postgresql':
+        try:
+            sql = str(query.statement.compile(bind, compile_kwargs={'literal_binds': True}))
+            plan = session.execute(text('EXPLAIN (FORMAT JSON) ' + sql.replace(':', r'\:'))).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows']), False
+        except Exception as e:
+            logger.warning(f"估算行数失败，改为限量计数: {e}")
+    count = query.order_by(None).limit(cap + 1).count()
+    return min(count, cap), count <= cap
@@ -0,0 +1,335 @@
+from datetime import datetime, timedelta
+import glob
+import gzip
+import json
+import os
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+LOG_COLUMNS = (
+    'id', 'api_key_id', 'timestamp', 'client_ip', 'provider', 'model',
+    'request_path', 'request_method', 'response_code', 'response_time',
+    'time_to_first_token', 'success', 'error_message', 'tokens', 'cost', 'cache_hit'
+)
+PARTITION_PREFIX = 'api_logs_p'
+DEFAULT_PARTITION = 'api_logs_pdefault'
+
+class LogPartitionManager:
+    """api_logs 按时间分区、归档和导出
+
+    - PostgreSQL：api_logs 为 PARTITION BY RANGE (timestamp) 的原生分区表
+    - SQLite：每个周期一张 api_logs_pYYYYMM(DD) 表，api_logs 为 UNION ALL 视图，
+      写入由 INSTEAD OF 触发器按时间路由，id 由 api_log_seq 统一分配
+    - 过期分区以流式方式写出为 gzip 压缩的 JSONL 文件后删除，归档数据可通过
+      iter_archived_logs() 继续查询
+    """
+
+    def __init__(self, db_manager, period='month', archive_dir='logs/archive'):
+        if period not in ('month', 'day'):
+            raise ValueError(f"不支持的分区周期: {period}")
+        self.db_manager = db_manager
+        self.period = period
+        self.archive_dir = archive_dir
+        self.dialect = getattr(db_manager, 'dialect', 'sqlite')
+
+    # ---- 周期计算 ----
+
+    def period_start(self, dt):
+        if self.period == 'day':
+            return datetime(dt.year, dt.month, dt.day)
+        return datetime(dt.year, dt.month, 1)
+
+    def next_period(self, start):
+        if self.period == 'day':
+            return start + timedelta(days=1)
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+    def partition_name(self, start):
+        return PARTITION_PREFIX + start.strftime('%Y%m%d' if self.period == 'day' else '%Y%m')
+
+    @staticmethod
+    def _parse_partition(name):
+        """从分区名解析周期起点，非周期分区返回None"""
+        suffix = name[len(PARTITION_PREFIX):]
+        fmt = {8: '%Y%m%d', 6: '%Y%m'}.get(len(suffix))
+        if not fmt or not suffix.isdigit():
+            return None
+        try:
+            return datetime.strptime(suffix, fmt)
+        except ValueError:
+            return None
+
+    def _bounds(self, name):
+        start = self._parse_partition(name)
+        if len(name) - len(PARTITION_PREFIX) == 8:
+            return start, start + timedelta(days=1)
+        return start, datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+    # ---- 分区管理 ----
+
+    def list_partitions(self):
+        """返回按时间排序的周期分区名"""
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.dialect == 'postgresql':
+                cursor.execute("""
+                    SELECT c.relname FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    JOIN pg_class p ON p.oid = i.inhparent
+                    WHERE p.relname = 'api_logs'
+                """)
+            else:
+                cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?",
+                               (PARTITION_PREFIX + '%',))
+            names = [row[0] for row in cursor.fetchall()]
+        return sorted(name for name in names if self._parse_partition(name))
+
+    def is_partitioned(self):
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.dialect == 'postgresql':
+                cursor.execute("SELECT 1 FROM pg_partitioned_table t JOIN pg_class c ON c.oid = t.partrelid "
+                               "WHERE c.relname = 'api_logs'")
+            else:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'api_logs'")
+            return cursor.fetchone() is not None
+
+    def _table_exists(self, name):
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.dialect == 'postgresql':
+                cursor.execute("SELECT to_regclass(?) IS NOT NULL", (name,))
+                return bool(cursor.fetchone()[0])
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+            return cursor.fetchone() is not None
+
+    def enable(self):
+        """把现有的 api_logs 表转换为分区布局（只需执行一次）
+
+        转换中断时 api_logs_legacy 会保留下来，重新执行会从中断处继续。
+        """
+        if self.is_partitioned() and not self._table_exists('api_logs_legacy'):
+            return False
+        if self.dialect == 'postgresql':
+            self._enable_postgres()
+        else:
+            self._enable_sqlite()
+        self.ensure_partitions()
+        logger.info(f"api_logs 已启用按{self.period}分区")
+        return True
+
+    def ensure_partitions(self, ahead=1):
+        """创建当前周期及之后 ahead 个周期的分区"""
+        start = self.period_start(datetime.utcnow())
+        starts = [start]
+        for _ in range(ahead):
+            starts.append(self.next_period(starts[-1]))
+        existing = set(self.list_partitions())
+        missing = [s for s in starts if self.partition_name(s) not in existing]
+        if missing:
+            self._create_partitions(missing)
+        return [self.partition_name(s) for s in missing]
+
+    def _create_partitions(self, starts):
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            for start in starts:
+                name = self.partition_name(start)
+                if self.dialect == 'postgresql':
+                    cursor.execute(f"""
+                        CREATE TABLE IF NOT EXISTS {name} PARTITION OF api_logs
+                        FOR VALUES FROM ('{start.isoformat(' ')}') TO ('{self.next_period(start).isoformat(' ')}')
+                    """)
+                else:
+                    cursor.execute(self._sqlite_table_sql(cursor, name))
+                    cursor.execute(f"CREATE INDEX IF NOT EXISTS ix_{name}_key_time ON {name} (api_key_id, timestamp)")
+            if self.dialect != 'postgresql':
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS ix_{DEFAULT_PARTITION}_key_time "
+                               f"ON {DEFAULT_PARTITION} (api_key_id, timestamp)")
+                self._rebuild_sqlite_view(cursor)
+            conn.commit()
+
+    def _enable_postgres(self):
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            if not self._table_exists('api_logs_legacy'):
+                cursor.execute("ALTER TABLE api_logs RENAME TO api_logs_legacy")
+                # 改表名不会改索引名（主键、ix_api_logs_key_time），先给旧表的索引改名，让出名称
+                cursor.execute("SELECT indexname FROM pg_indexes "
+                               "WHERE schemaname = current_schema() AND tablename = 'api_logs_legacy'")
+                for row in cursor.fetchall():
+                    legacy_name = row[0].replace('api_logs', 'api_logs_legacy', 1)
+                    if legacy_name != row[0]:
+                        cursor.execute(f'ALTER INDEX "{row[0]}" RENAME TO "{legacy_name}"')
+                # 序列脱离旧表，删除旧表后新分区表继续使用
+                cursor.execute("ALTER SEQUENCE api_logs_id_seq OWNED BY NONE")
+            if not self.is_partitioned():
+                cursor.execute("""
+                    CREATE TABLE api_logs (LIKE api_logs_legacy INCLUDING DEFAULTS)
+                    PARTITION BY RANGE (timestamp)
+                """)
+                cursor.execute("ALTER TABLE api_logs ADD PRIMARY KEY (id, timestamp)")
+                cursor.execute("CREATE INDEX ix_api_logs_key_time ON api_logs (api_key_id, timestamp)")
+                cursor.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF api_logs DEFAULT")
+            cursor.execute("SELECT DISTINCT date_trunc(?, timestamp) FROM api_logs_legacy WHERE timestamp IS NOT NULL",
+                           (self.period,))
+            starts = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+        self._create_partitions(starts)
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO api_logs SELECT * FROM api_logs_legacy")
+            cursor.execute("DROP TABLE api_logs_legacy")
+            conn.commit()
+
+    def _enable_sqlite(self):
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            if not self._table_exists('api_logs_legacy'):
+                cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'api_logs'")
+                table_sql = cursor.fetchone()[0]
+                cursor.execute("ALTER TABLE api_logs RENAME TO api_logs_legacy")
+                # 默认分区保存原始表结构，既接收无匹配分区的写入，也作为新分区的建表模板
+                cursor.execute(re.sub(r'^CREATE TABLE\s+"?api_logs"?', f'CREATE TABLE {DEFAULT_PARTITION}',
+                                      table_sql))
+                cursor.execute("CREATE TABLE api_log_seq (value INTEGER NOT NULL)")
+                cursor.execute("INSERT INTO api_log_seq (value) SELECT COALESCE(MAX(id), 0) FROM api_logs_legacy")
+            cursor.execute("SELECT MIN(timestamp), MAX(timestamp) FROM api_logs_legacy WHERE timestamp IS NOT NULL")
+            first, last = cursor.fetchone()
+            conn.commit()
+        starts = []
+        if first:
+            start = self.period_start(_as_datetime(first))
+            while start <= _as_datetime(last):
+                starts.append(start)
+                start = self.next_period(start)
+        self._create_partitions(starts)
+        columns = ', '.join(LOG_COLUMNS)
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            # 视图和触发器建好后，按时间路由写入各分区
+            cursor.execute(f"INSERT INTO api_logs ({columns}) SELECT {columns} FROM api_logs_legacy")
+            cursor.execute("DROP TABLE api_logs_legacy")
+            conn.commit()
+
+    def _sqlite_table_sql(self, cursor, name):
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (DEFAULT_PARTITION,))
+        template = cursor.fetchone()[0]
+        return re.sub(r'^CREATE TABLE\s+"?\w+"?', f'CREATE TABLE IF NOT EXISTS {name}', template)
+
+    def _rebuild_sqlite_view(self, cursor):
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?",
+                       (PARTITION_PREFIX + '%',))
+        partitions = sorted(row[0] for row in cursor.fetchall() if self._parse_partition(row[0]))
+        columns = ', '.join(LOG_COLUMNS)
+        values = ', '.join('COALESCE(NEW.id, (SELECT value FROM api_log_seq))' if c == 'id' else f'NEW.{c}'
+                           for c in LOG_COLUMNS)
+        ranges = []
+        routes = []
+        for name in partitions:
+            start, end = self._bounds(name)
+            condition = f"NEW.timestamp >= '{start.isoformat(' ')}' AND NEW.timestamp < '{end.isoformat(' ')}'"
+            ranges.append(f"({condition})")
+            routes.append(f"INSERT INTO {name} ({columns}) SELECT {values} WHERE {condition};")
+        default_condition = f"NOT ({' OR '.join(ranges)})" if ranges else '1'
+        routes.append(f"INSERT INTO {DEFAULT_PARTITION} ({columns}) SELECT {values} WHERE {default_condition};")
+
+        cursor.execute("DROP VIEW IF EXISTS api_logs")
+        cursor.execute("CREATE VIEW api_logs AS " + ' UNION ALL '.join(
+            f"SELECT {columns} FROM {name}" for name in partitions + [DEFAULT_PARTITION]
+        ))
+        cursor.execute(f"""
+            CREATE TRIGGER api_logs_insert INSTEAD OF INSERT ON api_logs
+            BEGIN
+                UPDATE api_log_seq SET value = CASE WHEN NEW.id IS NULL THEN value + 1 ELSE MAX(value, NEW.id) END;
+                {' '.join(routes)}
+            END
+        """)
+
+    # ---- 归档 ----
+
+    def archive(self, keep=3):
+        """把早于最近 keep 个周期的分区流式写出为 gzip JSONL 并删除，返回归档文件列表"""
+        cutoff = self.period_start(datetime.utcnow())
+        for _ in range(keep - 1):
+            cutoff = self.period_start(cutoff - timedelta(days=1))
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archived = []
+        for name in self.list_partitions():
+            start, end = self._bounds(name)
+            if end > cutoff:
+                continue
+            path = os.path.join(self.archive_dir, f"{name}.jsonl.gz")
+            rows = self._export_partition(name, path)
+            self._drop_partition(name)
+            archived.append(path)
+            logger.info(f"已归档日志分区: {name} -> {path}（{rows} 条）")
+        return archived
+
+    def _export_partition(self, name, path, batch_size=5000):
+        """按id分批读取（WHERE id > 上一批最大id），内存中只保留一批
+
+        psycopg2的普通游标会在execute时取回全部结果，fetchmany 不能分批读取。
+        """
+        tmp_path = path + '.tmp'
+        rows = 0
+        last_id = 0
+        with self.db_manager.get_connection() as conn, gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            cursor = conn.cursor()
+            while True:
+                cursor.execute(f"SELECT {', '.join(LOG_COLUMNS)} FROM {name} WHERE id > ? ORDER BY id LIMIT ?",
+                               (last_id, batch_size))
+                batch = cursor.fetchall()
+                if not batch:
+                    break
+                for row in batch:
+                    f.write(json.dumps(dict(zip(LOG_COLUMNS, row)), default=str, ensure_ascii=False))
+                    f.write('\n')
+                rows += len(batch)
+                last_id = batch[-1][0]
+        # 写完后再改名，避免中断时留下不完整的归档
+        os.replace(tmp_path, path)
+        return rows
+
+    def _drop_partition(self, name):
+        with self.db_manager.get_connection() as conn:
+            cursor = conn.cursor()
+            if self.dialect == 'postgresql':
+                cursor.execute(f"ALTER TABLE api_logs DETACH PARTITION {name}")
+                cursor.execute(f"DROP TABLE {name}")
+            else:
+                cursor.execute(f"DROP TABLE {name}")
+                self._rebuild_sqlite_view(cursor)
+            conn.commit()
+
+    def list_archives(self):
+        """返回 [(分区名, 周期起点, 周期终点, 文件路径)]"""
+        archives = []
+        for path in sorted(glob.glob(os.path.join(self.archive_dir, PARTITION_PREFIX + '*.jsonl.gz'))):
+            name = os.path.basename(path)[:-len('.jsonl.gz')]
+            if self._parse_partition(name):
+                archives.append((name,) + self._bounds(name) + (path,))
+        return archives
+
+    def iter_archived_logs(self, start=None, end=None, api_key_id=None, provider=None):
+        """逐行读取归档日志（不整体载入内存），按时间范围、密钥和提供商过滤"""
+        for name, period_start, period_end, path in self.list_archives():
+            if (start and period_end <= start) or (end and period_start >= end):
+                continue
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    log = json.loads(line)
+                    if api_key_id and log['api_key_id'] != api_key_id:
+                        continue
+                    if provider and log['provider'] != provider:
+                        continue
+                    if start or end:
+                        timestamp = _as_datetime(log['timestamp'])
+                        if (start and timestamp < start) or (end and timestamp >= end):
+                            continue
+                    yield log
+
+def _as_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
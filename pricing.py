@@ -0,0 +1,88 @@
+from collections import Counter, OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 每百万token价格（美元）：(输入, 输出)
+DEFAULT_PRICES = {
+    'openai': {
+        'gpt-4o-mini': (0.15, 0.60),
+        'gpt-4o': (2.50, 10.00),
+        'gpt-4-turbo': (10.00, 30.00),
+        'gpt-4': (30.00, 60.00),
+        'gpt-3.5-turbo': (0.50, 1.50),
+        'text-embedding-3-small': (0.02, 0.0),
+        'text-embedding-3-large': (0.13, 0.0),
+        'text-embedding-ada-002': (0.10, 0.0),
+    },
+    'anthropic': {
+        'claude-3-5-sonnet': (3.00, 15.00),
+        'claude-3-5-haiku': (0.80, 4.00),
+        'claude-3-opus': (15.00, 75.00),
+        'claude-3-sonnet': (3.00, 15.00),
+        'claude-3-haiku': (0.25, 1.25),
+    },
+    'google': {
+        'gemini-1.5-pro': (1.25, 5.00),
+        'gemini-1.5-flash': (0.075, 0.30),
+        'gemini-pro': (0.50, 1.50),
+    },
+}
+
+class PriceTable:
+    """按提供商/模型把token用量换算为费用
+
+    模型名来自客户端请求，解析结果只缓存匹配到价格的模型（LRU，最多 max_cache_size 个）；
+    未知模型不缓存，调用次数记入 unknown_models（最多记录 max_cache_size 个模型，
+    超出的只计入 unknown_calls），每个模型首次出现时记录一条警告。
+    """
+
+    def __init__(self, prices=None, max_cache_size=1024):
+        self.prices = prices if prices is not None else DEFAULT_PRICES
+        self.max_cache_size = max_cache_size
+        # 模型名按长度倒序，带版本后缀的模型名（如 gpt-4o-2024-08-06）按最长前缀匹配
+        self._models = {
+            provider: sorted(models, key=len, reverse=True)
+            for provider, models in self.prices.items()
+        }
+        self._resolved = OrderedDict()  # (provider, model) -> 价格
+        self.unknown_models = Counter()  # (provider, model) -> 调用次数
+        self.unknown_calls = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, provider, model):
+        """返回 (输入单价, 输出单价)，未知模型返回None"""
+        cache_key = (provider, model)
+        with self._lock:
+            price = self._resolved.get(cache_key)
+            if price is not None:
+                self._resolved.move_to_end(cache_key)
+                return price
+        for name in self._models.get(provider, ()):
+            if model and model.startswith(name):
+                price = self.prices[provider][name]
+                break
+        with self._lock:
+            if price is None:
+                self._record_unknown(cache_key)
+                return None
+            self._resolved[cache_key] = price
+            while len(self._resolved) > self.max_cache_size:
+                self._resolved.popitem(last=False)
+        return price
+
+    def _record_unknown(self, cache_key):
+        self.unknown_calls += 1
+        if cache_key in self.unknown_models:
+            self.unknown_models[cache_key] += 1
+        elif len(self.unknown_models) < self.max_cache_size:
+            self.unknown_models[cache_key] = 1
+            logger.warning(f"未配置模型价格，费用按0计算: provider={cache_key[0]}, model={cache_key[1]}")
+
+    def cost(self, provider, model, prompt_tokens=0, completion_tokens=0):
+        """计算一次调用的费用（美元）"""
+        price = self.lookup(provider, model)
+        if not price:
+            return 0.0
+        return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1000000
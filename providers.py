@@ -0,0 +1,315 @@
+from contextlib import contextmanager
+import os
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URLS = {
+    'openai': 'https://api.openai.com',
+    'anthropic': 'https://api.anthropic.com',
+    'google': 'https://generativelanguage.googleapis.com',
+}
+
+# 收到5xx时可以换密钥重试的方法；POST等非幂等请求可能已被上游执行，不重试
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+class NoUpstreamKeyAvailable(Exception):
+    """提供商的所有上游密钥都处于熔断状态"""
+
+    def __init__(self, provider, retry_after):
+        super().__init__(f"提供商 {provider} 没有可用的上游密钥，{retry_after:.0f}秒后重试")
+        self.provider = provider
+        self.retry_after = retry_after
+
+class UpstreamKey:
+    """一个上游凭据的实时状态：延迟/错误率的指数滑动平均和熔断器
+
+    收到429时熔断（使用 Retry-After，没有时按 cooldown 指数退避），熔断期间不参与
+    分配；到期后进入半开状态，只放行一个探测请求，成功则恢复，失败则再次熔断。
+    """
+
+    def __init__(self, provider, index, secret, latency=1.0, error_rate=0.0,
+                 alpha=0.2, cooldown=5.0, max_cooldown=300.0):
+        self.provider = provider
+        self.label = f"{provider}#{index}"  # 日志中使用，不输出密钥本身
+        self.secret = secret
+        self.latency = latency
+        self.error_rate = error_rate
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.open_until = 0.0
+        self.trips = 0
+        self.probing = False
+        self.in_flight = 0
+
+    def available(self, now):
+        return now >= self.open_until and not self.probing
+
+    def weight(self):
+        """延迟越低、错误率越低权重越高"""
+        return (1.0 - min(self.error_rate, 0.95)) ** 2 / max(self.latency, 0.001)
+
+    def record(self, latency, success):
+        self.latency += self.alpha * (latency - self.latency)
+        self.error_rate += self.alpha * ((0.0 if success else 1.0) - self.error_rate)
+        self.probing = False
+        if success:
+            self.trips = 0
+
+    def trip(self, now, retry_after=None, reason='触发限流'):
+        """熔断，返回熔断时长（秒）"""
+        self.trips += 1
+        duration = retry_after or min(self.cooldown * 2 ** (self.trips - 1), self.max_cooldown)
+        self.open_until = now + duration
+        self.probing = False
+        logger.warning(f"上游密钥 {self.label} {reason}，熔断 {duration:.0f} 秒")
+        return duration
+
+    def snapshot(self, now):
+        return {
+            'key': self.label,
+            'latency': round(self.latency, 4),
+            'error_rate': round(self.error_rate, 4),
+            'in_flight': self.in_flight,
+            'open_for': round(max(0.0, self.open_until - now), 1),
+        }
+
+def _auth_headers(provider, secret):
+    if provider == 'anthropic':
+        return {'x-api-key': secret, 'anthropic-version': '2023-06-01'}
+    if provider == 'google':
+        return {'x-goog-api-key': secret}
+    return {'Authorization': f'Bearer {secret}'}
+
+def _retry_after(response):
+    value = response.headers.get('retry-after')
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+def _close_response(response):
+    if response is not None and not isinstance(response, Exception):
+        response.close()
+
+class ProviderPool:
+    """单个提供商的长连接池和上游密钥负载均衡
+
+    - 每个提供商一个 httpx.Client，启用HTTP/2（安装了 h2 时）和keep-alive连接复用
+    - 请求按权重（实时延迟和错误率）随机分配到未熔断的上游密钥
+    - 429 熔断该密钥并换一个密钥重试；5xx和网络错误计入错误率，网络错误和幂等请求的
+      5xx换密钥重试，最多尝试 max_attempts 次；没有可换的密钥时返回最后一次的上游响应
+    """
+
+    def __init__(self, provider, secrets, base_url=None, http2=True, max_connections=100,
+                 max_keepalive=20, timeout=60.0, max_attempts=3, client=None, **key_options):
+        if not secrets:
+            raise ValueError(f"提供商 {provider} 没有配置上游密钥")
+        self.provider = provider
+        self.base_url = base_url or DEFAULT_BASE_URLS.get(provider)
+        self.max_attempts = max_attempts
+        self.keys = [UpstreamKey(provider, i, secret, **key_options) for i, secret in enumerate(secrets)]
+        self._lock = threading.Lock()
+        self.client = client or self._create_client(http2, max_connections, max_keepalive, timeout)
+
+    def _create_client(self, http2, max_connections, max_keepalive, timeout):
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError("上游连接池需要安装 httpx: pip install 'httpx[http2]'")
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("未安装 h2，上游连接使用HTTP/1.1 keep-alive")
+                http2 = False
+        return httpx.Client(
+            base_url=self.base_url,
+            http2=http2,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        )
+
+    def close(self):
+        self.client.close()
+
+    def choose(self, exclude=()):
+        """按权重选择一个可用的上游密钥，半开状态的密钥作为探测请求优先使用"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [k for k in self.keys if k not in exclude and k.available(now)]
+            if not candidates:
+                waiting = [k.open_until - now for k in self.keys if k not in exclude]
+                raise NoUpstreamKeyAvailable(self.provider, max(0.0, min(waiting, default=0.0)))
+            probe = next((k for k in candidates if k.trips and not k.probing), None)
+            if probe is not None:
+                probe.probing = True
+                key = probe
+            else:
+                key = random.choices(candidates, weights=[k.weight() for k in candidates])[0]
+            key.in_flight += 1
+            return key
+
+    def _finish(self, key, latency, response=None, error=None):
+        now = time.monotonic()
+        with self._lock:
+            key.in_flight -= 1
+            if response is not None and response.status_code == 429:
+                key.record(latency, False)
+                key.trip(now, _retry_after(response))
+                return True
+            failed = error is not None or (response is not None and response.status_code >= 500)
+            probing = key.probing
+            key.record(latency, not failed)
+            if failed and probing:
+                # 半开探测失败：按退避时长再次熔断，否则该密钥会一直被当作探测优先选中
+                key.trip(now, reason='探测失败')
+            return failed
+
+    @staticmethod
+    def _retryable(method, response):
+        return response.status_code == 429 or method.upper() in IDEMPOTENT_METHODS
+
+    def request(self, method, path, headers=None, **kwargs):
+        """发送请求并返回 httpx.Response，限流或失败时换上游密钥重试"""
+        tried = []
+        last_error = None
+        for _ in range(self.max_attempts):
+            try:
+                key = self.choose(exclude=tried)
+            except NoUpstreamKeyAvailable:
+                if last_error is None:
+                    raise
+                break
+            tried.append(key)
+            started = time.perf_counter()
+            try:
+                response = self.client.request(
+                    method, path, headers={**(headers or {}), **_auth_headers(self.provider, key.secret)}, **kwargs
+                )
+            except Exception as e:
+                self._finish(key, time.perf_counter() - started, error=e)
+                logger.error(f"请求上游 {key.label} 失败: {e}")
+                last_error = e
+                continue
+            failed = self._finish(key, time.perf_counter() - started, response=response)
+            if not failed or not self._retryable(method, response):
+                return response
+            last_error = response
+        if isinstance(last_error, Exception):
+            raise last_error
+        return last_error
+
+    @contextmanager
+    def stream(self, method, path, headers=None, **kwargs):
+        """流式请求（上下文管理器），返回的响应可用 iter_raw() 配合 streaming.stream_with_usage 转发
+
+        只有响应头到达之前的失败会换密钥重试；延迟按首字节时间记录。
+        """
+        response = self._open_stream(method, path, headers, **kwargs)
+        try:
+            yield response
+        finally:
+            response.close()
+
+    def _open_stream(self, method, path, headers=None, **kwargs):
+        tried = []
+        last = None
+        for _ in range(self.max_attempts):
+            try:
+                key = self.choose(exclude=tried)
+            except NoUpstreamKeyAvailable:
+                if last is None:
+                    raise
+                break
+            tried.append(key)
+            started = time.perf_counter()
+            request = self.client.build_request(
+                method, path, headers={**(headers or {}), **_auth_headers(self.provider, key.secret)}, **kwargs
+            )
+            try:
+                response = self.client.send(request, stream=True)
+            except Exception as e:
+                self._finish(key, time.perf_counter() - started, error=e)
+                logger.error(f"请求上游 {key.label} 失败: {e}")
+                _close_response(last)
+                last = e
+                continue
+            # 上一次失败的响应保留到拿到新的结果，没有可换的密钥时原样返回给调用方
+            _close_response(last)
+            last = response
+            failed = self._finish(key, time.perf_counter() - started, response=response)
+            if not failed or not self._retryable(method, response):
+                return response
+        if isinstance(last, Exception):
+            raise last
+        return last
+
+    def seed(self, latency=None, error_rate=None):
+        """用已收集的统计数据初始化各密钥的延迟和错误率"""
+        with self._lock:
+            for key in self.keys:
+                if latency:
+                    key.latency = latency
+                if error_rate is not None:
+                    key.error_rate = error_rate
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            return [key.snapshot(now) for key in self.keys]
+
+class ProviderDispatcher:
+    """按提供商分发上游请求"""
+
+    def __init__(self, pools):
+        self.pools = {pool.provider: pool for pool in pools}
+
+    @classmethod
+    def from_env(cls, environ=None, **pool_options):
+        """从环境变量创建：<PROVIDER>_API_KEYS（逗号分隔，多个上游密钥）或 <PROVIDER>_API_KEY，
+        可选 <PROVIDER>_BASE_URL（例如指向本地模拟服务）"""
+        environ = os.environ if environ is None else environ
+        pools = []
+        for provider in DEFAULT_BASE_URLS:
+            prefix = provider.upper()
+            secrets = environ.get(f'{prefix}_API_KEYS') or environ.get(f'{prefix}_API_KEY') or ''
+            secrets = [s.strip() for s in secrets.split(',') if s.strip()]
+            if secrets:
+                pools.append(ProviderPool(provider, secrets, base_url=environ.get(f'{prefix}_BASE_URL'), **pool_options))
+        return cls(pools)
+
+    def pool(self, provider):
+        try:
+            return self.pools[provider]
+        except KeyError:
+            raise ValueError(f"未配置提供商: {provider}")
+
+    def request(self, provider, method, path, **kwargs):
+        return self.pool(provider).request(method, path, **kwargs)
+
+    def stream(self, provider, method, path, **kwargs):
+        return self.pool(provider).stream(method, path, **kwargs)
+
+    def seed_from_stats(self, api_key_manager, days=1):
+        """用 api_stats_daily 中各提供商的延迟中位数和错误率作为初始权重"""
+        for provider, pool in self.pools.items():
+            try:
+                latency = api_key_manager.get_latency_percentiles(provider=provider, days=days).get('p50')
+                rows = api_key_manager.get_api_stats(provider=provider, days=days)
+                total = sum(row['total_calls'] or 0 for row in rows)
+                success = sum(row['success_calls'] or 0 for row in rows)
+                pool.seed(latency, 1.0 - success / total if total else None)
+            except Exception as e:
+                logger.error(f"加载提供商 {provider} 的历史统计失败: {e}")
+
+    def status(self):
+        return {provider: pool.status() for provider, pool in self.pools.items()}
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
@@ -0,0 +1,152 @@
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 不影响响应内容的请求字段，不参与缓存键
+IGNORED_FIELDS = ('api_key', 'user', 'metadata', 'stream_options')
+
+def is_cacheable(payload):
+    """只缓存确定性的非流式请求（temperature 为 0、单个候选）"""
+    if not isinstance(payload, dict) or payload.get('stream'):
+        return False
+    if payload.get('n', 1) != 1:
+        return False
+    temperature = payload.get('temperature')
+    try:
+        return temperature is not None and float(temperature) == 0
+    except (TypeError, ValueError):
+        return False
+
+def canonical_request_hash(provider, payload, namespace=None):
+    """对 (提供商, 模型, 消息, 参数) 规范化后计算SHA-256
+
+    字段按键排序，去掉值为None的字段和 IGNORED_FIELDS，数值统一为浮点表示，键顺序或
+    1 与 1.0 的差异不会产生不同的缓存键；字符串原样参与哈希，只有首尾空白不同的
+    提示词也是不同的请求。namespace 用于按密钥隔离缓存。
+    """
+    normalized = {k: _normalize(v) for k, v in payload.items() if k not in IGNORED_FIELDS and v is not None}
+    data = json.dumps([provider, namespace, normalized], sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def _normalize(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+class ResponseCache:
+    """确定性补全请求的响应缓存
+
+    内存层为LRU，同时限制条目数和总字节数（超过 max_item_bytes 的响应不缓存）；
+    可选的Redis层在多个节点间共享，内存未命中时读取并回填内存层。只有开启了
+    response_cache_enabled 的密钥使用缓存，默认按密钥隔离（shared=True 时所有
+    开启缓存的密钥共用）。
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, max_item_bytes=1024 * 1024,
+                 ttl=3600, redis_client=None, redis_prefix='akm:resp:', shared=False):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.ttl = ttl
+        self.redis = redis_client
+        self.redis_prefix = redis_prefix
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # cache_key -> (body, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, redis_url=None, **options):
+        client = None
+        if redis_url:
+            import redis
+            client = redis.Redis.from_url(redis_url)
+        return cls(redis_client=client, **options)
+
+    def lookup(self, key_obj, provider, payload):
+        """返回 (缓存键, 缓存的响应体)
+
+        密钥未开启缓存或请求不可缓存时缓存键为None；未命中时响应体为None，
+        上游成功后用返回的缓存键调用 store()。
+        """
+        if not key_obj['response_cache_enabled'] or not is_cacheable(payload):
+            return None, None
+        cache_key = canonical_request_hash(provider, payload, None if self.shared else key_obj['id'])
+        body = self.get(cache_key)
+        with self._lock:
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return cache_key, body
+
+    def get(self, cache_key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                if now < entry[1]:
+                    self._entries.move_to_end(cache_key)
+                    return entry[0]
+                self._remove(cache_key)
+        if self.redis is None:
+            return None
+        try:
+            pipe = self.redis.pipeline()
+            pipe.get(self.redis_prefix + cache_key)
+            pipe.ttl(self.redis_prefix + cache_key)
+            body, ttl = pipe.execute()
+        except Exception as e:
+            logger.error(f"读取Redis响应缓存失败: {e}")
+            return None
+        if body is not None:
+            self._set_local(cache_key, body, ttl if ttl and ttl > 0 else self.ttl)
+        return body
+
+    def store(self, cache_key, body, ttl=None):
+        """缓存响应体（bytes）"""
+        if cache_key is None or len(body) > self.max_item_bytes:
+            return
+        ttl = ttl or self.ttl
+        self._set_local(cache_key, body, ttl)
+        if self.redis is not None:
+            try:
+                self.redis.set(self.redis_prefix + cache_key, body, ex=int(ttl))
+            except Exception as e:
+                logger.error(f"写入Redis响应缓存失败: {e}")
+
+    def _set_local(self, cache_key, body, ttl):
+        with self._lock:
+            self._remove(cache_key)
+            self._entries[cache_key] = (body, time.monotonic() + ttl)
+            self._bytes += len(body)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, cache_key):
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
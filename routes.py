@@ -1,16 +1,62 @@
 from datetime import datetime, timedelta
 from functools import wraps
+import json
+import math
+import time
+import click
 from flask import (
     Blueprint, render_template, request, jsonify, 
-    redirect, url_for, session, g, current_app
+    redirect, url_for, session, g, current_app,
+    Response, stream_with_context
 )
+from sqlalchemy.orm import joinedload, load_only
 import logging
 
-from models import db, ApiKey, ApiLog, ApiStat, SystemLog, User
+from analytics import DIMENSIONS, METRICS, TIME_BUCKETS, UsageAnalytics
+from exports import EXPORT_FORMATS, parse_time, stream_rows
+from pagination import decode_cursor, keyset_paginate
+from partitions import LogPartitionManager
+from models import db, ApiKey, ApiLog, ApiStat, ApiStatDaily, ApiStatHourly, SystemLog, User
+import schema
+from sketch import LatencySketch
 
 logger = logging.getLogger(__name__)
 bp = Blueprint('admin', __name__, url_prefix='/admin')
 
+# 会话中缓存的管理员身份多久重新核对一次数据库（秒），可通过 ADMIN_IDENTITY_TTL 配置
+ADMIN_IDENTITY_TTL = 300
+
+# 列表和详情页只读取模板用到的列
+KEY_LIST_COLUMNS = (
+    ApiKey.id, ApiKey.name, ApiKey.key_prefix, ApiKey.status, ApiKey.created_by,
+    ApiKey.created_at, ApiKey.expires_at, ApiKey.daily_limit,
+    ApiKey.requests_per_second, ApiKey.requests_per_minute, ApiKey.total_calls
+)
+KEY_DETAIL_COLUMNS = KEY_LIST_COLUMNS + (ApiKey.last_used_at, ApiKey.response_cache_enabled)
+RECENT_LOG_LIMIT = 100
+ERROR_PREVIEW_CHARS = 200  # 最近调用中错误信息只取前N个字符用于提示
+
+def _admin_identity():
+    """返回当前会话的管理员身份 {'user_id', 'username', 'checked_at'}，不是管理员时返回None
+
+    身份缓存在会话中，ADMIN_IDENTITY_TTL 内的管理请求不再查询 users 表；
+    取消管理员权限最迟在一个TTL后生效。
+    """
+    user_id = session['user_id']
+    now = time.time()
+    ttl = current_app.config.get('ADMIN_IDENTITY_TTL', ADMIN_IDENTITY_TTL)
+    identity = session.get('admin_identity')
+    if identity and identity.get('user_id') == user_id and now - identity.get('checked_at', 0) < ttl:
+        return identity
+        
+    user = db.session.query(User.username, User.is_admin).filter(User.id == user_id).first()
+    if not user or not user.is_admin:
+        session.pop('admin_identity', None)
+        return None
+    identity = {'user_id': user_id, 'username': user.username, 'checked_at': now}
+    session['admin_identity'] = identity
+    return identity
+
 def require_admin(f):
     """管理员权限验证装饰器"""
     @wraps(f)
@@ -18,22 +64,46 @@ def require_admin(f):
         if not session.get('user_id'):
             return redirect(url_for('auth.login'))
             
-        user = User.query.get(session['user_id'])
-        if not user or not user.is_admin:
+        identity = _admin_identity()
+        if identity is None:
             return jsonify({'error': '需要管理员权限'}), 403
             
+        g.admin = identity
         return f(*args, **kwargs)
     return decorated_function
 
 @bp.route('/api-keys')
 @require_admin
 def list_api_keys():
-    """列出所有API密钥"""
+    """列出所有API密钥（按创建时间倒序游标分页，支持搜索和状态过滤）"""
     try:
-        api_keys = ApiKey.query.order_by(ApiKey.created_at.desc()).all()
+        search = request.args.get('q', '').strip()
+        status = request.args.get('status', 'all')
+        
+        query = ApiKey.query.options(
+            load_only(*KEY_LIST_COLUMNS),
+            joinedload(ApiKey.creator).load_only(User.username)
+        )
+        if search:
+            query = query.filter(db.or_(
+                ApiKey.name.contains(search, autoescape=True),
+                ApiKey.key_prefix.startswith(search, autoescape=True)
+            ))
+        if status != 'all':
+            query = query.filter(ApiKey.status == status)
+            
+        try:
+            page = keyset_paginate(query, (ApiKey.created_at, ApiKey.id),
+                                   cursor=request.args.get('cursor'), per_page=50)
+        except ValueError:
+            return redirect(url_for('admin.list_api_keys', q=search, status=status))
+            
         return render_template(
             'admin/api_keys.html',
-            api_keys=api_keys,
+            api_keys=page.items,
+            page=page,
+            search=search,
+            status=status,
             message=session.pop('message', None),
             error=session.pop('error', None)
         )
@@ -51,23 +121,36 @@ def create_api_key():
             name = request.form.get('name', '').strip()
             validity_days = int(request.form.get('validity_days', 365))
             daily_limit = int(request.form.get('daily_limit', 1000))
+            requests_per_second = request.form.get('requests_per_second', type=int)
+            requests_per_minute = request.form.get('requests_per_minute', type=int)
+            daily_token_limit = request.form.get('daily_token_limit', type=int)
+            monthly_token_limit = request.form.get('monthly_token_limit', type=int)
+            daily_cost_limit = request.form.get('daily_cost_limit', type=float)
+            monthly_cost_limit = request.form.get('monthly_cost_limit', type=float)
+            response_cache_enabled = bool(request.form.get('response_cache_enabled'))
             
-            # 创建新的API密钥
-            import secrets
-            key = ApiKey(
-                key=secrets.token_hex(16),
-                name=name,
-                created_by=session['user_id'],
-                expires_at=datetime.utcnow() + timedelta(days=validity_days) if validity_days > 0 else None,
-                daily_limit=daily_limit
+            # 数据库只保存前缀和哈希，明文密钥只在本次响应中显示，不写入会话
+            key = current_app.api_key_manager.create_key(
+                name,
+                session['user_id'],
+                validity_days=validity_days,
+                daily_limit=daily_limit,
+                requests_per_second=requests_per_second or None,
+                requests_per_minute=requests_per_minute or None,
+                daily_token_limit=daily_token_limit or None,
+                monthly_token_limit=monthly_token_limit or None,
+                daily_cost_limit=daily_cost_limit or None,
+                monthly_cost_limit=monthly_cost_limit or None,
+                response_cache_enabled=response_cache_enabled
             )
             
-            db.session.add(key)
-            db.session.commit()
-            
             SystemLog.log(f"创建新API密钥: {name}", level="INFO", source="create_api_key")
-            session['message'] = 'API密钥创建成功'
-            return redirect(url_for('admin.list_api_keys'))
+            return render_template(
+                'admin/create_api_key.html',
+                message='API密钥创建成功',
+                new_api_key=key['key'],
+                new_api_key_id=key['id']
+            ), 200, {'Cache-Control': 'no-store'}
             
         except Exception as e:
             logger.error(f"创建API密钥失败: {e}")
@@ -88,6 +171,7 @@ def toggle_api_key(key_id):
         key.status = 'disabled' if key.status == 'active' else 'active'
         key.updated_at = datetime.utcnow()
         db.session.commit()
+        current_app.api_key_manager.invalidate_key(key_id)
         
         SystemLog.log(
             f"切换API密钥状态: {key.name} -> {key.status}",
@@ -100,6 +184,28 @@ def toggle_api_key(key_id):
         logger.error(f"切换API密钥状态失败: {e}")
         return jsonify({'error': str(e)}), 500
 
+@bp.route('/api-keys/<int:key_id>/response-cache', methods=['POST'])
+@require_admin
+def toggle_response_cache(key_id):
+    """开启/关闭API密钥的响应缓存"""
+    try:
+        key = ApiKey.query.get_or_404(key_id)
+        key.response_cache_enabled = not key.response_cache_enabled
+        key.updated_at = datetime.utcnow()
+        db.session.commit()
+        current_app.api_key_manager.invalidate_key(key_id)
+        
+        SystemLog.log(
+            f"切换API密钥响应缓存: {key.name} -> {'开启' if key.response_cache_enabled else '关闭'}",
+            level="INFO",
+            source="toggle_response_cache"
+        )
+        return jsonify({'status': 'success', 'enabled': key.response_cache_enabled})
+        
+    except Exception as e:
+        logger.error(f"切换API密钥响应缓存失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @bp.route('/api-keys/<int:key_id>/delete', methods=['POST'])
 @require_admin
 def delete_api_key(key_id):
@@ -109,6 +215,7 @@ def delete_api_key(key_id):
         name = key.name
         db.session.delete(key)
         db.session.commit()
+        current_app.api_key_manager.invalidate_key(key_id)
         
         SystemLog.log(f"删除API密钥: {name}", level="INFO", source="delete_api_key")
         return jsonify({'status': 'success'})
@@ -117,30 +224,167 @@ def delete_api_key(key_id):
         logger.error(f"删除API密钥失败: {e}")
         return jsonify({'error': str(e)}), 500
 
+MAX_BULK_KEYS = 100000
+
+def _limit(data, name, convert, default=None):
+    """读取一个非负的数值参数，未提供时返回 default；类型错误或为负数时抛出 ValueError"""
+    value = data.get(name)
+    if value is None or value == '':
+        return default
+    if isinstance(value, (bool, list, dict)):
+        raise ValueError(f"{name} 必须是数字")
+    value = convert(value)
+    if not math.isfinite(value) or value < 0:
+        raise ValueError(f"{name} 必须是非负数")
+    return value
+
+def _stream_new_keys(keys):
+    """以JSONL流式返回新生成的密钥（明文密钥只在此响应中出现一次）"""
+    def generate():
+        for key in keys:
+            yield json.dumps(key, default=lambda v: v.isoformat(), ensure_ascii=False) + '\n'
+            
+    return Response(
+        generate(),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': 'attachment; filename=api_keys.jsonl', 'Cache-Control': 'no-store'}
+    )
+
+@bp.route('/api-keys/bulk/create', methods=['POST'])
+@require_admin
+def bulk_create_api_keys():
+    """批量创建API密钥
+
+    JSON参数: count, name（密钥名为 name-序号）, validity_days, daily_limit,
+    以及与单个创建相同的速率和预算限制、response_cache_enabled
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        count = int(data.get('count', 0))
+        if not 0 < count <= MAX_BULK_KEYS:
+            return jsonify({'error': f'count 必须在 1 到 {MAX_BULK_KEYS} 之间'}), 400
+        keys = current_app.api_key_manager.create_keys(
+            count,
+            created_by=session['user_id'],
+            name=data.get('name'),
+            validity_days=int(data.get('validity_days', 365)),
+            daily_limit=_limit(data, 'daily_limit', int, 1000),
+            requests_per_second=_limit(data, 'requests_per_second', int) or None,
+            requests_per_minute=_limit(data, 'requests_per_minute', int) or None,
+            daily_token_limit=_limit(data, 'daily_token_limit', int) or None,
+            monthly_token_limit=_limit(data, 'monthly_token_limit', int) or None,
+            daily_cost_limit=_limit(data, 'daily_cost_limit', float) or None,
+            monthly_cost_limit=_limit(data, 'monthly_cost_limit', float) or None,
+            response_cache_enabled=bool(data.get('response_cache_enabled'))
+        )
+        SystemLog.log(f"批量创建API密钥: {data.get('name')} x {count}", level="INFO", source="bulk_create_api_keys")
+        return _stream_new_keys(keys)
+        
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'参数错误: {e}'}), 400
+    except Exception as e:
+        logger.error(f"批量创建API密钥失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api-keys/bulk/revoke', methods=['POST'])
+@require_admin
+def bulk_revoke_api_keys():
+    """按条件批量禁用API密钥
+
+    JSON参数（AND关系，至少一个）: ids, q（名称或前缀）, created_by, created_before（ISO时间）
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        created_before = data.get('created_before')
+        revoked = current_app.api_key_manager.revoke_keys(
+            key_ids=[int(i) for i in data['ids']] if 'ids' in data else None,
+            search=data.get('q'),
+            created_by=data.get('created_by'),
+            created_before=datetime.fromisoformat(created_before) if created_before else None
+        )
+        SystemLog.log(f"批量禁用API密钥: {len(revoked)} 个", level="INFO", source="bulk_revoke_api_keys")
+        return jsonify({'status': 'success', 'revoked': len(revoked), 'ids': revoked})
+        
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'参数错误: {e}'}), 400
+    except Exception as e:
+        logger.error(f"批量禁用API密钥失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api-keys/bulk/rotate', methods=['POST'])
+@require_admin
+def bulk_rotate_api_keys():
+    """批量轮换API密钥，旧密钥在宽限期内继续有效
+
+    JSON参数: ids, grace_hours（默认24）
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        key_ids = [int(i) for i in data.get('ids', [])]
+        if not 0 < len(key_ids) <= MAX_BULK_KEYS:
+            return jsonify({'error': f'ids 数量必须在 1 到 {MAX_BULK_KEYS} 之间'}), 400
+        keys = current_app.api_key_manager.rotate_keys(
+            key_ids,
+            grace_period=timedelta(hours=float(data.get('grace_hours', 24)))
+        )
+        SystemLog.log(f"批量轮换API密钥: {len(keys)} 个", level="INFO", source="bulk_rotate_api_keys")
+        return _stream_new_keys(keys)
+        
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'参数错误: {e}'}), 400
+    except Exception as e:
+        logger.error(f"批量轮换API密钥失败: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @bp.route('/api-keys/<int:key_id>')
 @require_admin
 def view_api_key(key_id):
     """查看API密钥详情"""
     try:
-        key = ApiKey.query.get_or_404(key_id)
+        key = ApiKey.query.options(
+            load_only(*KEY_DETAIL_COLUMNS),
+            joinedload(ApiKey.creator).load_only(User.username)
+        ).filter(ApiKey.id == key_id).first_or_404()
         
-        # 获取最近的调用日志
-        recent_logs = ApiLog.query.filter_by(api_key_id=key_id)\
+        # 获取最近的调用日志（只取列表展示的列，错误信息截断）
+        recent_logs = db.session.query(
+            ApiLog.timestamp, ApiLog.provider, ApiLog.model, ApiLog.client_ip,
+            ApiLog.request_path, ApiLog.success, ApiLog.response_time,
+            db.func.substr(ApiLog.error_message, 1, ERROR_PREVIEW_CHARS).label('error_message')
+        ).filter(ApiLog.api_key_id == key_id)\
             .order_by(ApiLog.timestamp.desc())\
-            .limit(100)\
+            .limit(RECENT_LOG_LIMIT)\
             .all()
             
-        # 获取使用统计
-        stats = ApiStat.query.filter_by(api_key_id=key_id)\
-            .order_by(ApiStat.date.desc())\
-            .limit(30)\
+        # 获取使用统计（模板中会序列化为JSON供图表使用）
+        stats = [{
+            'date': stat.date.isoformat(),
+            'provider': stat.provider,
+            'total_calls': stat.total_calls,
+            'success_calls': stat.success_calls,
+            'total_tokens': stat.total_tokens,
+            'total_cost': stat.total_cost
+        } for stat in db.session.query(
+            ApiStat.date, ApiStat.provider, ApiStat.total_calls,
+            ApiStat.success_calls, ApiStat.total_tokens, ApiStat.total_cost
+        ).filter(ApiStat.api_key_id == key_id)
+            .order_by(ApiStat.date.desc())
+            .limit(30)
+            .all()]
+            
+        # 合并最近30天的小时级延迟直方图
+        sketches = db.session.query(ApiStatHourly.latency_sketch)\
+            .filter(ApiStatHourly.api_key_id == key_id)\
+            .filter(ApiStatHourly.hour >= datetime.utcnow() - timedelta(days=30))\
             .all()
+        latency = LatencySketch.merge_all(row[0] for row in sketches).percentiles()
             
         return render_template(
             'admin/view_api_key.html',
             key=key,
             recent_logs=recent_logs,
-            stats=stats
+            stats=stats,
+            latency=latency
         )
         
     except Exception as e:
@@ -156,28 +400,34 @@ def view_stats():
         provider = request.args.get('provider', 'all')
         days = int(request.args.get('days', 7))
         
-        # 构建查询
-        query = db.session.query(
-            ApiStat.date,
-            ApiStat.provider,
-            db.func.sum(ApiStat.total_calls).label('total_calls'),
-            db.func.sum(ApiStat.success_calls).label('success_calls'),
-            db.func.avg(ApiStat.average_latency).label('avg_latency'),
-            db.func.sum(ApiStat.total_tokens).label('total_tokens'),
-            db.func.sum(ApiStat.total_cost).label('total_cost')
-        )\
-        .filter(ApiStat.date >= datetime.utcnow().date() - timedelta(days=days))
+        # 按天汇总表已按 (日期, 提供商) 预聚合，这里只做范围读取
+        query = ApiStatDaily.query\
+            .filter(ApiStatDaily.date >= datetime.utcnow().date() - timedelta(days=days))
         
         if provider != 'all':
-            query = query.filter(ApiStat.provider == provider)
+            query = query.filter(ApiStatDaily.provider == provider)
             
-        stats = query.group_by(ApiStat.date, ApiStat.provider)\
-            .order_by(ApiStat.date.desc(), ApiStat.provider)\
-            .all()
+        stats = []
+        overall = LatencySketch()
+        for stat in query.order_by(ApiStatDaily.date.desc(), ApiStatDaily.provider).all():
+            sketch = LatencySketch.from_bytes(stat.latency_sketch)
+            overall.merge(sketch)
+            stats.append({
+                'date': stat.date.isoformat(),
+                'provider': stat.provider,
+                'total_calls': stat.total_calls,
+                'success_calls': stat.success_calls,
+                'latency_sum': stat.latency_sum,
+                'avg_latency': stat.average_latency,
+                'p95_latency': sketch.quantile(0.95),
+                'total_tokens': stat.total_tokens,
+                'total_cost': stat.total_cost
+            })
             
         return render_template(
             'admin/stats.html',
             stats=stats,
+            latency=overall.percentiles(),
             provider=provider,
             days=days
         )
@@ -192,7 +442,6 @@ def view_stats():
 def view_logs():
     """查看系统日志"""
     try:
-        page = request.args.get('page', 1, type=int)
         level = request.args.get('level', 'all')
         source = request.args.get('source', 'all')
         
@@ -204,14 +453,17 @@ def view_logs():
         if source != 'all':
             query = query.filter(SystemLog.source == source)
             
-        # 分页
-        pagination = query.order_by(SystemLog.timestamp.desc())\
-            .paginate(page=page, per_page=50, error_out=False)
+        # 按 (时间, id) 游标分页，深翻页不需要OFFSET扫描，总数为估算值
+        try:
+            page = keyset_paginate(query, (SystemLog.timestamp, SystemLog.id),
+                                   cursor=request.args.get('cursor'), per_page=50)
+        except ValueError:
+            return redirect(url_for('admin.view_logs', level=level, source=source))
             
         return render_template(
             'admin/logs.html',
-            logs=pagination.items,
-            pagination=pagination,
+            logs=page.items,
+            page=page,
             level=level,
             source=source
         )
@@ -221,6 +473,250 @@ def view_logs():
         session['error'] = '获取系统日志失败'
         return redirect(url_for('admin.dashboard'))
 
+LOG_EXPORT_COLUMNS = (
+    'id', 'api_key_id', 'timestamp', 'client_ip', 'provider', 'model',
+    'request_path', 'request_method', 'response_code', 'response_time',
+    'time_to_first_token', 'success', 'error_message', 'tokens', 'cost', 'cache_hit'
+)
+STAT_EXPORT_COLUMNS = (
+    'id', 'api_key_id', 'date', 'provider', 'total_calls', 'success_calls',
+    'average_latency', 'total_tokens', 'total_cost', 'cache_hits'
+)
+
+def _export_response(model, columns, time_column, name):
+    """按id顺序流式导出查询结果
+
+    查询参数: format=csv|jsonl, gzip=1, api_key_id, provider, start, end（ISO时间，end不含），
+    cursor（导出中断后传入最后收到一行的cursor字段继续）
+    """
+    fmt = request.args.get('format', 'csv')
+    compress = request.args.get('gzip', '0').lower() in ('1', 'true', 'yes')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f'不支持的导出格式: {fmt}'}), 400
+    try:
+        start = parse_time(request.args.get('start'))
+        end = parse_time(request.args.get('end'), end=True)
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor, (int,))[0][0] if cursor else None
+    except ValueError as e:
+        return jsonify({'error': f'参数错误: {e}'}), 400
+        
+    query = db.select(*[getattr(model, c) for c in columns])
+    api_key_id = request.args.get('api_key_id', type=int)
+    if api_key_id:
+        query = query.where(model.api_key_id == api_key_id)
+    provider = request.args.get('provider')
+    if provider:
+        query = query.where(model.provider == provider)
+    date_only = isinstance(time_column.type, db.Date)
+    if date_only:
+        start = start and start.date()
+        # end 不含，换算为最后一个包含的日期
+        end = end and (end - timedelta(microseconds=1)).date()
+    if start:
+        query = query.where(time_column >= start)
+    if end:
+        query = query.where(time_column <= end if date_only else time_column < end)
+    if after:
+        query = query.where(model.id > after)
+    # yield_per 使用服务端游标分批读取，内存占用与导出行数无关
+    query = query.order_by(model.id).execution_options(yield_per=1000)
+    
+    def generate():
+        try:
+            yield from stream_rows(db.session.execute(query), columns, fmt, compress)
+        except Exception as e:
+            logger.error(f"导出{name}失败: {e}")
+            raise
+            
+    filename = f"{name}.{fmt}{'.gz' if compress else ''}"
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/gzip' if compress else EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+@bp.route('/export/logs')
+@require_admin
+def export_logs():
+    """流式导出API调用日志"""
+    return _export_response(ApiLog, LOG_EXPORT_COLUMNS, ApiLog.timestamp, 'api_logs')
+
+@bp.route('/export/stats')
+@require_admin
+def export_stats():
+    """流式导出每个密钥的每日使用统计"""
+    return _export_response(ApiStat, STAT_EXPORT_COLUMNS, ApiStat.date, 'api_stats')
+
+def _partition_manager():
+    return LogPartitionManager(
+        current_app.api_key_manager.db_manager,
+        period=current_app.config.get('API_LOG_PARTITION_PERIOD', 'month'),
+        archive_dir=current_app.config.get('API_LOG_ARCHIVE_DIR', 'logs/archive')
+    )
+
+@bp.route('/archives')
+@require_admin
+def list_log_archives():
+    """列出已归档的API调用日志"""
+    archives = _partition_manager().list_archives()
+    return jsonify([{
+        'partition': name,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'url': url_for('admin.export_log_archives', start=start.isoformat(), end=end.isoformat())
+    } for name, start, end, path in archives])
+
+@bp.route('/archives/export')
+@require_admin
+def export_log_archives():
+    """以JSONL流式导出归档日志，支持时间范围、密钥和提供商过滤"""
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        logs = _partition_manager().iter_archived_logs(
+            start=datetime.fromisoformat(start) if start else None,
+            end=datetime.fromisoformat(end) if end else None,
+            api_key_id=request.args.get('api_key_id', type=int),
+            provider=request.args.get('provider')
+        )
+    except ValueError as e:
+        return jsonify({'error': f'参数错误: {e}'}), 400
+        
+    def generate():
+        for log in logs:
+            yield json.dumps(log, ensure_ascii=False) + '\n'
+            
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def _usage_analytics():
+    analytics = current_app.extensions.get('usage_analytics')
+    if analytics is None:
+        analytics = UsageAnalytics(
+            current_app.api_key_manager.db_manager,
+            data_dir=current_app.config.get('ANALYTICS_DIR', 'logs/analytics')
+        )
+    return analytics
+
+def _analytics_params():
+    """从查询参数解析分析查询: group_by/metrics（可重复）, bucket, days, 以及按维度过滤"""
+    days = request.args.get('days', 7, type=int)
+    filters = {}
+    for name in DIMENSIONS:
+        values = [v for v in request.args.getlist(name) if v != '']
+        if values:
+            filters[name] = values if len(values) > 1 else values[0]
+    return {
+        'group_by': request.args.getlist('group_by') or ['provider'],
+        'metrics': request.args.getlist('metrics') or ['calls', 'error_rate', 'p50_latency'],
+        'bucket': request.args.get('bucket') or None,
+        'filters': filters,
+        'start': datetime.utcnow() - timedelta(days=days),
+        'order_by': request.args.get('order_by') or None,
+        'limit': min(request.args.get('limit', 500, type=int), 10000)
+    }
+
+@bp.route('/analytics')
+@require_admin
+def view_analytics():
+    """即席用量分析（查询列式镜像，不访问主库）"""
+    params = _analytics_params()
+    rows, error = [], None
+    try:
+        rows = _usage_analytics().query(**params)
+    except (ImportError, ValueError) as e:
+        error = str(e)
+    except Exception as e:
+        logger.error(f"分析查询失败: {e}")
+        error = '分析查询失败'
+        
+    return render_template(
+        'admin/analytics.html',
+        rows=rows,
+        columns=(['bucket'] if params['bucket'] else []) + params['group_by'] + params['metrics'],
+        params=params,
+        days=request.args.get('days', 7, type=int),
+        dimensions=DIMENSIONS,
+        metrics=list(METRICS),
+        buckets=TIME_BUCKETS,
+        status=_usage_analytics().status(),
+        error=error
+    )
+
+@bp.route('/analytics/query')
+@require_admin
+def query_analytics():
+    """即席用量分析的JSON接口，参数同分析页面"""
+    try:
+        rows = _usage_analytics().query(**_analytics_params())
+    except (ImportError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"分析查询失败: {e}")
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'rows': [
+        {k: v.isoformat() if isinstance(v, datetime) else v for k, v in row.items()} for row in rows
+    ]})
+
+@bp.cli.command('sync-analytics')
+@click.option('--compact', is_flag=True, help='同步后合并小的Parquet段')
+def sync_analytics_command(compact):
+    """把新的api_logs增量同步到列式分析镜像（建议定时执行）"""
+    analytics = _usage_analytics()
+    click.echo(f"已同步日志 {analytics.sync()} 条")
+    if compact:
+        click.echo(f"合并生成段 {analytics.compact()} 个")
+    status = analytics.status()
+    click.echo(f"段文件 {status['segments']} 个，高水位 id={status['high_water_mark']}")
+
+@bp.cli.command('partition-logs')
+def partition_logs_command():
+    """把api_logs转换为按时间分区（只需执行一次），并创建后续分区"""
+    manager = _partition_manager()
+    if manager.enable():
+        click.echo("api_logs 已转换为分区表")
+    created = manager.ensure_partitions()
+    click.echo(f"新建分区: {', '.join(created) or '无'}")
+
+@bp.cli.command('archive-logs')
+@click.option('--keep', type=int, default=3, help='保留最近N个周期的分区')
+def archive_logs_command(keep):
+    """归档并删除过期的api_logs分区（建议每天定时执行）"""
+    manager = _partition_manager()
+    manager.ensure_partitions()
+    for path in manager.archive(keep=keep):
+        click.echo(f"已归档: {path}")
+
+@bp.cli.command('upgrade-schema')
+def upgrade_schema_command():
+    """创建缺少的表并执行尚未执行的数据库结构修订（可重复执行）"""
+    executed = schema.upgrade(db.engine)
+    click.echo(f"已执行修订: {', '.join(executed) or '无'}")
+
+@bp.cli.command('create-indexes')
+def create_indexes_command():
+    """补建模型中声明的索引（已存在的跳过；upgrade-schema 的修订中已包含）"""
+    with db.engine.begin() as conn:
+        schema.create_model_indexes(conn)
+    click.echo("索引已就绪")
+
+@bp.cli.command('rebuild-rollups')
+@click.option('--days', type=int, default=None, help='只重建最近N天（默认全量重建）')
+def rebuild_rollups_command(days):
+    """根据api_logs重建按小时/按天统计汇总表"""
+    since = datetime.utcnow().date() - timedelta(days=days) if days else None
+    processed = current_app.api_key_manager.rebuild_rollups(since=since)
+    click.echo(f"已重建统计汇总表，处理日志 {processed} 条")
+
+@bp.cli.command('migrate-key-hashes')
+def migrate_key_hashes_command():
+    """把明文存储的旧API密钥转换为前缀+HMAC哈希（先执行尚未执行的结构修订）"""
+    executed = schema.upgrade(db.engine)
+    if executed:
+        click.echo(f"已执行修订: {', '.join(executed)}")
+    migrated = current_app.api_key_manager.migrate_plaintext_keys()
+    click.echo(f"已迁移明文API密钥 {migrated} 个")
+
 def init_app(app):
     """初始化路由"""
     app.register_blueprint(bp)
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""数据库结构升级
+
+flask admin upgrade-schema 按顺序执行 MIGRATIONS 中尚未执行的修订，已执行的修订记录在
+schema_migrations 表中。升级前先用 db.create_all() 创建缺少的表；每个修订都先检查现有
+结构再修改，对新建的数据库执行也是安全的。
+"""
+from datetime import datetime
+import logging
+
+from sqlalchemy import MetaData, inspect, text
+from sqlalchemy.schema import CreateTable
+
+from models import db, ApiKey, ApiLog, ApiStat, ApiStatDaily, ApiStatHourly
+from partitions import LOG_COLUMNS, PARTITION_PREFIX, LogPartitionManager
+
+logger = logging.getLogger(__name__)
+
+def upgrade(engine):
+    """创建缺少的表并执行尚未执行的修订，返回本次执行的修订名"""
+    db.metadata.create_all(engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations (version VARCHAR(64) PRIMARY KEY, applied_at TIMESTAMP)"
+        ))
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+    executed = []
+    for version, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        # 每个修订一个事务，失败时之前的修订保持已执行
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(text("INSERT INTO schema_migrations (version, applied_at) VALUES (:version, :applied_at)"),
+                         {'version': version, 'applied_at': datetime.utcnow()})
+        logger.info(f"已执行数据库修订: {version}")
+        executed.append(version)
+    return executed
+
+def _add_columns(conn, table, *names):
+    """为已有的表补充模型中声明的列（已存在的跳过）
+
+    SQLite中分区后的 api_logs 是视图，列加在各个分区表上，然后重建视图（视图按
+    LOG_COLUMNS 重建，缺少的列一并补齐）。
+    """
+    inspector = inspect(conn)
+    partitioned = conn.dialect.name == 'sqlite' and table.name in inspector.get_view_names()
+    if partitioned:
+        names = tuple(dict.fromkeys(names + LOG_COLUMNS))
+    targets = [name for name in inspector.get_table_names() if name.startswith(PARTITION_PREFIX)] \
+        if partitioned else [table.name]
+    for target in targets:
+        existing = {column['name'] for column in inspector.get_columns(target)}
+        for name in names:
+            if name not in existing:
+                conn.execute(text(f"ALTER TABLE {target} ADD COLUMN {_column_ddl(conn, table.c[name])}"))
+    if partitioned:
+        LogPartitionManager(None)._rebuild_sqlite_view(conn.connection.cursor())
+
+def _column_ddl(conn, column):
+    ddl = f"{conn.dialect.identifier_preparer.quote(column.name)} {column.type.compile(dialect=conn.dialect)}"
+    default = column.default.arg if column.default is not None and column.default.is_scalar else None
+    if isinstance(default, bool):
+        ddl += f" DEFAULT {int(default) if conn.dialect.name == 'sqlite' else str(default).upper()}"
+    elif isinstance(default, (int, float)):
+        ddl += f" DEFAULT {default!r}"
+    return ddl
+
+def _drop_not_null(conn, table, name):
+    column = next(c for c in inspect(conn).get_columns(table.name) if c['name'] == name)
+    if column['nullable']:
+        return
+    if conn.dialect.name != 'sqlite':
+        quoted = conn.dialect.identifier_preparer.quote(name)
+        conn.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {quoted} DROP NOT NULL"))
+        return
+    # SQLite不能修改列约束：按模型建新表，复制数据后替换（索引由调用方重建）
+    metadata = MetaData()
+    for referred in {fk.column.table for fk in table.foreign_keys}:
+        referred.to_metadata(metadata)
+    rebuilt = table.to_metadata(metadata, name=f'{table.name}_rebuild')
+    conn.execute(CreateTable(rebuilt))
+    quote = conn.dialect.identifier_preparer.quote
+    columns = ', '.join(quote(c['name']) for c in inspect(conn).get_columns(table.name) if c['name'] in table.c)
+    conn.execute(text(f"INSERT INTO {rebuilt.name} ({columns}) SELECT {columns} FROM {table.name}"))
+    conn.execute(text(f"DROP TABLE {table.name}"))
+    conn.execute(text(f"ALTER TABLE {rebuilt.name} RENAME TO {table.name}"))
+
+def _create_indexes(conn, table):
+    for index in table.indexes:
+        index.create(conn, checkfirst=True)
+
+# ---- 修订 ----
+
+def _request_rate_limits(conn):
+    _add_columns(conn, ApiKey.__table__, 'requests_per_second', 'requests_per_minute')
+
+def _usage_budgets(conn):
+    _add_columns(conn, ApiKey.__table__, 'daily_token_limit', 'monthly_token_limit',
+                 'daily_cost_limit', 'monthly_cost_limit')
+    _add_columns(conn, ApiLog.__table__, 'tokens', 'cost')
+    for table in (ApiStatHourly.__table__, ApiStatDaily.__table__):
+        table.create(conn, checkfirst=True)
+
+def _key_hashes(conn):
+    # 哈希迁移把 key 置为NULL，新密钥也不再写入 key
+    _add_columns(conn, ApiKey.__table__, 'key_prefix', 'key_hash', 'previous_key_prefix',
+                 'previous_key_hash', 'previous_key_expires_at')
+    _drop_not_null(conn, ApiKey.__table__, 'key')
+    _create_indexes(conn, ApiKey.__table__)
+
+def _time_to_first_token(conn):
+    _add_columns(conn, ApiLog.__table__, 'time_to_first_token')
+
+def _response_cache(conn):
+    _add_columns(conn, ApiKey.__table__, 'response_cache_enabled')
+    _add_columns(conn, ApiLog.__table__, 'cache_hit')
+    for table in (ApiStat.__table__, ApiStatHourly.__table__, ApiStatDaily.__table__):
+        _add_columns(conn, table, 'cache_hits')
+
+def create_model_indexes(conn):
+    """创建模型中声明的索引（已存在的跳过）；SQLite中分区后的 api_logs 由各分区表上的索引覆盖"""
+    views = set(inspect(conn).get_view_names()) if conn.dialect.name == 'sqlite' else set()
+    for table in db.metadata.sorted_tables:
+        if table.name not in views:
+            _create_indexes(conn, table)
+
+MIGRATIONS = (
+    ('0001_request_rate_limits', _request_rate_limits),
+    ('0002_usage_budgets', _usage_budgets),
+    ('0003_key_hashes', _key_hashes),
+    ('0004_admin_query_indexes', create_model_indexes),
+    ('0005_time_to_first_token', _time_to_first_token),
+    ('0006_response_cache', _response_cache),
+)
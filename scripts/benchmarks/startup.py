@@ -0,0 +1,173 @@
+"""工作进程冷启动基准
+
+分别以API节点（ADMIN_ENABLED=0，只导入 gate）和管理节点（同时注册管理后台）的
+方式在新的Python进程中启动应用，统计：
+
+- python -X importtime 的总导入耗时和最慢的模块，并检查API节点没有导入ORM
+- 进程启动到应用就绪（导入 + init_gate + 从快照预热密钥缓存）的耗时
+- 第一个携带API密钥的请求的耗时（预热后不需要查询密钥）
+
+每种方式运行 --runs 次取中位数，结果输出为JSON；API节点就绪耗时超过 --max-ready-ms
+或导入了ORM时以非零状态码退出。
+
+用法:
+    python scripts/benchmarks/startup.py --keys 5000 --runs 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT)
+
+# API节点不应导入的模块
+FORBIDDEN_MODULES = ('flask_sqlalchemy', 'sqlalchemy.orm', 'models', 'routes')
+
+# 在子进程中执行：启动应用并发送第一个请求，输出各阶段耗时
+BOOT_SCRIPT = r'''
+import json, os, sys, time
+started = time.perf_counter()
+from flask import Flask, jsonify
+from gate import init_gate, require_api_key
+imported = time.perf_counter()
+app = Flask('bench')
+app.config['SECRET_KEY'] = 'benchmark'
+manager = init_gate(app, database_url=os.environ['BENCH_DATABASE_URL'], hash_secret='benchmark',
+                    snapshot_path=os.environ['BENCH_SNAPSHOT'])
+
+@app.route('/v1/ping')
+@require_api_key
+def ping():
+    return jsonify({'ok': True})
+
+ready = time.perf_counter()
+response = app.test_client().get('/v1/ping', headers={'X-API-KEY': os.environ['BENCH_API_KEY']})
+first = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'init_ms': (ready - imported) * 1000,
+    'first_request_ms': (first - ready) * 1000,
+    'status': response.status_code,
+    'cached_keys': len(manager.key_cache.hot_prefixes()),
+}))
+'''
+
+def prepare(args, workdir):
+    """创建数据库和密钥，写出缓存快照，返回 (数据库URL, 快照路径, 一个明文密钥)"""
+    from flask import Flask
+    from api_keys import ApiKeyManager
+    from db_manager import create_db_manager
+    from models import db, User
+
+    url = 'sqlite:///' + os.path.join(workdir, 'startup.db')
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, username='admin', is_admin=True))
+        db.session.commit()
+    manager = ApiKeyManager(create_db_manager(url), cache_size=max(args.keys, 1), hash_secret='benchmark')
+    keys = manager.create_keys(args.keys, 1, name='startup')
+    for key in keys:
+        manager.validate_key(key['key'])
+    snapshot = os.path.join(workdir, 'key_cache.snapshot')
+    manager.dump_cache_snapshot(snapshot)
+    return url, snapshot, keys[0]['key']
+
+def parse_importtime(stderr):
+    """返回 (总导入耗时ms, [(模块, 累计耗时ms)], 导入的模块集合)"""
+    modules = {}
+    total_us = 0
+    for line in stderr.splitlines():
+        parts = line.split('|')
+        if not line.startswith('import time:') or len(parts) != 3 or 'cumulative' in line:
+            continue
+        cumulative = int(parts[1])
+        name = parts[2].rstrip()
+        modules[name.strip()] = max(modules.get(name.strip(), 0), cumulative)
+        if not name.startswith('  '):
+            # 顶层导入（未缩进）的累计耗时之和即总导入耗时
+            total_us += cumulative
+    slowest = sorted(modules.items(), key=lambda item: item[1], reverse=True)
+    return total_us / 1000, [(name, round(us / 1000, 2)) for name, us in slowest], set(modules)
+
+def importtime(statement, env):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return parse_importtime(result.stderr)
+
+def boot(env):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', BOOT_SCRIPT], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    wall_ms = (time.perf_counter() - started) * 1000
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process_ms'] = wall_ms
+    return timings
+
+def measure(mode, env, args):
+    statement = 'import gate' if mode == 'api' else 'import gate, routes'
+    total_ms, slowest, modules = importtime(statement, env)
+    runs = [boot(env) for _ in range(args.runs)]
+    result = {
+        'import_total_ms': round(total_ms, 2),
+        'slowest_imports': slowest[:args.top],
+        'forbidden_imports': sorted(m for m in FORBIDDEN_MODULES if m in modules),
+    }
+    for metric in ('process_ms', 'import_ms', 'init_ms', 'first_request_ms'):
+        result[f'{metric}_p50'] = round(statistics.median(run[metric] for run in runs), 2)
+    result['ready_ms_p50'] = round(statistics.median(run['import_ms'] + run['init_ms'] for run in runs), 2)
+    result['first_status'] = runs[-1]['status']
+    result['cached_keys'] = runs[-1]['cached_keys']
+    print(f"[{mode}] 导入 {result['import_total_ms']}ms，就绪 {result['ready_ms_p50']}ms，"
+          f"进程总耗时 {result['process_ms_p50']}ms", file=sys.stderr)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=1000, help='快照中的密钥数量')
+    parser.add_argument('--runs', type=int, default=5, help='每种方式启动的次数')
+    parser.add_argument('--top', type=int, default=15, help='输出最慢的N个模块')
+    parser.add_argument('--max-ready-ms', type=float, default=500, help='API节点就绪耗时上限')
+    parser.add_argument('--output', help='结果JSON文件（默认输出到标准输出）')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    url, snapshot, api_key = prepare(args, workdir)
+    base_env = dict(os.environ, BENCH_DATABASE_URL=url, BENCH_SNAPSHOT=snapshot, BENCH_API_KEY=api_key)
+    report = {
+        'python': sys.version.split()[0],
+        'params': {k: v for k, v in vars(args).items() if k != 'output'},
+        'results': {
+            'api': measure('api', dict(base_env, ADMIN_ENABLED='0'), args),
+            'admin': measure('admin', dict(base_env, ADMIN_ENABLED='1'), args),
+        },
+    }
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    api = report['results']['api']
+    failures = []
+    if api['forbidden_imports']:
+        failures.append(f"API节点导入了 {', '.join(api['forbidden_imports'])}")
+    if api['ready_ms_p50'] > args.max_ready_ms:
+        failures.append(f"API节点就绪耗时 {api['ready_ms_p50']}ms 超过 {args.max_ready_ms}ms")
+    if api['first_status'] != 200:
+        failures.append(f"第一个请求返回 {api['first_status']}")
+    for line in failures:
+        print(f"启动检查失败: {line}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
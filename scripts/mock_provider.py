@@ -0,0 +1,143 @@
+"""本地模拟的LLM提供商服务，用于测试上游连接池、多密钥分配和熔断
+
+支持 OpenAI（/v1/chat/completions）、Anthropic（/v1/messages）格式，请求体中
+"stream": true 时返回SSE流（最后一个事件带 usage）。GET /stats 返回每个上游密钥
+收到的请求数和当前连接数。
+
+用法:
+    python scripts/mock_provider.py --port 8900 --latency-ms 50 --rate-limited sk-b --error-rate 0.05
+    OPENAI_API_KEYS=sk-a,sk-b,sk-c OPENAI_BASE_URL=http://127.0.0.1:8900 ...
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class MockProvider(BaseHTTPRequestHandler):
+    # HTTP/1.1 保持连接，可以观察客户端的连接复用
+    protocol_version = 'HTTP/1.1'
+    options = None
+    counts = {}
+    connections = set()
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with self.lock:
+            self.connections.add(self.client_address)
+
+    def finish(self):
+        super().finish()
+        with self.lock:
+            self.connections.discard(self.client_address)
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            super().log_message(format, *args)
+
+    def _api_key(self):
+        auth = self.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            return auth[len('Bearer '):]
+        return self.headers.get('x-api-key') or self.headers.get('x-goog-api-key')
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with self.lock:
+                self._send_json(200, {'requests': dict(self.counts), 'connections': len(self.connections)})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        key = self._api_key()
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+        opts = self.options
+        if not key:
+            return self._send_json(401, {'error': 'missing api key'})
+        if key in opts.rate_limited:
+            return self._send_json(429, {'error': 'rate limited'}, {'Retry-After': str(opts.retry_after)})
+        time.sleep(opts.latency.get(key, opts.latency_ms) / 1000.0)
+        if random.random() < opts.error_rate:
+            return self._send_json(503, {'error': 'overloaded'})
+
+        anthropic = self.path.startswith('/v1/messages')
+        if body.get('stream'):
+            return self._stream(anthropic)
+        usage = ({'input_tokens': 12, 'output_tokens': opts.tokens} if anthropic
+                 else {'prompt_tokens': 12, 'completion_tokens': opts.tokens, 'total_tokens': 12 + opts.tokens})
+        self._send_json(200, {'id': 'mock', 'model': body.get('model'), 'usage': usage,
+                              'choices': [{'message': {'role': 'assistant', 'content': 'ok'}}]})
+
+    def _stream(self, anthropic):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        tokens = self.options.tokens
+        if anthropic:
+            events = [{'type': 'message_start', 'message': {'usage': {'input_tokens': 12, 'output_tokens': 1}}}]
+            events += [{'type': 'content_block_delta', 'delta': {'text': 'x'}}] * tokens
+            events.append({'type': 'message_delta', 'usage': {'output_tokens': tokens}})
+        else:
+            events = [{'choices': [{'delta': {'content': 'x'}}]}] * tokens
+            events.append({'choices': [], 'usage': {'prompt_tokens': 12, 'completion_tokens': tokens}})
+        for event in events:
+            self._chunk(f"data: {json.dumps(event)}\n\n".encode())
+            time.sleep(self.options.chunk_interval_ms / 1000.0)
+        if not anthropic:
+            self._chunk(b"data: [DONE]\n\n")
+        self._chunk(b'')
+
+    def _chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+def parse_latency(values):
+    latency = {}
+    for item in values or ():
+        key, _, ms = item.partition('=')
+        latency[key] = float(ms)
+    return latency
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency-ms', type=float, default=20, help='默认响应延迟')
+    parser.add_argument('--key-latency', action='append', help='按密钥设置延迟，如 sk-a=200（可重复）')
+    parser.add_argument('--rate-limited', default='', help='总是返回429的密钥（逗号分隔）')
+    parser.add_argument('--retry-after', type=int, default=5, help='429响应的 Retry-After（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回503的概率')
+    parser.add_argument('--tokens', type=int, default=20, help='每个响应的输出token数')
+    parser.add_argument('--chunk-interval-ms', type=float, default=5, help='流式响应事件间隔')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    args.rate_limited = {k for k in args.rate_limited.split(',') if k}
+    args.latency = parse_latency(args.key_latency)
+
+    MockProvider.options = args
+    server = ThreadingHTTPServer((args.host, args.port), MockProvider)
+    print(f"模拟提供商服务: http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import math
+import struct
+
+class LatencySketch:
+    """可合并的对数分桶延迟直方图（DDSketch 风格）
+
+    每个值落入下标为 ceil(log_gamma(v)) 的桶，分位数估计的相对误差不超过
+    relative_accuracy。桶计数可直接相加，任意时间范围的分位数通过合并得到。
+    """
+
+    VERSION = 1
+    RELATIVE_ACCURACY = 0.01
+    MIN_VALUE = 1e-4  # 小于0.1毫秒的值计入零桶
+
+    _gamma = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    _log_gamma = math.log(_gamma)
+    _header = struct.Struct('<BIH')
+    _bucket = struct.Struct('<hI')
+
+    def __init__(self):
+        self.buckets = {}
+        self.zero_count = 0
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.buckets.values())
+
+    def add(self, value, count=1):
+        """记录一个延迟值（秒）"""
+        if value < self.MIN_VALUE:
+            self.zero_count += count
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        """合并另一个直方图"""
+        self.zero_count += other.zero_count
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def quantile(self, q):
+        """返回分位数估计值，没有数据时返回None"""
+        total = self.count
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * self._gamma ** index / (self._gamma + 1)
+        return 2 * self._gamma ** max(self.buckets) / (self._gamma + 1)
+
+    def percentiles(self, quantiles=(0.5, 0.95, 0.99)):
+        """返回 {'p50': ..., 'p95': ..., 'p99': ...}"""
+        return {f"p{round(q * 100):d}": self.quantile(q) for q in quantiles}
+
+    def to_bytes(self):
+        """序列化为紧凑的二进制格式（每个非空桶6字节）"""
+        parts = [self._header.pack(self.VERSION, self.zero_count, len(self.buckets))]
+        parts.extend(self._bucket.pack(index, count) for index, count in sorted(self.buckets.items()))
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """从二进制格式反序列化，空值返回空直方图"""
+        sketch = cls()
+        if not data:
+            return sketch
+        data = bytes(data)
+        version, sketch.zero_count, size = cls._header.unpack_from(data)
+        if version != cls.VERSION:
+            raise ValueError(f"不支持的直方图版本: {version}")
+        offset = cls._header.size
+        for _ in range(size):
+            index, count = cls._bucket.unpack_from(data, offset)
+            sketch.buckets[index] = count
+            offset += cls._bucket.size
+        return sketch
+
+    @classmethod
+    def merge_all(cls, blobs):
+        """合并多个序列化后的直方图"""
+        sketch = cls()
+        for blob in blobs:
+            if blob:
+                sketch.merge(cls.from_bytes(blob))
+        return sketch
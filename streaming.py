@@ -0,0 +1,227 @@
+from functools import partial
+import asyncio
+import json
+import time
+import logging
+
+from flask import has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+# 已发送部分响应后客户端断开，沿用nginx的 499 状态码
+CLIENT_CLOSED_REQUEST = 499
+
+class UsageMeter:
+    """从SSE分块中提取token用量
+
+    分块原样转发，只在分块中出现 "usage" 字样时才解码对应的事件；跨分块的
+    未完成事件最多保留 max_event_size 字节。支持 OpenAI（usage.prompt_tokens）、
+    Anthropic（message.usage / usage.output_tokens）和 Google（usageMetadata）的
+    用量格式，同一字段以最后出现的值为准。
+    """
+
+    def __init__(self, max_event_size=65536):
+        self.max_event_size = max_event_size
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.chunks = 0
+        self._tail = None
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        self.chunks += 1
+        text = isinstance(chunk, str)
+        marker = 'usage' if text else b'usage'
+        end = self._event_boundary(chunk, text)
+        tail = self._tail if self._tail is not None and isinstance(self._tail, str) == text else None
+
+        if end == -1:
+            # 分块内没有完整事件，累积到下一个分块
+            tail = chunk if tail is None else tail + chunk
+            self._tail = tail if len(tail) <= self.max_event_size else None
+            return
+
+        if tail is not None:
+            # 事件跨分块时才拼接
+            events = tail + chunk[:end]
+            if marker in events:
+                self._parse(events)
+        elif chunk.find(marker, 0, end) != -1:
+            self._parse(chunk[:end])
+        self._tail = chunk[end:] if end < len(chunk) else None
+
+    @staticmethod
+    def _event_boundary(chunk, text):
+        """返回最后一个事件分隔符（空行）之后的位置，没有时返回 -1"""
+        lf, crlf = ('\n\n', '\r\n\r\n') if text else (b'\n\n', b'\r\n\r\n')
+        end = chunk.rfind(lf)
+        if end != -1:
+            end += 2
+        end_crlf = chunk.rfind(crlf)
+        if end_crlf != -1:
+            end = max(end, end_crlf + 4)
+        return end
+
+    def _parse(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        for line in data.splitlines():
+            if not line.startswith('data:'):
+                continue
+            payload = line[5:].strip()
+            if 'usage' not in payload or payload == '[DONE]':
+                continue
+            try:
+                self._apply(json.loads(payload))
+            except (ValueError, AttributeError) as e:
+                logger.debug(f"解析流式响应用量失败: {e}")
+
+    def _apply(self, event):
+        usage = (event.get('usage') or event.get('usageMetadata')
+                 or (event.get('message') or {}).get('usage'))
+        if not usage:
+            return
+        prompt = _first(usage, 'prompt_tokens', 'input_tokens', 'promptTokenCount')
+        completion = _first(usage, 'completion_tokens', 'output_tokens', 'candidatesTokenCount')
+        if prompt is not None:
+            self.prompt_tokens = prompt
+        if completion is not None:
+            self.completion_tokens = completion
+
+def _first(mapping, *keys):
+    for key in keys:
+        if mapping.get(key) is not None:
+            return mapping[key]
+    return None
+
+class _StreamCall:
+    """一次流式调用的计时、用量和结束时的日志记录"""
+
+    def __init__(self, api_key_manager, client_ip, provider, model, api_key_id,
+                 request_path, request_method, started_at):
+        self.api_key_manager = api_key_manager
+        self.client_ip = client_ip
+        self.provider = provider
+        self.model = model
+        self.api_key_id = api_key_id
+        self.request_path = request_path
+        self.request_method = request_method
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.first_chunk_at = None
+        self.meter = UsageMeter()
+
+    def feed(self, chunk):
+        if self.first_chunk_at is None and chunk:
+            self.first_chunk_at = time.perf_counter()
+        self.meter.feed(chunk)
+
+    def log(self, success, error_message, response_code):
+        finished_at = time.perf_counter()
+        ttft = self.first_chunk_at - self.started_at if self.first_chunk_at is not None else None
+        self.api_key_manager.log_api_call(
+            self.client_ip, self.provider, self.model, self.api_key_id, success,
+            error_message=error_message,
+            response_time=finished_at - self.started_at,
+            prompt_tokens=self.meter.prompt_tokens,
+            completion_tokens=self.meter.completion_tokens,
+            time_to_first_token=ttft,
+            response_code=response_code,
+            request_path=self.request_path,
+            request_method=self.request_method
+        )
+
+def _request_info(request_path, request_method):
+    # 生成器在请求上下文之外执行，请求信息需要在创建时取得
+    if request_path is None and has_request_context():
+        return request.path, request.method
+    return request_path, request_method
+
+def stream_with_usage(api_key_manager, chunks, client_ip, provider, model, api_key_id,
+                      started_at=None, request_path=None, request_method=None):
+    """包装上游SSE分块迭代器，分块原样转发
+
+    记录首个分块耗时（time_to_first_token）、总耗时和最后事件中的token用量，
+    流结束、上游出错或客户端断开（WSGI服务器调用 close()）时写入一条日志。
+    started_at 为上游请求开始时的 time.perf_counter()，默认取包装时刻。
+    """
+    call = _StreamCall(api_key_manager, client_ip, provider, model, api_key_id,
+                       *_request_info(request_path, request_method), started_at)
+    return _Relay(call, chunks)
+
+class _Relay:
+    """转发上游分块的迭代器，结束、出错或 close() 时关闭上游并写入一次日志
+
+    不用生成器实现：生成器在第一次 next() 之前被关闭不会执行 finally，
+    客户端在首个分块到达前断开时会漏记日志。
+    """
+
+    def __init__(self, call, chunks):
+        self.call = call
+        self.chunks = chunks
+        self._iterator = iter(chunks)
+        self._finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        try:
+            chunk = next(self._iterator)
+            self.call.feed(chunk)
+        except StopIteration:
+            self._finish(True, None, 200)
+            raise
+        except Exception as e:
+            logger.error(f"转发流式响应时出错: {e}")
+            self._finish(False, str(e), 502)
+            raise
+        return chunk
+
+    def close(self):
+        self._finish(False, '客户端断开连接', CLIENT_CLOSED_REQUEST)
+
+    def _finish(self, success, error_message, response_code):
+        if self._finished:
+            return
+        self._finished = True
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            try:
+                close()
+            except Exception as e:
+                logger.error(f"关闭上游流式响应时出错: {e}")
+        self.call.log(success, error_message, response_code)
+
+def astream_with_usage(api_key_manager, chunks, client_ip, provider, model, api_key_id,
+                       started_at=None, request_path=None, request_method=None):
+    """stream_with_usage 的异步版本，用于Quart/Starlette的流式响应
+
+    api_key_manager 为同步的 ApiKeyManager；日志在线程池中提交，断开连接时
+    不需要在已取消的任务中等待。
+    """
+    call = _StreamCall(api_key_manager, client_ip, provider, model, api_key_id,
+                       request_path, request_method, started_at)
+    return _arelay(call, chunks)
+
+async def _arelay(call, chunks):
+    outcome = (False, '客户端断开连接', CLIENT_CLOSED_REQUEST)
+    try:
+        async for chunk in chunks:
+            call.feed(chunk)
+            yield chunk
+        outcome = (True, None, 200)
+    except (GeneratorExit, asyncio.CancelledError):
+        raise
+    except Exception as e:
+        logger.error(f"转发流式响应时出错: {e}")
+        outcome = (False, str(e), 502)
+        raise
+    finally:
+        log = partial(call.log, *outcome)
+        try:
+            asyncio.get_running_loop().run_in_executor(None, log)
+        except RuntimeError:
+            log()
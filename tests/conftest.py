@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from api_keys import ApiKeyManager  # noqa: E402
+from db_manager import DatabaseManager  # noqa: E402
+from models import db, User  # noqa: E402
+import routes  # noqa: E402
+
+def create_app(url):
+    """创建管理后台应用（不建表）"""
+    app = Flask(__name__, template_folder=os.path.join(ROOT, 'templates'))
+    app.config.update(SQLALCHEMY_DATABASE_URI=url, SECRET_KEY='test', TESTING=True)
+    # 模板引用的登录蓝图和部分后台页面不在本仓库中
+    app.url_build_error_handlers.append(lambda error, endpoint, values: '#')
+    db.init_app(app)
+    routes.init_app(app)
+    app.api_key_manager = ApiKeyManager(DatabaseManager(url), hash_secret='test')
+    return app
+
+@pytest.fixture
+def app(tmp_path):
+    """使用临时SQLite数据库的管理后台应用，包含一个管理员（id=1）"""
+    app = create_app('sqlite:///' + str(tmp_path / 'api_keys.db'))
+    with app.app_context():
+        db.create_all()
+        admin = User(username='admin', is_admin=True)
+        admin.set_password('password')
+        db.session.add(admin)
+        db.session.commit()
+    yield app
+    app.api_key_manager.close()
+    app.api_key_manager.db_manager.close()
+
+@pytest.fixture
+def admin_client(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    return client
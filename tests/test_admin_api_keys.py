@@ -0,0 +1,45 @@
+import re
+
+def test_created_key_is_shown_once_and_not_stored_in_session(app, admin_client):
+    response = admin_client.post('/admin/api-keys/new', data={
+        'name': 'web', 'validity_days': '30', 'daily_limit': '100', 'requests_per_minute': '5',
+        'response_cache_enabled': 'on'
+    })
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-store'
+    api_key = re.search(r'<code class="user-select-all">([^<]+)</code>', response.get_data(as_text=True)).group(1)
+    with admin_client.session_transaction() as session:
+        assert api_key not in str(dict(session))
+
+    key = app.api_key_manager.validate_key(api_key)
+    assert (key['name'], key['daily_limit'], key['requests_per_minute']) == ('web', 100, 5)
+    assert key['response_cache_enabled']
+    assert api_key not in admin_client.get('/admin/api-keys').get_data(as_text=True)
+
+def test_key_search_matches_wildcards_literally(app):
+    manager = app.api_key_manager
+    ids = {name: manager.create_key(name, 1)['id'] for name in ('ci_bot', 'cixbot', '100%', 'other')}
+
+    rows, _ = manager.get_key_list(search='ci_')
+    assert [row['id'] for row in rows] == [ids['ci_bot']]
+    assert manager.revoke_keys(search='%') == [ids['100%']]
+    assert manager.revoke_keys(search='_') == [ids['ci_bot']]
+    rows, _ = manager.get_key_list(status='active')
+    assert {row['id'] for row in rows} == {ids['cixbot'], ids['other']}
+
+def test_bulk_create_rejects_invalid_limits(app, admin_client):
+    for limits in ({'requests_per_minute': -1}, {'daily_token_limit': 'many'}, {'daily_cost_limit': 'nan'},
+                   {'monthly_cost_limit': [1]}, {'daily_limit': -5}):
+        response = admin_client.post('/admin/api-keys/bulk/create', json={'count': 1, 'name': 'bulk', **limits})
+        assert response.status_code == 400, limits
+    rows, _ = app.api_key_manager.get_key_list()
+    assert rows == []
+
+def test_bulk_create_coerces_limits(app, admin_client):
+    response = admin_client.post('/admin/api-keys/bulk/create', json={
+        'count': 2, 'name': 'bulk', 'requests_per_minute': '30', 'daily_cost_limit': '1.5', 'monthly_token_limit': 0
+    })
+    assert response.status_code == 200
+    rows, _ = app.api_key_manager.get_key_list()
+    assert [(row['requests_per_minute'], row['daily_cost_limit'], row['monthly_token_limit'], row['daily_limit'])
+            for row in rows] == [(30, 1.5, None, 1000)] * 2
@@ -0,0 +1,80 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db, SystemLog, User
+
+# 每个后台页面允许的SQL语句数（不含管理员身份缓存过期时查询 users 的一条）
+PAGE_QUERY_BUDGETS = {
+    '/admin/api-keys': 2,
+    '/admin/api-keys/{key_id}': 4,
+    '/admin/stats': 1,
+    '/admin/logs': 2,
+}
+
+@contextmanager
+def count_statements(app):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+def _seed(app, users, keys_per_user, calls_per_key):
+    """每个用户创建若干密钥，每个密钥写入调用日志、统计汇总和系统日志"""
+    manager = app.api_key_manager
+    with app.app_context():
+        for i in range(users):
+            user = User(username=f'user{User.query.count() + 1}', is_admin=False)
+            user.set_password('password')
+            db.session.add(user)
+            db.session.commit()
+            for j in range(keys_per_user):
+                key = manager.create_key(f'{user.username}-{j}', user.id)
+                with app.test_request_context('/v1/chat'):
+                    for n in range(calls_per_key):
+                        manager.log_api_call('127.0.0.1', 'openai', 'gpt-4o', key['id'], n % 4 != 0,
+                                             error_message='E' * 5000, response_time=0.1,
+                                             prompt_tokens=10, completion_tokens=5)
+                SystemLog.log(f'created {key["id"]}', source='admin')
+        db.session.commit()
+    return key['id']
+
+def _page_queries(app, client, key_id):
+    counts = {}
+    client.get('/admin/api-keys')  # 首次请求查询并缓存管理员身份
+    for path in PAGE_QUERY_BUDGETS:
+        url = path.format(key_id=key_id)
+        with count_statements(app) as statements:
+            response = client.get(url)
+        # 页面中的异常（包括 lazy='raise' 关系被访问）会重定向，只统计正常渲染的页面
+        assert response.status_code == 200, url
+        counts[path] = list(statements)
+    return counts
+
+def test_admin_pages_stay_within_query_budget(app, admin_client):
+    key_id = _seed(app, users=2, keys_per_user=2, calls_per_key=3)
+    for path, statements in _page_queries(app, admin_client, key_id).items():
+        assert len(statements) <= PAGE_QUERY_BUDGETS[path], (path, statements)
+
+def test_admin_query_count_does_not_grow_with_rows(app, admin_client):
+    key_id = _seed(app, users=1, keys_per_user=1, calls_per_key=1)
+    small = _page_queries(app, admin_client, key_id)
+    key_id = _seed(app, users=5, keys_per_user=4, calls_per_key=10)
+    large = _page_queries(app, admin_client, key_id)
+    for path in PAGE_QUERY_BUDGETS:
+        assert len(large[path]) == len(small[path]), (path, large[path])
+
+def test_expired_admin_identity_adds_one_query(app, admin_client):
+    key_id = _seed(app, users=1, keys_per_user=1, calls_per_key=1)
+    cached = _page_queries(app, admin_client, key_id)
+    app.config['ADMIN_IDENTITY_TTL'] = 0
+    with count_statements(app) as statements:
+        assert admin_client.get('/admin/api-keys').status_code == 200
+    assert len(statements) == len(cached['/admin/api-keys']) + 1
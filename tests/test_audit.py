@@ -0,0 +1,51 @@
+from datetime import datetime
+import json
+
+from audit import AuditSink
+
+def _record(message):
+    return {'timestamp': datetime(2026, 1, 1), 'level': 'INFO', 'message': message, 'source': 'admin'}
+
+def _messages(manager):
+    with manager.db_manager.get_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT message FROM system_logs ORDER BY id")]
+
+def test_replay_quarantines_corrupt_lines(app, tmp_path):
+    manager = app.api_key_manager
+    spool = tmp_path / 'audit.jsonl'
+    sink = AuditSink(manager.db_manager, spool_path=str(spool))
+    sink._spool([_record('first')])
+    with open(spool, 'a', encoding='utf-8') as f:
+        f.write('{"timestamp": "2026-01-01T00:00:00", "level": "INFO", "mess\n')
+        f.write(json.dumps({'timestamp': 'yesterday', 'level': 'INFO', 'message': 'x', 'source': None}) + '\n')
+    sink._spool([_record('second')])
+
+    assert sink.replay_spool() == 2
+    assert _messages(manager) == ['first', 'second']
+    assert not spool.exists() and not (tmp_path / 'audit.jsonl.replay').exists()
+    assert len((tmp_path / 'audit.jsonl.corrupt').read_text(encoding='utf-8').splitlines()) == 2
+
+def test_flush_replays_spool_only_after_insert_succeeds(app, tmp_path, monkeypatch):
+    manager = app.api_key_manager
+    spool = tmp_path / 'audit.jsonl'
+    sink = AuditSink(manager.db_manager, spool_path=str(spool))
+    replays = []
+    replay_spool = sink.replay_spool
+    monkeypatch.setattr(sink, 'replay_spool', lambda: replays.append(1) or replay_spool())
+
+    sink._flush([_record('online')])
+    assert replays == []
+
+    def fail(records):
+        raise RuntimeError('database is down')
+    monkeypatch.setattr(sink, '_insert', fail)
+    sink._flush([_record('offline')])
+    assert replays == [] and spool.exists()
+
+    monkeypatch.undo()
+    monkeypatch.setattr(sink, 'replay_spool', lambda: replays.append(1) or replay_spool())
+    sink._retry_at = 0.0
+    sink._flush([_record('recovered')])
+    assert replays == [1]
+    assert _messages(manager) == ['online', 'recovered', 'offline']
+    assert not spool.exists()
@@ -0,0 +1,34 @@
+import pytest
+
+from api_keys import ApiKeyManager
+from cluster import KeyInvalidationSync, LocalInvalidationBus
+from db_manager import DatabaseManager
+
+@pytest.fixture
+def nodes(app):
+    """与 app 共用同一个数据库的两个节点，通过同一个 LocalInvalidationBus 同步缓存失效"""
+    url = 'sqlite:///' + app.api_key_manager.db_manager.database
+    bus = LocalInvalidationBus()
+    managers = [ApiKeyManager(DatabaseManager(url), hash_secret='test') for _ in range(2)]
+    syncs = [KeyInvalidationSync(manager, bus).start() for manager in managers]
+    yield managers
+    for sync, manager in zip(syncs, managers):
+        sync.close()
+        manager.close()
+        manager.db_manager.close()
+
+def test_revoke_on_one_node_evicts_key_on_the_other(nodes):
+    first, second = nodes
+    key = first.create_key('shared', 1, requests_per_minute=2)
+    prefix = key['key'].split('.')[0]
+    for manager in nodes:
+        assert manager.validate_key(key['key'])['id'] == key['id']
+    assert second.check_request_rate(second.validate_key(key['key'])).allowed
+    assert second.key_cache.get(prefix)[0]
+
+    assert first.revoke_keys(key_ids=[key['id']]) == [key['id']]
+
+    assert second.key_cache.get(prefix) == (False, None)
+    assert second.validate_key(key['key']) is None
+    assert first.validate_key(key['key']) is None
+    assert second.rate_limiter.check(key['id'], [(2, 60)]).remaining == 1
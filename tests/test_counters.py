@@ -0,0 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import pytest
+
+from counters import ReconciledCounterBackend, RedisCounterBackend
+
+fakeredis = pytest.importorskip('fakeredis')
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+def _redis(server):
+    return RedisCounterBackend(fakeredis.FakeRedis(server=server))
+
+def _admit(backend, key, limit):
+    """与 ApiKeyManager 的每日限额检查相同：先加1，超限时退回"""
+    if backend.incr(key, 1, 86400) > limit:
+        backend.incr(key, -1, 86400)
+        return False
+    return True
+
+def test_redis_backend_counts_and_expires(server):
+    backend = _redis(server)
+    assert backend.get('daily:1') == 0
+    assert backend.incr('daily:1', 2, ttl=60) == 2
+    assert backend.incr('cost:1', 0.25) == 0.25
+    assert backend.incr('cost:1', 0.5) == 0.75
+    assert backend.setdefault('daily:1', 100, ttl=60) == 2
+    assert backend.setdefault('tokens:1', 100, ttl=60) == 100
+    assert 0 < backend.client.ttl('akm:daily:1') <= 60
+    backend.delete('daily:1')
+    assert backend.get('daily:1') == 0
+
+def test_redis_backend_concurrent_increments_are_atomic(server):
+    backends = [_redis(server) for _ in range(4)]
+    with ThreadPoolExecutor(8) as pool:
+        admitted = list(pool.map(lambda i: _admit(backends[i % 4], 'daily:1', 50), range(200)))
+    assert admitted.count(True) == 50
+    assert backends[0].get('daily:1') == 50
+
+def test_reconciled_overshoot_is_bounded_by_nodes_times_max_pending(server):
+    nodes, max_pending, limit = 3, 10, 100
+    backends = [ReconciledCounterBackend(_redis(server), sync_interval=60, max_pending={'daily': max_pending})
+                for _ in range(nodes)]
+    barrier = threading.Barrier(nodes * 2)
+    admitted = []
+
+    def worker(backend):
+        barrier.wait()
+        admitted.append(sum(_admit(backend, 'daily:1', limit) for _ in range(200)))
+    threads = [threading.Thread(target=worker, args=(backends[i % nodes],)) for i in range(nodes * 2)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    for backend in backends:
+        backend.close()
+
+    assert limit <= sum(admitted) <= limit + nodes * max_pending
+    # 退回的次数与多加的次数相互抵消，对账后全局值等于放行的次数
+    assert _redis(server).get('daily:1') == sum(admitted)
+
+def test_reconciled_flushes_pending_increments(server):
+    remote = _redis(server)
+    backend = ReconciledCounterBackend(remote, sync_interval=60, max_pending={'tokens': 1000, 'cost': 1.0})
+    assert backend.incr('tokens:1', 100, ttl=60) == 100  # 新计数器立即同步
+    for _ in range(5):
+        backend.incr('tokens:1', 100, ttl=60)
+        backend.incr('cost:1', 0.1, ttl=60)
+    assert remote.get('tokens:1') == 100
+    assert backend.get('tokens:1') == 600
+
+    backend.sync()
+    assert remote.get('tokens:1') == 600
+    assert remote.get('cost:1') == pytest.approx(0.5)
+    assert 0 < remote.client.ttl('akm:tokens:1') <= 60
+    # 其他节点的增量在本节点下一次对账后可见
+    remote.incr('tokens:1', 50)
+    assert backend.incr('tokens:1', 1) == 601
+    backend.sync()
+    assert backend.get('tokens:1') == remote.get('tokens:1') == 651
+
+def test_reconciled_keeps_increments_while_remote_is_down(server, monkeypatch):
+    remote = _redis(server)
+    backend = ReconciledCounterBackend(remote, sync_interval=60, max_pending={'daily': 100})
+    backend.incr('daily:1', 1)
+
+    def down(*args, **kwargs):
+        raise ConnectionError('redis is down')
+    monkeypatch.setattr(remote, 'incr', down)
+    for _ in range(3):
+        backend.incr('daily:1', 1)
+    backend.sync()
+    assert remote.get('daily:1') == 1
+    assert backend.get('daily:1') == 4
+
+    monkeypatch.undo()
+    backend.close()
+    assert remote.get('daily:1') == 4
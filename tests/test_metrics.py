@@ -0,0 +1,28 @@
+import builtins
+
+import metrics
+from metrics import MetricsRegistry, SlowRequestProfiler
+
+def test_profiler_writes_files_outside_lock(tmp_path, monkeypatch):
+    profiler = SlowRequestProfiler(str(tmp_path), top_n=2)
+    opened = []
+    real_open = builtins.open
+
+    def checked_open(*args, **kwargs):
+        opened.append(profiler._lock.locked())
+        return real_open(*args, **kwargs)
+    monkeypatch.setattr(metrics, 'open', checked_open, raising=False)
+
+    for i in range(4):
+        profiler.begin()
+        profiler._active[next(iter(profiler._active))][1]['main (app.py:1)'] += i + 1
+        profiler.end(f'GET /slow/{i}')
+    assert opened and not any(opened)
+    assert len(list(tmp_path.glob('*.folded'))) == len(profiler._slowest) == 2
+
+def test_render_includes_every_stage():
+    registry = MetricsRegistry(name='t', buckets=(0.1,))
+    registry.observe('auth', 0.05)
+    registry.observe('db', 0.5)
+    text = registry.render()
+    assert 't_count{stage="auth"} 1' in text and 't_bucket{stage="db",le="+Inf"} 1' in text
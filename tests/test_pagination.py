@@ -0,0 +1,36 @@
+from datetime import datetime, timedelta
+
+import pagination
+from models import db, SystemLog
+from pagination import decode_cursor, keyset_paginate
+
+def test_count_is_estimated_once_and_carried_in_cursor(app, monkeypatch):
+    calls = []
+    estimate_count = pagination.estimate_count
+    monkeypatch.setattr(pagination, 'estimate_count', lambda *args: calls.append(args) or estimate_count(*args))
+    start = datetime(2026, 1, 1)
+    with app.app_context():
+        db.session.add_all(SystemLog(timestamp=start + timedelta(seconds=i), message=str(i)) for i in range(120))
+        db.session.commit()
+        columns = (SystemLog.timestamp, SystemLog.id)
+
+        first = keyset_paginate(SystemLog.query, columns, per_page=50)
+        second = keyset_paginate(SystemLog.query, columns, cursor=first.next_cursor, per_page=50)
+        third = keyset_paginate(SystemLog.query, columns, cursor=second.next_cursor, per_page=50)
+        back = keyset_paginate(SystemLog.query, columns, cursor=third.prev_cursor, per_page=50)
+
+    assert len(calls) == 1
+    assert [(p.total, p.total_exact) for p in (first, second, third, back)] == [(120, True)] * 4
+    assert [len(p.items) for p in (first, second, third)] == [50, 50, 20]
+    assert [log.id for log in back.items] == [log.id for log in second.items]
+    assert third.next_cursor is None
+
+def test_cursor_without_total_is_still_accepted(app):
+    with app.app_context():
+        db.session.add_all(SystemLog(message=str(i)) for i in range(3))
+        db.session.commit()
+        first = keyset_paginate(SystemLog.query, (SystemLog.id,), per_page=1)
+        values, before = decode_cursor(first.next_cursor, (int,))
+        page = keyset_paginate(SystemLog.query, (SystemLog.id,),
+                               cursor=pagination.encode_cursor(values, before), per_page=1)
+    assert (page.total, page.total_exact) == (3, True)
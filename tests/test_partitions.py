@@ -0,0 +1,73 @@
+from datetime import datetime
+import os
+
+import pytest
+
+from models import ApiLog
+from partitions import DEFAULT_PARTITION, LogPartitionManager
+
+def _log_calls(app, key_id, count):
+    with app.test_request_context('/v1/chat'):
+        for _ in range(count):
+            app.api_key_manager.log_api_call('127.0.0.1', 'openai', 'gpt-4o', key_id, True, response_time=0.1)
+
+def _insert_old_logs(app, key_id, timestamps):
+    with app.api_key_manager.db_manager.get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO api_logs (api_key_id, timestamp, provider, success, response_time) VALUES (?, ?, 'openai', 1, 0.1)",
+            [(key_id, ts) for ts in timestamps]
+        )
+        conn.commit()
+
+@pytest.fixture
+def key_id(app):
+    return app.api_key_manager.create_key('partitioned', 1)['id']
+
+@pytest.fixture
+def partitions(app, tmp_path):
+    return LogPartitionManager(app.api_key_manager.db_manager, archive_dir=str(tmp_path / 'archive'))
+
+def test_insert_after_partitioning_round_trips(app, key_id, partitions):
+    _log_calls(app, key_id, 3)
+    _insert_old_logs(app, key_id, ['2020-01-15 10:00:00'])
+    assert partitions.enable()
+
+    _log_calls(app, key_id, 2)
+    with app.app_context():
+        logs = ApiLog.query.order_by(ApiLog.id).all()
+    assert [log.id for log in logs] == [1, 2, 3, 4, 5, 6]
+    assert logs[-1].timestamp.date() == datetime.utcnow().date()
+    assert logs[3].timestamp == datetime(2020, 1, 15, 10)
+
+def test_default_partition_has_key_time_index(app, key_id, partitions):
+    partitions.enable()
+    with app.api_key_manager.db_manager.get_connection() as conn:
+        row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                           (f'ix_{DEFAULT_PARTITION}_key_time',)).fetchone()
+    assert row is not None
+
+def test_enable_resumes_after_interruption(app, key_id, partitions, monkeypatch):
+    _log_calls(app, key_id, 2)
+    _insert_old_logs(app, key_id, ['2020-01-15 10:00:00', '2020-02-15 10:00:00'])
+
+    def fail(starts):
+        raise RuntimeError('interrupted')
+    with monkeypatch.context() as patched:
+        patched.setattr(partitions, '_create_partitions', fail)
+        with pytest.raises(RuntimeError):
+            partitions.enable()
+
+    assert partitions.enable()
+    assert not partitions.enable()
+    with app.app_context():
+        assert ApiLog.query.count() == 4
+    assert {'api_logs_p202001', 'api_logs_p202002'} <= set(partitions.list_partitions())
+
+def test_archive_exports_partition_in_batches(app, key_id, partitions):
+    _insert_old_logs(app, key_id, [f'2020-01-{day:02d} 10:00:00' for day in range(1, 8)])
+    partitions.enable()
+    path = os.path.join(partitions.archive_dir, 'api_logs_p202001.jsonl.gz')
+    os.makedirs(partitions.archive_dir)
+
+    assert partitions._export_partition('api_logs_p202001', path, batch_size=3) == 7
+    assert [log['id'] for log in partitions.iter_archived_logs()] == list(range(1, 8))
@@ -0,0 +1,18 @@
+from pricing import PriceTable
+
+def test_only_known_models_are_cached():
+    table = PriceTable(max_cache_size=2)
+    for i in range(10):
+        assert table.cost('openai', f'unknown-{i}', 100, 100) == 0.0
+    assert table.cost('openai', 'gpt-4o-2024-08-06', 1000000, 0) == 2.50
+    assert table.lookup('openai', 'gpt-4o-mini') == (0.15, 0.60)
+    assert table.lookup('anthropic', 'claude-3-haiku-20240307') == (0.25, 1.25)
+    assert len(table._resolved) == 2
+    assert ('openai', 'gpt-4o-2024-08-06') not in table._resolved
+
+def test_unknown_models_are_counted():
+    table = PriceTable(max_cache_size=2)
+    for model in ('a', 'a', 'b', 'c'):
+        assert table.lookup('openai', model) is None
+    assert table.unknown_calls == 4
+    assert table.unknown_models == {('openai', 'a'): 2, ('openai', 'b'): 1}
@@ -0,0 +1,71 @@
+import pytest
+
+from providers import NoUpstreamKeyAvailable, ProviderPool
+
+httpx = pytest.importorskip('httpx')
+
+def _pool(handler, secrets=('sk-a',), **options):
+    client = httpx.Client(base_url='http://upstream', transport=httpx.MockTransport(handler))
+    return ProviderPool('openai', list(secrets), client=client, **options)
+
+def _recording(status_codes):
+    calls = []
+
+    def handler(request):
+        calls.append(request.headers['authorization'])
+        return httpx.Response(status_codes[min(len(calls), len(status_codes)) - 1], json={'n': len(calls)})
+    return handler, calls
+
+def test_stream_returns_upstream_error_when_no_key_left():
+    handler, calls = _recording([429])
+    pool = _pool(handler, max_attempts=3)
+    with pool.stream('POST', '/v1/chat/completions', json={}) as response:
+        assert response.status_code == 429
+        assert response.read()
+    assert len(calls) == 1
+
+def test_stream_raises_when_all_keys_are_open():
+    handler, calls = _recording([429])
+    pool = _pool(handler)
+    with pool.stream('POST', '/v1/chat/completions', json={}):
+        pass
+    with pytest.raises(NoUpstreamKeyAvailable):
+        with pool.stream('POST', '/v1/chat/completions', json={}):
+            pass
+
+def test_post_is_not_retried_after_5xx():
+    handler, calls = _recording([502, 200])
+    pool = _pool(handler, secrets=('sk-a', 'sk-b'))
+    assert pool.request('POST', '/v1/chat/completions', json={}).status_code == 502
+    with pool.stream('POST', '/v1/chat/completions', json={}) as response:
+        assert response.status_code == 200
+    assert len(calls) == 2
+
+def test_idempotent_request_is_retried_after_5xx():
+    handler, calls = _recording([503, 200])
+    pool = _pool(handler, secrets=('sk-a', 'sk-b'))
+    with pool.stream('GET', '/v1/models') as response:
+        assert response.status_code == 200
+    assert len(set(calls)) == 2
+
+def test_rate_limited_post_moves_to_next_key():
+    handler, calls = _recording([429, 200])
+    pool = _pool(handler, secrets=('sk-a', 'sk-b'))
+    assert pool.request('POST', '/v1/chat/completions', json={}).status_code == 200
+    assert len(set(calls)) == 2
+
+def test_failed_probe_reopens_breaker(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('providers.time.monotonic', lambda: now[0])
+    handler, calls = _recording([429, 502, 200])
+    pool = _pool(handler, secrets=('sk-a',), cooldown=5.0)
+    assert pool.request('POST', '/v1/chat/completions', json={}).status_code == 429
+    now[0] += 5.0
+    assert pool.request('POST', '/v1/chat/completions', json={}).status_code == 502
+    key = pool.keys[0]
+    assert (key.trips, key.open_until, key.probing) == (2, 115.0, False)
+    with pytest.raises(NoUpstreamKeyAvailable):
+        pool.choose()
+    now[0] += 10.0
+    assert pool.request('POST', '/v1/chat/completions', json={}).status_code == 200
+    assert key.trips == 0 and len(calls) == 3
@@ -0,0 +1,48 @@
+from flask import jsonify
+import pytest
+
+from api_keys import RateLimiter, require_api_key
+
+@pytest.fixture
+def client(app):
+    @app.route('/v1/ping')
+    @require_api_key
+    def ping():
+        return jsonify({'ok': True})
+    return app.test_client()
+
+def _remaining_slots(manager, key, requests_per_minute=3):
+    """再占用一次每分钟额度，返回占用前剩余的次数"""
+    result = manager.rate_limiter.check(key['id'], [(requests_per_minute, 60)])
+    return result.remaining + 1 if result.allowed else 0
+
+def _get(client, key):
+    return client.get('/v1/ping', headers={'X-API-KEY': key['key']})
+
+def test_daily_limit_rejections_refund_request_rate(app, client):
+    manager = app.api_key_manager
+    key = manager.create_key('daily', 1, daily_limit=1, requests_per_minute=3)
+    assert _get(client, key).status_code == 200
+    for _ in range(5):
+        response = _get(client, key)
+        assert response.status_code == 429
+        assert 'Retry-After' not in response.headers
+    assert _remaining_slots(manager, key) == 2
+
+def test_budget_rejections_do_not_use_request_rate(app, client):
+    manager = app.api_key_manager
+    key = manager.create_key('budget', 1, daily_token_limit=10, requests_per_minute=3)
+    with app.test_request_context('/v1/ping'):
+        manager.log_api_call('127.0.0.1', 'openai', 'gpt-4o', key['id'], True, prompt_tokens=20)
+    for _ in range(5):
+        assert _get(client, key).status_code == 429
+    assert _remaining_slots(manager, key) == 3
+
+def test_refund_restores_slot():
+    limiter = RateLimiter()
+    limits = [(2, 1), (3, 60)]
+    assert limiter.check(1, limits).allowed
+    assert limiter.check(1, limits).allowed
+    assert not limiter.check(1, limits).allowed
+    limiter.refund(1, limits)
+    assert limiter.check(1, limits).allowed
@@ -0,0 +1,21 @@
+from response_cache import canonical_request_hash, is_cacheable
+
+def _payload(content, **params):
+    return {'model': 'gpt-4o', 'temperature': 0, 'messages': [{'role': 'user', 'content': content}], **params}
+
+def test_whitespace_in_messages_changes_hash():
+    code = '```python\nprint(1)\n```'
+    assert canonical_request_hash('openai', _payload(code)) != canonical_request_hash('openai', _payload(code + '\n'))
+    assert canonical_request_hash('openai', _payload('hi')) != canonical_request_hash('openai', _payload(' hi'))
+
+def test_structure_is_normalized():
+    a = _payload('hi', max_tokens=10, user='u1')
+    b = {'max_tokens': 10.0, 'messages': [{'content': 'hi', 'role': 'user', 'name': None}],
+         'temperature': 0.0, 'model': 'gpt-4o', 'top_p': None}
+    assert canonical_request_hash('openai', a) == canonical_request_hash('openai', b)
+
+def test_non_numeric_temperature_is_not_cacheable():
+    assert is_cacheable(_payload('hi'))
+    assert not is_cacheable(_payload('hi', temperature='cold'))
+    assert not is_cacheable(_payload('hi', temperature=[0]))
+    assert not is_cacheable(_payload('hi', temperature=0.7))
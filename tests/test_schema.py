@@ -0,0 +1,172 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import inspect
+
+from conftest import create_app
+from models import db
+from partitions import LOG_COLUMNS, LogPartitionManager
+import schema
+
+# 加入分区、限流和预算等功能之前的表结构（与最初的 models.py 一致）
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL, username VARCHAR(80) NOT NULL, password_hash VARCHAR(128), is_admin BOOLEAN,
+    status VARCHAR(20), created_at DATETIME, last_login DATETIME,
+    PRIMARY KEY (id), UNIQUE (username)
+);
+CREATE TABLE system_logs (
+    id INTEGER NOT NULL, timestamp DATETIME, level VARCHAR(20), message TEXT, source VARCHAR(100),
+    PRIMARY KEY (id)
+);
+CREATE TABLE api_keys (
+    id INTEGER NOT NULL, "key" VARCHAR(32) NOT NULL, name VARCHAR(100), status VARCHAR(20),
+    created_by INTEGER NOT NULL, created_at DATETIME, updated_at DATETIME, expires_at DATETIME,
+    last_used_at DATETIME, daily_limit INTEGER, total_calls INTEGER,
+    PRIMARY KEY (id), UNIQUE ("key"), FOREIGN KEY(created_by) REFERENCES users (id)
+);
+CREATE TABLE api_logs (
+    id INTEGER NOT NULL, api_key_id INTEGER NOT NULL, timestamp DATETIME, client_ip VARCHAR(45),
+    provider VARCHAR(20), model VARCHAR(50), request_path VARCHAR(200), request_method VARCHAR(10),
+    response_code INTEGER, response_time FLOAT, success BOOLEAN, error_message TEXT,
+    PRIMARY KEY (id), FOREIGN KEY(api_key_id) REFERENCES api_keys (id)
+);
+CREATE TABLE api_stats (
+    id INTEGER NOT NULL, api_key_id INTEGER NOT NULL, date DATE NOT NULL, provider VARCHAR(20) NOT NULL,
+    total_calls INTEGER, success_calls INTEGER, average_latency FLOAT, total_tokens INTEGER, total_cost FLOAT,
+    PRIMARY KEY (id), CONSTRAINT unique_daily_stats UNIQUE (api_key_id, date, provider),
+    FOREIGN KEY(api_key_id) REFERENCES api_keys (id)
+);
+INSERT INTO users (id, username, is_admin) VALUES (1, 'admin', 1);
+INSERT INTO api_keys (id, "key", name, status, created_by, created_at, daily_limit, total_calls)
+VALUES (1, 'legacykey0123456789abcdefghijklm', 'legacy', 'active', 1, '2024-01-01 00:00:00', 1000, 0);
+"""
+
+@pytest.fixture
+def legacy_app(tmp_path):
+    path = tmp_path / 'legacy.db'
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.close()
+    app = create_app(f'sqlite:///{path}')
+    yield app
+    app.api_key_manager.db_manager.close()
+
+def _columns(app, table):
+    with app.app_context():
+        return {column['name']: column for column in inspect(db.engine).get_columns(table)}
+
+def test_upgrade_adds_request_rate_columns(legacy_app):
+    with legacy_app.app_context():
+        executed = schema.upgrade(db.engine)
+    assert executed == [version for version, _ in schema.MIGRATIONS]
+    assert {'requests_per_second', 'requests_per_minute'} <= set(_columns(legacy_app, 'api_keys'))
+
+def test_upgrade_is_idempotent_on_new_database(app):
+    with app.app_context():
+        assert schema.upgrade(db.engine) == [version for version, _ in schema.MIGRATIONS]
+        assert schema.upgrade(db.engine) == []
+
+def test_upgrade_adds_usage_columns_and_rollup_tables(legacy_app):
+    with legacy_app.app_context():
+        schema.upgrade(db.engine)
+        tables = set(inspect(db.engine).get_table_names())
+    assert {'daily_token_limit', 'monthly_token_limit', 'daily_cost_limit', 'monthly_cost_limit'} \
+        <= set(_columns(legacy_app, 'api_keys'))
+    assert {'tokens', 'cost'} <= set(_columns(legacy_app, 'api_logs'))
+    assert {'api_stats_hourly', 'api_stats_daily'} <= tables
+
+def test_upgrade_adds_columns_to_sqlite_log_partitions(app):
+    manager = app.api_key_manager
+    LogPartitionManager(manager.db_manager).enable()
+    # 模拟分区时 api_logs 还没有 tokens/cost 列
+    with manager.db_manager.get_connection() as conn:
+        partitions = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'api_logs_p%'")]
+        columns = [c for c in LOG_COLUMNS if c not in ('tokens', 'cost')]
+        conn.execute("DROP VIEW api_logs")
+        for name in partitions:
+            conn.execute(f"ALTER TABLE {name} DROP COLUMN tokens")
+            conn.execute(f"ALTER TABLE {name} DROP COLUMN cost")
+        conn.execute("CREATE VIEW api_logs AS " + " UNION ALL ".join(
+            f"SELECT {', '.join(columns)} FROM {name}" for name in partitions))
+        conn.commit()
+
+    with app.app_context():
+        schema.upgrade(db.engine)
+    with app.test_request_context('/v1/chat'):
+        manager.log_api_call('127.0.0.1', 'openai', 'gpt-4o', 1, True, prompt_tokens=7)
+    with manager.db_manager.get_connection() as conn:
+        rows = conn.execute("SELECT api_key_id, tokens FROM api_logs").fetchall()
+    assert [tuple(row) for row in rows] == [(1, 7)]
+
+def test_upgrade_allows_hashed_and_legacy_keys(legacy_app):
+    with legacy_app.app_context():
+        schema.upgrade(db.engine)
+        indexes = {index['name']: index for index in inspect(db.engine).get_indexes('api_keys')}
+    columns = _columns(legacy_app, 'api_keys')
+    assert columns['key']['nullable']
+    assert {'key_prefix', 'key_hash', 'previous_key_prefix', 'previous_key_hash', 'previous_key_expires_at'} \
+        <= set(columns)
+    assert indexes['ix_api_keys_key_prefix']['unique']
+
+    manager = legacy_app.api_key_manager
+    created = manager.create_key('hashed', 1)
+    assert manager.validate_key(created['key'])['id'] == created['id']
+    assert manager.validate_key('legacykey0123456789abcdefghijklm')['id'] == 1
+    with manager.db_manager.get_connection() as conn:
+        row = conn.execute("SELECT key, key_hash, name, created_at FROM api_keys WHERE id = 1").fetchone()
+    assert row['key'] is None and row['key_hash']
+    assert row['name'] == 'legacy' and row['created_at'].year == 2024
+
+def test_migrate_key_hashes_runs_pending_revisions_first(legacy_app):
+    result = legacy_app.test_cli_runner().invoke(args=['admin', 'migrate-key-hashes'])
+    assert result.exit_code == 0, result.output
+    assert '0003_key_hashes' in result.output
+    assert '已迁移明文API密钥 1 个' in result.output
+    with legacy_app.api_key_manager.db_manager.get_connection() as conn:
+        migrated = conn.execute("SELECT COUNT(*) FROM api_keys WHERE key IS NULL AND key_hash IS NOT NULL")
+        assert migrated.fetchone()[0] == 1
+
+def test_upgrade_creates_model_indexes(legacy_app):
+    with legacy_app.app_context():
+        schema.upgrade(db.engine)
+        inspector = inspect(db.engine)
+        indexes = {index['name'] for table in ('api_keys', 'api_logs', 'api_stats', 'system_logs')
+                   for index in inspector.get_indexes(table)}
+    assert {'ix_api_keys_created_at_id', 'ix_api_logs_key_time', 'ix_api_stats_date_provider',
+            'ix_system_logs_timestamp', 'ix_system_logs_level_source_time'} <= indexes
+
+def test_create_indexes_skips_partitioned_sqlite_logs(app):
+    LogPartitionManager(app.api_key_manager.db_manager).enable()
+    result = app.test_cli_runner().invoke(args=['admin', 'create-indexes'])
+    assert result.exit_code == 0, result.output
+
+def test_upgrade_adds_time_to_first_token(legacy_app):
+    with legacy_app.app_context():
+        schema.upgrade(db.engine)
+    assert _columns(legacy_app, 'api_logs')['time_to_first_token']['nullable']
+
+def test_upgraded_legacy_database_serves_requests(legacy_app):
+    with legacy_app.app_context():
+        schema.upgrade(db.engine)
+    assert 'response_cache_enabled' in _columns(legacy_app, 'api_keys')
+    assert 'cache_hits' in _columns(legacy_app, 'api_stats')
+
+    manager = legacy_app.api_key_manager
+    key = manager.create_key('upgraded', 1, requests_per_minute=10, daily_token_limit=1000,
+                             response_cache_enabled=True)
+    key_obj = manager.validate_key(key['key'])
+    assert key_obj['response_cache_enabled']
+    assert manager.check_request_rate(key_obj).allowed
+    assert manager.check_budget(key_obj)
+    with legacy_app.test_request_context('/v1/chat'):
+        manager.log_api_call('127.0.0.1', 'openai', 'gpt-4o', key['id'], True, response_time=0.2,
+                             prompt_tokens=100, completion_tokens=50, time_to_first_token=0.05)
+        manager.log_api_call('127.0.0.1', 'openai', 'gpt-4o', key['id'], True, cache_hit=True)
+    with manager.db_manager.get_connection() as conn:
+        assert tuple(conn.execute("SELECT SUM(tokens), SUM(cache_hit) FROM api_logs").fetchone()) == (150, 1)
+        assert tuple(conn.execute("SELECT total_calls, total_tokens, cache_hits FROM api_stats").fetchone()) \
+            == (1, 150, 1)
+        assert tuple(conn.execute("SELECT total_calls, cache_hits FROM api_stats_hourly").fetchone()) == (1, 1)
+        assert tuple(conn.execute("SELECT total_calls, cache_hits FROM api_stats_daily").fetchone()) == (1, 1)
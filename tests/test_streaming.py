@@ -0,0 +1,59 @@
+from streaming import CLIENT_CLOSED_REQUEST, stream_with_usage
+
+class RecordingManager:
+    def __init__(self):
+        self.calls = []
+
+    def log_api_call(self, client_ip, provider, model, api_key_id, success, **kwargs):
+        self.calls.append(dict(kwargs, success=success))
+
+class Upstream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+USAGE = b'data: {"usage": {"prompt_tokens": 3, "completion_tokens": 4}}\n\n'
+
+def _stream(manager, upstream):
+    return stream_with_usage(manager, upstream, '127.0.0.1', 'openai', 'gpt-4o', 1,
+                             request_path='/v1/chat/completions', request_method='POST')
+
+def test_close_before_first_chunk_is_logged():
+    manager, upstream = RecordingManager(), Upstream([USAGE])
+    _stream(manager, upstream).close()
+    assert upstream.closed
+    assert [(c['success'], c['response_code'], c['time_to_first_token']) for c in manager.calls] \
+        == [(False, CLIENT_CLOSED_REQUEST, None)]
+
+def test_completed_stream_is_logged_once():
+    manager, upstream = RecordingManager(), Upstream([b'data: {}\n\n', USAGE])
+    stream = _stream(manager, upstream)
+    assert list(stream) == [b'data: {}\n\n', USAGE]
+    stream.close()
+    assert upstream.closed
+    assert len(manager.calls) == 1
+    call = manager.calls[0]
+    assert (call['success'], call['response_code'], call['prompt_tokens'], call['completion_tokens']) \
+        == (True, 200, 3, 4)
+    assert call['time_to_first_token'] is not None
+
+def test_upstream_error_is_logged():
+    def chunks():
+        yield USAGE
+        raise ConnectionError('reset')
+    manager = RecordingManager()
+    stream = _stream(manager, chunks())
+    assert next(stream) == USAGE
+    try:
+        next(stream)
+    except ConnectionError:
+        pass
+    stream.close()
+    assert [(c['success'], c['response_code'], c['error_message']) for c in manager.calls] \
+        == [(False, 502, 'reset')]